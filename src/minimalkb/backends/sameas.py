@@ -0,0 +1,61 @@
+import logging; logger = logging.getLogger("minimalKB."+__name__);
+
+class SameAs:
+    """ Union-find structure over the owl:sameAs statements: each set of
+    equivalent resources is represented by a canonical resource (the
+    smallest one, so that the representative does not depend on the order
+    in which the statements have been asserted).
+
+    Equivalences are merged with 'union'. Removing a owl:sameAs statement
+    may split a set: the sets it belonged to are rebuilt with 'split'.
+    """
+
+    def __init__(self, pairs = []):
+        self.parent = {}
+        for a, b in pairs:
+            self.union(a, b)
+
+    def find(self, resource):
+        """ Returns the canonical representative of a resource (the resource
+        itself if it has no equivalent).
+        """
+        root = resource
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+
+        # path compression
+        while resource != root:
+            self.parent[resource], resource = root, self.parent[resource]
+
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return
+        if rb < ra:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.parent.setdefault(ra, ra)
+
+    def split(self, resources, pairs):
+        """ Forgets the equivalences of the given resources, and merges them
+        again with the given pairs.
+
+        :param resources: whole sets of equivalent resources
+        """
+        for resource in resources:
+            self.parent.pop(resource, None)
+        for a, b in pairs:
+            self.union(a, b)
+
+    def canonical(self, resources = None):
+        """ Returns a dictionary {resource: canonical representative} for
+        all the resources that have at least one equivalent (including the
+        representatives themselves).
+
+        :param resources: if given, only these resources are considered
+        """
+        if resources is None:
+            resources = self.parent
+        return {resource: self.find(resource) for resource in resources if resource in self.parent}
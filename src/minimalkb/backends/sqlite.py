@@ -1,12 +1,16 @@
 import logging; logger = logging.getLogger("minimalKB."+__name__);
 DEBUG_LEVEL=logging.DEBUG
 
+import time
 import datetime
 import sqlite3
+from contextlib import contextmanager
 
-from sqlite_queries import query, simplequery, matchingstmt
+from sqlite_queries import query, joinquery, compiled, simplequery, matchingstmt, nb_variables, QueryProfile, CLOSURES
+from sqlite_filters import register_functions
+from sameas import SameAs
 from minimalkb.kb import DEFAULT_MODEL
-from minimalkb.helpers import memoize
+from minimalkb.helpers import memoize, parse_literal, literal_value
 
 TRIPLETABLENAME = "triples"
 TRIPLETABLE = '''CREATE TABLE IF NOT EXISTS %s
@@ -17,110 +21,890 @@ TRIPLETABLE = '''CREATE TABLE IF NOT EXISTS %s
                     "model" TEXT NOT NULL ,
                     "timestamp" DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL ,
                     "expires" DATETIME ,
-                    "inferred" BOOLEAN DEFAULT 0 NOT NULL)'''
+                    "inferred" BOOLEAN DEFAULT 0 NOT NULL ,
+                    "lexical" TEXT ,
+                    "datatype" TEXT ,
+                    "lang" TEXT ,
+                    "numeric" REAL)'''
+
+# for literal objects, 'lexical', 'datatype' and 'lang' store the parsed
+# literal, and 'numeric' its value for numbers and dates (as seconds since the
+# epoch). These columns are NULL for resources.
+TYPEDCOLUMNS = ["lexical", "datatype", "lang", "numeric"]
+
+TRIPLEINDICES = ['''CREATE INDEX IF NOT EXISTS subject_idx ON %s (subject, predicate)''',
+                 '''CREATE INDEX IF NOT EXISTS object_idx ON %s (object, predicate)''',
+                 '''CREATE INDEX IF NOT EXISTS numeric_idx ON %s (predicate, numeric)''',
+                 """CREATE INDEX IF NOT EXISTS label_idx ON %s (lexical COLLATE NOCASE)
+                    WHERE predicate='rdfs:label'"""]
+
+# temporary (ie, per connection) tables used to stage the keys of bulk operations
+STAGEDTABLE = '''CREATE TEMP TABLE IF NOT EXISTS staged
+                    ("hash" INTEGER PRIMARY KEY NOT NULL ,
+                    "subject" TEXT NOT NULL ,
+                    "predicate" TEXT NOT NULL ,
+                    "model" TEXT NOT NULL)'''
+REMOVEDTABLE = '''CREATE TEMP TABLE IF NOT EXISTS removed
+                    ("hash" INTEGER PRIMARY KEY NOT NULL)'''
+
+# canonical representatives of the resources that have owl:sameAs
+# equivalents, used by queries (see 'sqlite_queries.joinquery'). Mirrors the
+# store's union-find structure.
+SAMEASTABLE = '''CREATE TEMP TABLE IF NOT EXISTS sameas
+                    ("resource" TEXT PRIMARY KEY NOT NULL ,
+                    "canonical" TEXT NOT NULL)'''
+SAMEASINDEX = '''CREATE INDEX IF NOT EXISTS temp.sameas_canonical ON sameas (canonical)'''
+
+# statements recently added, joined with the other patterns of a query to find
+# its new results (see 'SQLStore.bindings')
+DELTATABLE = '''CREATE TEMP TABLE IF NOT EXISTS delta
+                    ("subject" TEXT NOT NULL ,
+                    "predicate" TEXT NOT NULL ,
+                    "object" TEXT NOT NULL ,
+                    "model" TEXT NOT NULL ,
+                    "lexical" TEXT ,
+                    "datatype" TEXT ,
+                    "lang" TEXT ,
+                    "numeric" REAL)'''
+
+# last access to resources, for the LRU eviction of statements (see
+# 'SQLStore.set_capacity')
+ACCESSEDTABLE = '''CREATE TEMP TABLE IF NOT EXISTS accessed
+                    ("resource" TEXT PRIMARY KEY NOT NULL ,
+                    "time" REAL NOT NULL)'''
+
+# Eviction policies of the bounded models: the oldest statements first, the
+# statements about the least recently accessed resources first, or the
+# statements with the lowest predicate priority first (then, the oldest).
+# Once a model exceeds its capacity, statements are evicted down to (1 -
+# EVICTION_MARGIN) x capacity, so that evictions are amortized over many
+# writes.
+EVICTION_OLDEST = "oldest"
+EVICTION_LRU = "lru"
+EVICTION_PRIORITY = "priority"
+EVICTION_POLICIES = [EVICTION_OLDEST, EVICTION_LRU, EVICTION_PRIORITY]
+EVICTION_MARGIN = 0.1
+
+# predicates along which inferred knowledge is inherited
+TAXONOMY_PREDICATES = ["rdf:type", "rdfs:subClassOf"]
+
+# The change log is an append-only journal of every modification of the
+# triple table, with monotonic sequence numbers. It is fed by SQL triggers, so
+# that writes from every process sharing the database (the KB itself, but also
+# the reasoner and the lifespan manager) are recorded.
+CHANGELOGTABLENAME = "changelog"
+CHANGELOGTABLE = '''CREATE TABLE IF NOT EXISTS %s
+                    ("seq" INTEGER PRIMARY KEY AUTOINCREMENT ,
+                    "op" TEXT NOT NULL ,
+                    "subject" TEXT ,
+                    "predicate" TEXT ,
+                    "object" TEXT ,
+                    "model" TEXT ,
+                    "inferred" BOOLEAN DEFAULT 0 NOT NULL ,
+                    "timestamp" DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL)'''
+
+# a deleted statement whose lifespan is over is logged as 'expire' instead of 'retract'
+CHANGELOGTRIGGERS = ['''CREATE TRIGGER IF NOT EXISTS log_add AFTER INSERT ON %s
+                    BEGIN
+                        INSERT INTO %s (op, subject, predicate, object, model, inferred)
+                        VALUES ('add', NEW.subject, NEW.predicate, NEW.object, NEW.model, NEW.inferred);
+                    END''',
+                     '''CREATE TRIGGER IF NOT EXISTS log_delete AFTER DELETE ON %s
+                    BEGIN
+                        INSERT INTO %s (op, subject, predicate, object, model, inferred)
+                        VALUES (CASE WHEN OLD.expires IS NOT NULL AND
+                                          OLD.expires < strftime('%%Y-%%m-%%dT%%H:%%M:%%f', 'now', 'localtime')
+                                     THEN 'expire' ELSE 'retract' END,
+                                OLD.subject, OLD.predicate, OLD.object, OLD.model, OLD.inferred);
+                    END''']
+
+CHANGELOG_SIZE = 100000 # max number of changes kept in the change log
+
+# Property characteristics cached by the store (together with the
+# owl:inverseOf and owl:sameAs axioms). The cache is kept up to date from the
+# change log.
+PROPERTY_CHARACTERISTICS = ["owl:FunctionalProperty",
+                            "owl:InverseFunctionalProperty",
+                            "owl:SymmetricProperty",
+                            "owl:TransitiveProperty"]
+
+# Statistics of the reasoner's rules (number of inferred statements, time
+# spent evaluating each rule), written by the reasoner process.
+RULESTATSTABLENAME = "rulestats"
+RULESTATSTABLE = '''CREATE TABLE IF NOT EXISTS %s
+                    ("rule" TEXT PRIMARY KEY NOT NULL ,
+                    "firings" INTEGER DEFAULT 0 NOT NULL ,
+                    "time" REAL DEFAULT 0 NOT NULL ,
+                    "runs" INTEGER DEFAULT 0 NOT NULL)'''
+
+# Axioms whose removal may invalidate any inferred statement of the model
+SCHEMA_PREDICATES = ["rdfs:domain",
+                     "rdfs:range",
+                     "rdfs:subPropertyOf",
+                     "owl:inverseOf"]
+
+# Full-text index of the resources' labels (rdfs:label), used for fuzzy
+# lookups. It is maintained by triggers, and uses the FTS5 trigram tokenizer
+# if available (substring and typo-tolerant matching), else the default FTS5
+# tokenizer (word prefixes). Without FTS5, label lookups scan the labels.
+LABELTABLENAME = "labels"
+LABELTABLE = '''CREATE VIRTUAL TABLE IF NOT EXISTS %s
+                    USING fts5(resource UNINDEXED, model UNINDEXED, label%s)'''
+LABELTRIGGERS = ['''CREATE TRIGGER IF NOT EXISTS label_add AFTER INSERT ON %s
+                    WHEN NEW.predicate='rdfs:label'
+                    BEGIN
+                        INSERT INTO %s (rowid, resource, model, label)
+                        VALUES (NEW.hash, NEW.subject, NEW.model, IFNULL(NEW.lexical, NEW.object));
+                    END''',
+                 '''CREATE TRIGGER IF NOT EXISTS label_delete AFTER DELETE ON %s
+                    WHEN OLD.predicate='rdfs:label'
+                    BEGIN
+                        DELETE FROM %s WHERE rowid=OLD.hash;
+                    END''']
+
+# Fuzzy lookups with a limit rank at most LABEL_CANDIDATES labels: the best
+# ones according to FTS5 (bm25, that favours short labels), among the labels
+# matching the first LABEL_PREFIX characters of the longest words of the
+# looked-up text (at most LABEL_WORDS words). Ranking all the labels sharing
+# trigrams with the text would cost the number of labels containing common
+# words.
+LABEL_CANDIDATES = 50
+LABEL_WORDS = 4
+LABEL_PREFIX = 4
+
+# Index of the kinds of resources (class, instance, property...), used to
+# answer 'typeof' with one lookup. Each statement is evidence of the kind of
+# some of its terms, and the table counts, per model, the statements
+# supporting each kind of each resource. It is maintained by triggers (and
+# is thus updated by the reasoner as well).
+#
+# When several kinds are supported, the one with the lowest code wins.
+KINDSTABLENAME = "kinds"
+KINDSTABLE = '''CREATE TABLE IF NOT EXISTS %s
+                    ("resource" TEXT NOT NULL ,
+                    "model" TEXT NOT NULL ,
+                    "kind" INTEGER NOT NULL ,
+                    "count" INTEGER NOT NULL ,
+                    PRIMARY KEY (resource, model, kind)) WITHOUT ROWID'''
+
+KINDS = {1: "object_property",   # <r rdf:type owl:ObjectProperty>
+         2: "datatype_property", # <r rdf:type owl:DatatypeProperty>
+         3: "class",             # <r rdf:type owl:Class>
+         4: "instance",          # <r rdf:type ?c> (or "literal", if r is a literal)
+         5: "class",             # <?i rdf:type r>, <r rdfs:subClassOf ?c>, <?c rdfs:subClassOf r>
+         6: "datatype_property", # <?s r "literal">
+         7: "object_property"}   # <?s r ?o>
+
+# (resource, kind, condition) for each kind of evidence brought by a statement
+KINDEVIDENCE = [("%(row)s.predicate", "CASE WHEN %(row)s.lexical IS NULL THEN 7 ELSE 6 END", "1"),
+                ("%(row)s.subject", """CASE %(row)s.object WHEN 'owl:ObjectProperty' THEN 1
+                                                          WHEN 'owl:DatatypeProperty' THEN 2
+                                                          WHEN 'owl:Class' THEN 3
+                                                          ELSE 4 END""", "%(row)s.predicate='rdf:type'"),
+                ("%(row)s.object", "5", "%(row)s.predicate IN ('rdf:type', 'rdfs:subClassOf')"),
+                ("%(row)s.subject", "5", "%(row)s.predicate='rdfs:subClassOf'")]
+
+def kindtriggers():
+    add = []
+    delete = []
+    for resource, kind, condition in KINDEVIDENCE:
+        add.append('''INSERT OR IGNORE INTO %(kinds)s SELECT %(resource)s, NEW.model, %(kind)s, 0 WHERE %(condition)s;
+                      UPDATE %(kinds)s SET count=count+1
+                      WHERE %(condition)s AND resource=%(resource)s AND model=NEW.model AND kind=%(kind)s;''' % \
+                      {"kinds": KINDSTABLENAME,
+                       "resource": resource % {"row": "NEW"},
+                       "kind": kind % {"row": "NEW"},
+                       "condition": condition % {"row": "NEW"}})
+        delete.append('''UPDATE %(kinds)s SET count=count-1
+                         WHERE %(condition)s AND resource=%(resource)s AND model=OLD.model AND kind=%(kind)s;
+                         DELETE FROM %(kinds)s
+                         WHERE %(condition)s AND resource=%(resource)s AND model=OLD.model AND kind=%(kind)s AND count<=0;''' % \
+                      {"kinds": KINDSTABLENAME,
+                       "resource": resource % {"row": "OLD"},
+                       "kind": kind % {"row": "OLD"},
+                       "condition": condition % {"row": "OLD"}})
+
+    return ["CREATE TRIGGER IF NOT EXISTS kind_add AFTER INSERT ON %s BEGIN %s END" % (TRIPLETABLENAME, "\n".join(add)),
+            "CREATE TRIGGER IF NOT EXISTS kind_delete AFTER DELETE ON %s BEGIN %s END" % (TRIPLETABLENAME, "\n".join(delete))]
+
+def kindbackfill():
+    evidence = " UNION ALL ".join("SELECT %s AS resource, model, %s AS kind FROM %s WHERE %s" % \
+                                    (resource % {"row": TRIPLETABLENAME},
+                                     kind % {"row": TRIPLETABLENAME},
+                                     TRIPLETABLENAME,
+                                     condition % {"row": TRIPLETABLENAME})
+                                  for resource, kind, condition in KINDEVIDENCE)
+    return '''INSERT INTO %s (resource, model, kind, count)
+              SELECT resource, model, kind, COUNT(*) FROM (%s)
+              GROUP BY resource, model, kind''' % (KINDSTABLENAME, evidence)
+
+def modellist(models):
+    """ Accepts a single model, or a list of models.
+    """
+    if isinstance(models, basestring):
+        return [models]
+    return list(models)
 
 def sqlhash(s,p,o,model):
     return hash("%s%s%s%s"%(s,p,o, model))
 
+def typed(atom):
+    """ Returns the values of the typed columns (lexical, datatype, lang,
+    numeric) for a given object.
+    """
+    atom = unicode(atom)
+    literal = parse_literal(atom)
+    if literal:
+        lexical, datatype, lang = literal
+        return lexical, datatype, lang, literal_value(lexical, datatype)
+
+    if "@" in atom or "^^" in atom: # not strictly Turtle, but accepted as literals
+        return atom, None, None, None
+
+    return None, None, None, None
+
 class SQLStore:
 
-    def __init__(self):
-        self.conn = sqlite3.connect('kb.db')
+    def __init__(self, database = "kb.db", backward = False):
+        """
+        :param backward: if True, the closure of the taxonomy (rdf:type and
+        rdfs:subClassOf) is computed at query time instead of being
+        materialized by the reasoner (see 'sqlite_queries.closure').
+        """
+        self.conn = sqlite3.connect(database)
+        self.backward = backward
+        register_functions(self.conn)
         self.create_kb()
 
+        # staging tables for bulk updates and removals
+        with self.conn:
+            self.conn.execute(STAGEDTABLE)
+            self.conn.execute(REMOVEDTABLE)
+            self.conn.execute(SAMEASTABLE)
+            self.conn.execute(SAMEASINDEX)
+            self.conn.execute(ACCESSEDTABLE)
+            self.conn.execute(DELTATABLE)
+
+        # cache of the property axioms: {(s, p, o): number of models where the
+        # axiom is stated}, up to change '_axiomseq' of the change log
+        self._axioms = {}
+        self._axiomseq = 0
         self._functionalproperties = frozenset()
+        self._inverses = {}
+
+        # owl:sameAs equivalences (in any model): union-find structure, the
+        # pairs it has been built from, {resource: canonical} and {canonical:
+        # [resources]}
+        self._sameas = SameAs()
+        self._sameaspairs = set()
+        self._canonical = {}
+        self._equivalents = {}
+
+        # bounded models: {model: (capacity, eviction policy, {predicate:
+        # priority})}, and their number of asserted statements (None: to be
+        # counted) up to change '_sizeseq' of the change log
+        self._capacities = {}
+        self._sizes = None
+        self._sizeseq = 0
+
+        # last access to resources, not yet written to the 'accessed' table
+        self._accessed = {}
+
+        # if True, writes join the current group transaction (see 'begin_group')
+        self.grouped = False
+
+        # callables notified after each committed write (eg, to wake up the
+        # reasoner)
+        self.listeners = []
+
+        self.load_axioms()
 
     def create_kb(self):
     
         with self.conn:
             self.conn.execute(TRIPLETABLE % TRIPLETABLENAME)
+        self.migrate()
+
+        with self.conn:
+            for index in TRIPLEINDICES:
+                self.conn.execute(index % TRIPLETABLENAME)
+            self.conn.execute(CHANGELOGTABLE % CHANGELOGTABLENAME)
+            for trigger in CHANGELOGTRIGGERS:
+                self.conn.execute(trigger % (TRIPLETABLENAME, CHANGELOGTABLENAME))
+            self.conn.execute(RULESTATSTABLE % RULESTATSTABLENAME)
+
+        self.create_label_index()
+        self.create_kinds_index()
+
+    def create_kinds_index(self):
+
+        existing = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                     (KINDSTABLENAME,)).fetchone()
+        with self.conn:
+            self.conn.execute(KINDSTABLE % KINDSTABLENAME)
+            for trigger in kindtriggers():
+                self.conn.execute(trigger)
+
+            if not existing:
+                self.conn.execute(kindbackfill())
+
+    def create_label_index(self):
+
+        existing = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                     (LABELTABLENAME,)).fetchone()
+
+        self._labelindex = None
+        for tokenizer in ["trigram", None]:
+            try:
+                with self.conn:
+                    self.conn.execute(LABELTABLE % (LABELTABLENAME, ", tokenize='%s'" % tokenizer if tokenizer else ""))
+                self._labelindex = "fts5"
+                break
+            except sqlite3.OperationalError:
+                pass
+
+        if not self._labelindex:
+            logger.warn("SQLite FTS5 not available. Label lookups will be slow.")
+            return
+
+        sql = self.conn.execute("SELECT sql FROM sqlite_master WHERE name=?", (LABELTABLENAME,)).fetchone()[0]
+        if "trigram" in sql:
+            self._labelindex = "trigram"
+
+        with self.conn:
+            for trigger in LABELTRIGGERS:
+                self.conn.execute(trigger % (TRIPLETABLENAME, LABELTABLENAME))
+
+            if not existing:
+                self.conn.execute("""INSERT INTO %s (rowid, resource, model, label)
+                                     SELECT hash, subject, model, IFNULL(lexical, object) FROM %s
+                                     WHERE predicate='rdfs:label'""" % (LABELTABLENAME, TRIPLETABLENAME))
+
+    def migrate(self):
+        """ Adds the typed literal columns to triple tables created by
+        previous versions of minimalKB.
+        """
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(%s)" % TRIPLETABLENAME)]
+        missing = [c for c in TYPEDCOLUMNS if c not in columns]
+        if not missing:
+            return
+
+        logger.info("Adding typed literal columns to the knowledge base.")
+        for column in missing:
+            self.conn.execute("ALTER TABLE %s ADD COLUMN \"%s\" %s" % (TRIPLETABLENAME, column, "REAL" if column == "numeric" else "TEXT"))
+
+        with self.conn:
+            self.conn.executemany('''UPDATE %s SET lexical=?, datatype=?, lang=?, numeric=?
+                                     WHERE hash=?''' % TRIPLETABLENAME,
+                                  [typed(o) + (hash,) for hash, o in self.conn.execute("SELECT hash, object FROM %s" % TRIPLETABLENAME).fetchall()])
 
     def clear(self):
         with self.conn:
             self.conn.execute("DROP TABLE %s" % TRIPLETABLENAME)
+            if self._labelindex:
+                self.conn.execute("DELETE FROM %s" % LABELTABLENAME)
+            self.conn.execute("DELETE FROM %s" % KINDSTABLENAME)
+            self.conn.execute("INSERT INTO %s (op) VALUES ('clear')" % CHANGELOGTABLENAME)
 
         self.create_kb()
         self.onupdate()
 
-    def add(self, stmts, model = DEFAULT_MODEL, lifespan = 0, replace = False):
+    def add(self, stmts, models = [DEFAULT_MODEL], lifespan = 0):
+        """ Adds the statements to each of the models, in one transaction.
+        """
+        with self.transaction():
+            self.insert(stmts, models, lifespan)
+
+        self.onupdate()
 
+    def delete(self, stmts, models = [DEFAULT_MODEL]):
+        """ Removes the statements from each of the models, in one
+        transaction.
+        """
+        models = modellist(models)
+
+        with self.transaction():
+            self.conn.execute("DELETE FROM removed")
+            self.conn.executemany("INSERT OR IGNORE INTO removed VALUES (?)",
+                                  [(sqlhash(s,p,o, model),) for model in models for s,p,o in stmts])
+
+            self.remove_staged(models)
+
+        self.onupdate()
+
+    def expire(self):
+        """ Removes the statements whose lifespan has expired, as well as the
+        inferences that depend on them (see 'remove_staged'). Returns the
+        number of expired statements.
+        """
+        # (the axioms may have been changed by another connection)
+        self.refresh_axioms()
+
+        with self.transaction():
+            self.conn.execute("DELETE FROM removed")
+            expired = self.conn.execute('''INSERT INTO removed
+                    SELECT hash FROM %s WHERE expires<?''' % TRIPLETABLENAME,
+                    (datetime.datetime.now().isoformat(),)).rowcount
+            if expired:
+                models = [m for m, in self.conn.execute('''SELECT DISTINCT model FROM %s
+                        WHERE hash IN (SELECT hash FROM removed)''' % TRIPLETABLENAME)]
+                self.remove_staged(models)
+
+        return expired
+
+    def update(self, stmts, models = [DEFAULT_MODEL], lifespan = 0):
+        """ Adds the statements to each of the models, replacing the previous
+        values of functional properties. All the models are updated in one
+        transaction.
+        """
+        models = modellist(models)
+
+        functional = [(sqlhash(s,p,o, model), s, p, model) for model in models for s,p,o in stmts if p in self._functionalproperties]
+
+        with self.transaction():
+            if functional:
+                logger.debug("Updating functional values: %s" % functional)
+
+                self.conn.execute("DELETE FROM staged")
+                self.conn.executemany("INSERT OR IGNORE INTO staged VALUES (?, ?, ?, ?)", functional)
+
+                # the previous values of the functional properties are
+                # removed in one pass. Values that do not change are kept
+                # (only their timestamp and lifespan are updated below)
+                self.conn.execute("DELETE FROM removed")
+                self.conn.execute('''INSERT INTO removed
+                        SELECT t.hash FROM %s AS t JOIN staged AS k
+                        ON (t.subject=k.subject AND t.predicate=k.predicate AND t.model=k.model)
+                        WHERE t.hash NOT IN (SELECT hash FROM staged)''' % TRIPLETABLENAME)
+                self.remove_staged(models)
+
+            self.insert(stmts, models, lifespan)
+
+            if functional:
+                timestamp, expires = self.timestamps(lifespan)
+                self.conn.execute('''UPDATE %s SET timestamp=?, expires=?
+                        WHERE hash IN (SELECT hash FROM staged)''' % TRIPLETABLENAME, (timestamp, expires))
+
+        self.onupdate()
+
+    @contextmanager
+    def transaction(self):
+        """ Context of a write transaction: committed on exit, or rolled back
+        if an exception is raised. Within a group commit, the writes join
+        the group transaction instead.
+        """
+        if self.grouped:
+            yield
+        else:
+            with self.conn:
+                yield
+
+    def begin_group(self):
+        """ Starts a group commit: the following writes (add, delete, update)
+        are all performed in a single transaction, until 'commit_group' (or
+        'rollback_group') is called.
+        """
+        self.grouped = True
+
+    def commit_group(self):
+        self.grouped = False
+        self.conn.commit()
+        self.onupdate()
+
+    def rollback_group(self):
+        self.grouped = False
+        self.conn.rollback()
+        # the caches may reflect changes that have been rolled back
+        self._sizes = None
+        self.load_axioms()
+        self.onupdate()
+
+    def timestamps(self, lifespan):
         timestamp = datetime.datetime.now()
         expires = None
         if lifespan > 0:
             expires = (timestamp + datetime.timedelta(seconds = lifespan)).isoformat()
 
-        timestamp = timestamp.isoformat()
+        return timestamp.isoformat(), expires
 
-        if replace:
-            with self.conn:
-                self.conn.executemany("DELETE FROM %s WHERE subject=? AND predicate=? AND model=?" % TRIPLETABLENAME, [(s,p, model) for s,p,o in stmts])
+    def insert(self, stmts, models, lifespan):
+        """ Inserts the statements in each of the models. Must be called from
+        within a transaction.
+        """
+        timestamp, expires = self.timestamps(lifespan)
 
-        if expires:
-            stmts = [[sqlhash(s,p,o, model), s, p, o, model, timestamp, expires] for s,p,o in stmts]
-        else:
-            stmts = [[sqlhash(s,p,o, model), s, p, o, model, timestamp] for s,p,o in stmts]
-        with self.conn:
-            if expires:
-                self.conn.executemany('''INSERT OR IGNORE INTO %s
-                        (hash, subject, predicate, object, model, timestamp, expires)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)''' % TRIPLETABLENAME, stmts)
+        models = modellist(models)
+
+        rows = []
+        for s,p,o in stmts:
+            literal = typed(o)
+            rows += [(sqlhash(s,p,o, model), s, p, o, model, timestamp, expires) + literal for model in models]
+
+        self.conn.executemany('''INSERT OR IGNORE INTO %s
+                (hash, subject, predicate, object, model, timestamp, expires, lexical, datatype, lang, numeric)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''' % TRIPLETABLENAME, rows)
+
+        self.enforce_capacities(models)
+
+    def set_capacity(self, models, capacity, eviction = EVICTION_OLDEST, priorities = None):
+        """ Bounds the number of statements asserted in each of the models
+        (inferred statements are not counted). If 'capacity' is None or 0,
+        the models are not bounded anymore.
+
+        'eviction' is one of EVICTION_POLICIES. With EVICTION_PRIORITY,
+        'priorities' is a dictionary {predicate: priority} (0 for the other
+        predicates): the statements with the lowest priority are evicted
+        first. With EVICTION_LRU, the resources are accessed through 'query',
+        'has' and 'about', and the statements are evicted according to the
+        last access to their subject.
+        """
+        for model in models:
+            if capacity:
+                self._capacities[model] = (capacity, eviction, priorities or {})
             else:
-                self.conn.executemany('''INSERT OR IGNORE INTO %s
-                        (hash, subject, predicate, object, model, timestamp)
-                        VALUES (?, ?, ?, ?, ?, ?)''' % TRIPLETABLENAME, stmts)
+                self._capacities.pop(model, None)
+        self._sizes = None
+
+        with self.transaction():
+            self.enforce_capacities(models)
 
         self.onupdate()
 
-    def delete(self, stmts, model = DEFAULT_MODEL):
+    def enforce_capacities(self, models):
+        """ Evicts statements from the models that exceed their capacity.
+        Must be called from within a transaction.
+        """
+        bounded = [m for m in models if m in self._capacities]
+        if not bounded:
+            return
 
-        hashes = [[sqlhash(s,p,o, model)] for s,p,o in stmts]
+        self.update_sizes()
 
-        with self.conn:
-            # removal is non-monotonic. Remove all inferred statements
-            self.conn.execute("DELETE FROM %s WHERE inferred=1" % TRIPLETABLENAME)
+        for model in bounded:
+            capacity, eviction, priorities = self._capacities[model]
+            size = self._sizes.get(model, 0)
+            if size > capacity:
+                self.evict(model, size - int(capacity * (1 - EVICTION_MARGIN)), eviction, priorities)
 
-            self.conn.executemany('''DELETE FROM %s 
-                        WHERE (hash=?)''' % TRIPLETABLENAME, hashes)
+        self.update_sizes()
 
-        self.onupdate()
+    def update_sizes(self):
+        """ Updates the number of asserted statements of the bounded models
+        from the change log. They are counted again if some changes are
+        missing from the log.
+        """
+        head = self.head()
+        if self._sizes is not None and head == self._sizeseq:
+            return
 
-    def update(self, stmts, model = DEFAULT_MODEL, lifespan = 0):
+        bounded = list(self._capacities)
+        inmodels = ", ".join("?" * len(bounded))
 
-        stmts_to_add = []
-        stmts_to_replace = []
-        for stmt in stmts:
-            s,p,o = stmt
-            if p in self._functionalproperties:
-                stmts_to_replace.append(stmt)
-            else:
-                stmts_to_add.append(stmt)
+        if self._sizes is not None:
+            first, cleared = self.conn.execute('''SELECT MIN(seq), SUM(op='clear') FROM %s
+                                                 WHERE seq>?''' % CHANGELOGTABLENAME,
+                                              (self._sizeseq,)).fetchone()
+            if cleared or first is None or first > self._sizeseq + 1:
+                self._sizes = None
+
+        if self._sizes is None:
+            self._sizes = dict(self.conn.execute('''SELECT model, COUNT(*) FROM %s
+                                                  WHERE inferred=0 AND model IN (%s)
+                                                  GROUP BY model''' % (TRIPLETABLENAME, inmodels),
+                                               bounded).fetchall())
+        else:
+            for model, delta in self.conn.execute('''SELECT model, SUM(CASE WHEN op='add' THEN 1 ELSE -1 END)
+                                                     FROM %s WHERE seq>? AND inferred=0 AND model IN (%s)
+                                                     GROUP BY model''' % (CHANGELOGTABLENAME, inmodels),
+                                                  [self._sizeseq] + bounded):
+                self._sizes[model] = self._sizes.get(model, 0) + delta
+
+        self._sizeseq = head
+
+    def evict(self, model, count, eviction, priorities):
+        """ Removes 'count' asserted statements from the model, according to
+        the eviction policy (see 'set_capacity'), as well as the inferences
+        that depend on them. Must be called from within a transaction.
+        """
+        params = []
+        if eviction == EVICTION_LRU:
+            self.conn.executemany("INSERT OR REPLACE INTO accessed VALUES (?, ?)", self._accessed.items())
+            self._accessed = {}
+            order = "IFNULL((SELECT time FROM accessed WHERE resource=t.subject), 0), t.timestamp"
+        elif eviction == EVICTION_PRIORITY and priorities:
+            order = "CASE t.predicate %s ELSE 0 END, t.timestamp" % " ".join("WHEN ? THEN ?" for p in priorities)
+            for predicate, priority in priorities.items():
+                params += [predicate, priority]
+        else:
+            order = "t.timestamp"
+
+        self.conn.execute("DELETE FROM removed")
+        self.conn.execute('''INSERT INTO removed
+                SELECT hash FROM %s AS t WHERE model=? AND inferred=0
+                ORDER BY %s LIMIT ?''' % (TRIPLETABLENAME, order),
+                [model] + params + [count])
 
-        if stmts_to_add:
-            self.add(stmts_to_add, model, lifespan)
-        if stmts_to_replace:
-            logger.debug("Updating functional values: %s" % stmts_to_replace)
-            self.add(stmts_to_replace, model, lifespan, replace=True)
+        logger.info("Evicting %s statements from <%s> (%s)" % (count, model, eviction))
+        self.remove_staged([model])
 
-    def about(self, resource, models):
+        if eviction == EVICTION_LRU:
+            self.conn.execute("DELETE FROM accessed WHERE resource NOT IN (SELECT subject FROM %s)" % TRIPLETABLENAME)
+
+    def touch(self, resources):
+        """ Records an access to the resources, if some models are bounded
+        with the LRU eviction policy.
+        """
+        if not any(eviction == EVICTION_LRU for capacity, eviction, priorities in self._capacities.values()):
+            return
+
+        now = time.time()
+        for resource in resources:
+            self._accessed[resource] = now
+
+    def remove_staged(self, models):
+        """ Deletes the statements whose hashes are staged in the 'removed'
+        temporary table, as well as the inferred statements that may depend
+        on them. Must be called from within a transaction.
+
+        Removal is non-monotonic: the inferences about the subjects of the
+        removed statements (and about the objects, except for taxonomic
+        relations), and about everything that inherits from them through the
+        taxonomy are removed as well. The reasoner re-creates the ones that
+        still hold.
+
+        Removing a schema axiom (domain, range, sub-property, inverse,
+        property characteristic) or a statement about a transitive property
+        removes all the inferred statements of the model.
+        """
+        params = {}
+        for i, model in enumerate(models):
+            params["m%s" % i] = model
+        inmodels = ",".join(":m%s" % i for i in range(len(models)))
 
-        params = {'res':resource}
+        transitive = self.propertiesof("owl:TransitiveProperty")
+        schema = self.conn.execute('''SELECT DISTINCT model FROM %s
+                WHERE hash IN (SELECT hash FROM removed) AND
+                      (predicate IN (%s) OR
+                       (predicate='rdf:type' AND object IN (%s)) OR
+                       predicate IN (%s))''' % \
+                    (TRIPLETABLENAME,
+                     ", ".join("'%s'" % p for p in SCHEMA_PREDICATES),
+                     ", ".join("'%s'" % c for c in PROPERTY_CHARACTERISTICS),
+                     ", ".join("?" * len(transitive))),
+                list(transitive)).fetchall()
+        if schema:
+            logger.debug("Schema axioms removed: invalidating all the inferences in %s" % [m for m, in schema])
+            self.conn.execute("DELETE FROM %s WHERE inferred=1 AND model IN (%s)" % \
+                                    (TRIPLETABLENAME, ", ".join("?" * len(schema))),
+                              [m for m, in schema])
+
+        # (the query starts with DELETE: with Python 2 sqlite3, a statement
+        # starting with WITH would implicitly commit the current transaction)
+        self.conn.execute('''DELETE FROM %(table)s
+                WHERE inferred=1 AND model IN (%(models)s) AND subject IN (
+                    WITH RECURSIVE dependents(resource) AS (
+                        SELECT subject FROM %(table)s
+                        WHERE hash IN (SELECT hash FROM removed)
+                      UNION
+                        SELECT object FROM %(table)s
+                        WHERE hash IN (SELECT hash FROM removed) AND predicate NOT IN (%(taxonomy)s)
+                      UNION
+                        SELECT CASE WHEN t.object=d.resource THEN t.subject ELSE t.object END
+                        FROM %(table)s AS t, dependents AS d
+                        WHERE t.model IN (%(models)s) AND
+                              ((t.object=d.resource AND t.predicate IN (%(taxonomy)s, 'owl:equivalentClass')) OR
+                               (t.subject=d.resource AND t.predicate='owl:equivalentClass')))
+                    SELECT resource FROM dependents)''' % \
+                        {"table": TRIPLETABLENAME,
+                         "models": inmodels,
+                         "taxonomy": ", ".join("'%s'" % p for p in TAXONOMY_PREDICATES)},
+                params)
+
+        self.conn.execute("DELETE FROM %s WHERE hash IN (SELECT hash FROM removed)" % TRIPLETABLENAME)
+
+    def about(self, resource, models, limit = None):
+        """ Returns the statements where the resource appears as subject,
+        predicate or object (or as a string literal object).
+
+        Each role is retrieved with its own index seek. 'limit' optionally
+        limits the number of statements returned for each role: either an
+        integer (same limit for the three roles) or a dictionary {'subject':
+        n, 'predicate': n, 'object': n} (missing roles are not limited).
+        """
+
+        if not isinstance(limit, dict):
+            limit = {"subject": limit, "predicate": limit, "object": limit}
+
+        params = {'res':resource,
+                  'literal': '"%s"' % resource,
+                  'ls': limit.get("subject") or -1,
+                  'lp': limit.get("predicate") or -1,
+                  'lo': limit.get("object") or -1}
 
         # workaround to feed a variable number of models
         models = list(models)
         for i in range(len(models)):
             params["m%s"%i] = models[i]
+        inmodels = "AND model IN (%s)" % ",".join([":m%s" % i for i in range(len(models))]) if models else ""
 
+        # statements matching several roles are only returned once
         query = '''
-                SELECT subject, predicate, object 
-                FROM %s
-                WHERE (subject=:res OR predicate=:res OR object IN ('"%s"',:res)
-                AND model IN (%s))''' % (TRIPLETABLENAME, resource, ",".join([":m%s" % i for i in range(len(models))]))
-        with self.conn:
-            res = self.conn.execute(query, params)
-            return [[row[0], row[1], row[2]] for row in res]
+                SELECT * FROM (SELECT subject, predicate, object FROM %(table)s
+                               WHERE subject=:res %(models)s LIMIT :ls)
+                UNION ALL
+                SELECT * FROM (SELECT subject, predicate, object FROM %(table)s
+                               WHERE predicate=:res AND subject!=:res %(models)s LIMIT :lp)
+                UNION ALL
+                SELECT * FROM (SELECT subject, predicate, object FROM %(table)s
+                               WHERE object IN (:literal, :res) AND subject!=:res AND predicate!=:res %(models)s
+                               LIMIT :lo)''' % {"table": TRIPLETABLENAME, "models": inmodels}
+
+        self.touch([resource])
+
+        return [[row[0], row[1], row[2]] for row in self.conn.execute(query, params)]
+
+    def search_labels(self, text, models, fuzzy = False, limit = None):
+        """ Returns the resources whose label matches 'text', best matches
+        first.
+
+        If 'fuzzy' is False, the label must be equal to the text (case
+        insensitive). Otherwise, labels are ranked by their similarity with
+        the text (shared trigrams if the FTS5 trigram tokenizer is available,
+        shared words otherwise).
+        """
+        text = text.strip()
+        models = list(models)
+        params = {"text": text, "limit": limit or -1}
+        for i in range(len(models)):
+            params["m%s"%i] = models[i]
+        inmodels = "model IN (%s)" % ",".join([":m%s" % i for i in range(len(models))]) if models else "1"
+
+        if not text:
+            return []
+
+        if not fuzzy:
+            query = '''SELECT DISTINCT subject FROM %s
+                       WHERE predicate='rdfs:label' AND lexical=:text COLLATE NOCASE AND %s
+                       LIMIT :limit''' % (TRIPLETABLENAME, inmodels)
+            return [row[0] for row in self.conn.execute(query, params)]
+
+        if not self._labelindex:
+            words = text.lower().split()
+            for i, w in enumerate(words):
+                params["w%s" % i] = w
+            score = " + ".join("(instr(lower(label), :w%s) > 0)" % i for i in range(len(words)))
+            query = '''SELECT subject, MAX(%s) AS score FROM
+                         (SELECT subject, IFNULL(lexical, object) AS label FROM %s
+                          WHERE predicate='rdfs:label' AND %s)
+                       GROUP BY subject HAVING score > 0
+                       ORDER BY score DESC LIMIT :limit''' % (score, TRIPLETABLENAME, inmodels)
+            return [row[0] for row in self.conn.execute(query, params)]
+
+        # FTS5 phrases: quoted, with quotes doubled
+        if self._labelindex == "trigram":
+            trigrams = [text.lower()[i:i+3] for i in range(len(text) - 2)]
+            terms = ['"%s"' % t.replace('"', '""') for t in trigrams if t.strip()]
+        else:
+            terms = ['"%s"*' % w.replace('"', '""') for w in text.split()]
+
+        if not terms:
+            # too short for the trigram index: scan the labels
+            params["like"] = "%" + text + "%"
+            query = '''SELECT resource, MIN(length(label)) AS score FROM %s
+                       WHERE lower(label) LIKE lower(:like) AND %s
+                       GROUP BY resource ORDER BY score LIMIT :limit''' % (LABELTABLENAME, inmodels)
+            return [row[0] for row in self.conn.execute(query, params)]
+
+        if limit:
+            matches = self.closest_labels(text, inmodels, dict(params), limit)
+            if matches:
+                return matches[:limit]
+
+        # without limit, or if no label contains any word of the text (eg,
+        # misspelled): all the labels sharing terms with the text are ranked.
+        # 'ORDER BY rank' is directly handled by the FTS5 module. A resource
+        # may appear once per model: results are de-duplicated afterwards.
+        params["match"] = " OR ".join(sorted(set(terms)))
+        params["limit"] = limit * max(1, len(models)) if limit else -1
+        query = '''SELECT resource FROM %s
+                   WHERE label MATCH :match AND %s
+                   ORDER BY rank LIMIT :limit''' % (LABELTABLENAME, inmodels)
+
+        matches = []
+        for row in self.conn.execute(query, params):
+            if row[0] not in matches:
+                matches.append(row[0])
+        return matches[:limit] if limit else matches
+
+    def closest_labels(self, text, inmodels, params, limit):
+        """ Returns the resources whose label is a part of the text ('the
+        red cup' finds 'red cup'), longest first, followed by the resources
+        whose label contains the most words of the text, shortest first.
+
+        At most LABEL_CANDIDATES labels are ranked, the best ones according
+        to FTS5: the cost of the lookup barely depends on the number of
+        labels containing common words.
+        """
+        words = text.lower().split()
+
+        phrases = {" ".join(words[i:j]) for i in range(len(words)) for j in range(i + 1, len(words) + 1)}
+        for i, phrase in enumerate(phrases):
+            params["p%s" % i] = phrase
+        # (one lookup of label_idx per phrase: SQLite does not use the
+        # index for 'lexical IN (...) COLLATE NOCASE')
+        lookups = " UNION ALL ".join('''SELECT subject, length(lexical) AS length FROM %s
+                                        WHERE predicate='rdfs:label' AND lexical=:p%s COLLATE NOCASE AND %s''' % \
+                                        (TRIPLETABLENAME, i, inmodels)
+                                     for i in range(len(phrases)))
+        query = '''SELECT subject, MAX(length) AS length FROM (%s)
+                   GROUP BY subject ORDER BY length DESC LIMIT :limit''' % lookups
+        matches = [row[0] for row in self.conn.execute(query, params)]
+        if len(matches) >= limit:
+            return matches
+
+        # the candidate labels are found with the first LABEL_PREFIX
+        # characters of the words (queries on many trigrams are slower), and
+        # ranked by the number of words they contain
+        words = sorted({w for w in words if self._labelindex != "trigram" or len(w) >= 3}, key = len, reverse = True)[:LABEL_WORDS]
+        prefixes = sorted({w[:LABEL_PREFIX].replace('"', '""') for w in words})
+        if self._labelindex == "trigram":
+            terms = ['"%s"' % p for p in prefixes]
+        else:
+            terms = ['"%s"*' % p for p in prefixes]
+        if not terms:
+            return matches
+
+        # the labels matching all the words, then (if needed) the labels
+        # matching some of them
+        scores = {}
+        for operator in ["AND", "OR"][:2 if len(terms) > 1 else 1]:
+            params["match"] = (" %s " % operator).join(terms)
+            params["limit"] = LABEL_CANDIDATES
+            for resource, label in self.conn.execute('''SELECT resource, label FROM %s
+                                                        WHERE label MATCH :match AND %s
+                                                        ORDER BY rank LIMIT :limit''' % (LABELTABLENAME, inmodels),
+                                                     params):
+                label = label.lower()
+                score = (-sum(1 for w in words if w in label), len(label))
+                if score[0]:
+                    scores[resource] = min(score, scores.get(resource, score))
+
+            if len(scores) + len(matches) >= limit:
+                break
+
+        for resource in sorted(scores, key = lambda r: scores[r]):
+            if resource not in matches:
+                matches.append(resource)
+        return matches
 
     def has(self, stmts, models):
 
+        self.touch(tok for stmt in stmts for tok in stmt if not tok.startswith("?"))
+
+        if self._canonical or self.backward:
+            vars = {tok for stmt in stmts for tok in stmt if tok.startswith("?")}
+            return len(self.query(vars, stmts, models)) > 0
+
         candidates = set()
         for s in stmts:
             if not candidates:
@@ -131,8 +915,131 @@ class SQLStore:
         return len(candidates) > 0
 
 
-    def query(self, vars, patterns, models):
-        return query(self.conn, vars, patterns, models)
+    def query(self, vars, patterns, models, constraints = None, profile = False):
+        """ If 'profile' is True, returns a tuple (results, trace), 'trace'
+        being a dictionary {'statements': [{'stage', 'sql', 'params', 'plan',
+        'rows', 'time'}, ...], 'candidates': {var: size}, 'time': total
+        time} (see 'sqlite_queries.QueryProfile').
+        """
+        db = QueryProfile(self.conn) if profile else self.conn
+
+        starttime = time.time()
+        res = query(db, vars, patterns, models, constraints,
+                    self.equivalents if self._canonical else None,
+                    self.backward)
+
+        if profile:
+            trace = db.trace()
+            trace["time"] = time.time() - starttime
+
+        self.touch(tok for pattern in patterns for tok in pattern if not tok.startswith("?"))
+        self.touch(value for row in res for value in (row.values() if isinstance(row, dict) else [row]))
+
+        if profile:
+            return res, trace
+        return res
+
+    def returns_statements(self, vars, patterns, constraints = None):
+        """ Returns True if 'query' returns the statements matching the
+        (single) pattern, instead of the values of the variables.
+        """
+        if len(patterns) != 1:
+            return False
+        if compiled(vars, patterns, constraints, self._canonical, self.backward):
+            return len(vars) != 1
+        return nb_variables(patterns[0]) != 1 # see 'singlepattern'
+
+    def bindings(self, vars, patterns, models, constraints = None, delta = None):
+        """ Returns the bindings of the variables 'vars' matching the
+        patterns, as a set of tuples of values (in the order of 'vars').
+
+        With 'delta' (the index of a pattern), only the bindings where this
+        pattern matches one of the statements staged by 'stage_delta' are
+        returned.
+        """
+        res = joinquery(self.conn, vars, patterns, models, constraints,
+                        self.equivalents if self._canonical else None,
+                        self.backward, delta)
+
+        if len(vars) == 1:
+            return {(value,) for value in res}
+        if len(patterns) == 1: # statements
+            return {tuple(stmt[list(patterns[0]).index(v)] for v in vars) for stmt in res}
+        return {tuple(row[v[1:]] for v in vars) for row in res}
+
+    def stage_delta(self, stmts):
+        """ Stages the given statements ((s, p, o, model) tuples) that are
+        still in the KB in the 'delta' table, for 'bindings'.
+
+        (the statements are looked up by subject: many statements may share
+        the same object)
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM delta")
+            self.conn.executemany('''INSERT INTO delta
+                                      SELECT subject, predicate, object, model, lexical, datatype, lang, numeric
+                                      FROM %s WHERE subject=? AND predicate=? AND +object=? AND model=?''' % TRIPLETABLENAME,
+                                  stmts)
+
+    def holds(self, stmts, models):
+        """ Returns True if each of the statements (without variables) is in
+        one of the models, or can be inferred at query time (equivalent
+        resources, backward reasoning).
+        """
+        if self._canonical or (self.backward and any(s[1] in CLOSURES for s in stmts)):
+            return len(joinquery(self.conn, [], stmts, models, None,
+                                 self.equivalents if self._canonical else None,
+                                 self.backward)) > 0
+
+        return all(simplequery(self.conn, s, models) for s in stmts)
+
+    def canonical(self, resource):
+        """ Returns the canonical representative of the resources equivalent
+        to the given one (owl:sameAs).
+        """
+        return self._canonical.get(resource, resource)
+
+    def equivalents(self, resource):
+        """ Returns the resources equivalent to the given one (owl:sameAs),
+        itself included.
+        """
+        return self._equivalents.get(self._canonical.get(resource, resource), [resource])
+
+    def labels(self, concepts, models = []):
+        """ Returns a dictionary {concept: label} for a set of concepts,
+        retrieved with one query (per batch of MAX_PARAMS concepts). Concepts
+        without label are labelled with their ID.
+        """
+        labels = {}
+        for batch, params in batches(concepts, models):
+            query = '''SELECT subject, object FROM %s
+                       WHERE predicate='rdfs:label' AND subject IN (%s)''' % (TRIPLETABLENAME, batch)
+            if models:
+                query += " AND model IN (%s)" % ",".join("?" * len(models))
+            for concept, label in self.conn.execute(query, params):
+                labels.setdefault(concept, label)
+
+        return {c: labels.get(c, c) for c in concepts}
+
+    def related(self, concepts, predicate, models = [], inverse = False, assertedonly = False):
+        """ Returns a dictionary {concept: [values]} of the objects (or
+        subjects if 'inverse' is True) of the statements <concept predicate
+        ?value> (resp. <?value predicate concept>), for a set of concepts.
+        """
+        selected, bound = ("subject", "object") if inverse else ("object", "subject")
+
+        related = {c: [] for c in concepts}
+        for batch, params in batches(concepts, models):
+            query = '''SELECT DISTINCT %s, %s FROM %s
+                       WHERE predicate=? AND %s IN (%s)''' % (bound, selected, TRIPLETABLENAME, bound, batch)
+            if models:
+                query += " AND model IN (%s)" % ",".join("?" * len(models))
+            if assertedonly:
+                query += " AND inferred=0"
+            for concept, value in self.conn.execute(query, [predicate] + params):
+                related[concept].append(value)
+
+        return related
 
     @memoize
     def label(self, concept, models = []):
@@ -142,46 +1049,52 @@ class SQLStore:
         else:
             return concept
 
-    @memoize
     def typeof(self, concept, models):
-        classes = self.classesof(concept, False, models)
-        if classes:
-            if "owl:ObjectProperty" in classes:
-                return "object_property"
-            elif "owl:DatatypeProperty" in classes:
-                return "datatype_property"
-            elif "owl:Class" in classes:
-                return "class"
-            elif self.is_literal(concept):
-                return "literal"
-            else:
-                return "instance"
-        if self.instancesof(concept, False, models) or \
-           self.subclassesof(concept, False, models) or \
-           self.superclassesof(concept, False, models):
-               return "class"
-        
-        stmts_if_predicate = matchingstmt(self.conn, ("?s", concept, "?o"), models)
-        if stmts_if_predicate:
-            if self.is_literal(stmts_if_predicate[0][3]):
-                return "datatype_property"
-            else:
-                return "object_property"
+        """ Returns the kind of a concept (class, instance, object_property,
+        datatype_property, literal or undefined), from the kinds index.
+        """
+        return self.typesof([concept], models)[concept]
+
+    def typesof(self, concepts, models):
+        """ Returns a dictionary {concept: kind} for a set of concepts (see
+        'typeof').
+        """
+        kinds = {}
+        for batch, params in batches(concepts, models):
+            query = '''SELECT resource, MIN(kind) FROM %s
+                       WHERE resource IN (%s)''' % (KINDSTABLENAME, batch)
+            if models:
+                query += " AND model IN (%s)" % ",".join("?" * len(models))
+            query += " GROUP BY resource"
+            kinds.update(self.conn.execute(query, params))
 
-        logger.warn("Concept <%s> has undefined type." % concept)
-        return "undefined"
+        types = {}
+        for concept in concepts:
+            kind = kinds.get(concept)
+            if kind is None:
+                logger.warn("Concept <%s> has undefined type." % concept)
+                types[concept] = "undefined"
+            elif kind == 4 and self.is_literal(concept):
+                types[concept] = "literal"
+            else:
+                types[concept] = KINDS[kind]
 
+        return types
 
     def classesof(self, concept, direct, models = []):
         if direct:
             logger.warn("Direct classes are assumed to be the asserted is-a relations")
             return list(simplequery(self.conn, (concept, "rdf:type", "?class"), models, assertedonly = True))
+        if self.backward:
+            return self.query(["?class"], [(concept, "rdf:type", "?class")], models)
         return list(simplequery(self.conn, (concept, "rdf:type", "?class"), models))
 
     def instancesof(self, concept, direct, models = []):
         if direct:
             logger.warn("Direct instances are assumed to be the asserted is-a relations")
             return list(simplequery(self.conn, ("?instances", "rdf:type", concept), models, assertedonly = True))
+        if self.backward:
+            return self.query(["?instances"], [("?instances", "rdf:type", concept)], models)
         return list(simplequery(self.conn, ("?instances", "rdf:type", concept), models))
 
 
@@ -189,19 +1102,238 @@ class SQLStore:
         if direct:
             logger.warn("Direct super-classes are assumed to be the asserted subClassOf relations")
             return list(simplequery(self.conn, (concept, "rdfs:subClassOf", "?superclass"), models, assertedonly = True))
+        if self.backward:
+            return self.query(["?superclass"], [(concept, "rdfs:subClassOf", "?superclass")], models)
         return list(simplequery(self.conn, (concept, "rdfs:subClassOf", "?superclass"), models))
 
     def subclassesof(self, concept, direct, models = []):
         if direct:
             logger.warn("Direct sub-classes are assumed to be the asserted subClassOf relations")
             return list(simplequery(self.conn, ("?subclass", "rdfs:subClassOf", concept), models, assertedonly = True))
+        if self.backward:
+            return self.query(["?subclass"], [("?subclass", "rdfs:subClassOf", concept)], models)
         return list(simplequery(self.conn, ("?subclass", "rdfs:subClassOf", concept), models))
 
 
+    def head(self):
+        """ Returns the sequence number of the last change recorded in the
+        change log (0 if the log is empty).
+        """
+        return self.conn.execute("SELECT IFNULL(MAX(seq), 0) FROM %s" % CHANGELOGTABLENAME).fetchone()[0]
+
+    def changes_since(self, seq, limit = None):
+        """ Returns the changes recorded after the change 'seq', as a
+        dictionary:
+        - 'seq': sequence number of the last returned change (or 'seq' if
+          there are no new changes),
+        - 'resync': True if some of the requested changes have already been
+          discarded from the log. The client must then reload the whole KB.
+        - 'changes': list of [seq, op, subject, predicate, object, model,
+          inferred] with op in ['add', 'retract', 'expire', 'clear'].
+        """
+        oldest = self.conn.execute("SELECT MIN(seq) FROM %s" % CHANGELOGTABLENAME).fetchone()[0]
+        resync = oldest is not None and seq < oldest - 1
+
+        query = '''SELECT seq, op, subject, predicate, object, model, inferred
+                   FROM %s WHERE seq>? ORDER BY seq''' % CHANGELOGTABLENAME
+        params = [seq]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        changes = [list(row) for row in self.conn.execute(query, params)]
+        return {"seq": changes[-1][0] if changes else seq,
+                "resync": resync,
+                "changes": changes}
+
+    def snapshot(self):
+        """ Returns the whole content of the KB, as a dictionary {'seq': seq,
+        'triples': [[s, p, o, model, inferred], ...]}.
+
+        The changes recorded after 'seq' may or may not be already
+        reflected in the triples: replaying them with 'apply_changes'
+        leads in any case to the current state of the KB.
+        """
+        seq = self.head()
+        triples = [list(row) for row in self.conn.execute(
+                "SELECT subject, predicate, object, model, inferred FROM %s" % TRIPLETABLENAME)]
+        return {"seq": seq, "triples": triples}
+
+    def rule_stats(self):
+        """ Returns the statistics of the reasoner's rules, as a list of
+        (rule, firings, time, runs).
+        """
+        return self.conn.execute('''SELECT rule, firings, time, runs FROM %s
+                                     ORDER BY time DESC''' % RULESTATSTABLENAME).fetchall()
+
+    def apply_changes(self, changes):
+        """ Applies a list of changes, as returned by 'changes_since' (ie
+        [seq, op, s, p, o, model, inferred]). Changes are idempotent, and
+        are applied in one single transaction.
+        """
+        with self.conn:
+            for seq, op, s, p, o, model, inferred in changes:
+                if op == "add":
+                    self.conn.execute('''INSERT OR IGNORE INTO %s
+                            (hash, subject, predicate, object, model, inferred, lexical, datatype, lang, numeric)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''' % TRIPLETABLENAME,
+                            (sqlhash(s, p, o, model), s, p, o, model, inferred) + typed(o))
+                elif op in ["retract", "expire"]:
+                    self.conn.execute("DELETE FROM %s WHERE hash=?" % TRIPLETABLENAME,
+                                      (sqlhash(s, p, o, model),))
+                elif op == "clear":
+                    self.conn.execute("DELETE FROM %s" % TRIPLETABLENAME)
+                else:
+                    logger.warn("Unknown change <%s> in the change log. Skipping it." % op)
+
+        self.onupdate()
+
     ###################################################################################
 
+    def axiomfilter(self, table):
+        return "%(t)s.predicate IN ('owl:inverseOf', 'owl:sameAs') OR (%(t)s.predicate='rdf:type' AND %(t)s.object IN (%(c)s))" % \
+                    {"t": table, "c": ", ".join("'%s'" % c for c in PROPERTY_CHARACTERISTICS)}
+
+    def load_axioms(self):
+        """ (Re-)loads the cache of property axioms from the triples.
+        """
+        self._axiomseq = self.head()
+        self._axioms = {}
+        for s, p, o, count in self.conn.execute('''SELECT subject, predicate, object, COUNT(*)
+                                                    FROM %s WHERE %s
+                                                    GROUP BY subject, predicate, object''' % \
+                                                        (TRIPLETABLENAME, self.axiomfilter(TRIPLETABLENAME))):
+            self._axioms[(s, p, o)] = count
+        self.axioms_changed(reload = True)
+
+    def refresh_axioms(self):
+        """ Applies to the cache of property axioms the changes recorded in
+        the change log since the last refresh (by any process). Only the new
+        changes are read.
+        """
+        # (two subqueries: SQLite only reads MIN or MAX from the index when it
+        # is the only aggregate of the query)
+        first, head = self.conn.execute("SELECT (SELECT MIN(seq) FROM %s), (SELECT MAX(seq) FROM %s)" % \
+                                            (CHANGELOGTABLENAME, CHANGELOGTABLENAME)).fetchone()
+        if head is None or head <= self._axiomseq:
+            return
+        if first > self._axiomseq + 1:
+            # some changes have been trimmed from the change log before we could read them
+            self.load_axioms()
+            return
+
+        changed = False
+        for op, s, p, o in self.conn.execute('''SELECT op, subject, predicate, object
+                                               FROM %s WHERE seq>? AND seq<=? AND (op='clear' OR %s)
+                                               ORDER BY seq''' % \
+                                                   (CHANGELOGTABLENAME, self.axiomfilter(CHANGELOGTABLENAME)),
+                                            (self._axiomseq, head)):
+            changed = True
+            if op == "clear":
+                self._axioms = {}
+            elif op == "add":
+                self._axioms[(s, p, o)] = self._axioms.get((s, p, o), 0) + 1
+            elif self._axioms.get((s, p, o), 0) > 1:
+                self._axioms[(s, p, o)] -= 1
+            else:
+                self._axioms.pop((s, p, o), None)
+
+        self._axiomseq = head
+        if changed:
+            self.axioms_changed()
+
+    def axioms_changed(self, reload = False):
+        self._functionalproperties = self.propertiesof("owl:FunctionalProperty")
+
+        self._inverses = {}
+        for s, p, o in self._axioms:
+            if p == "owl:inverseOf":
+                self._inverses.setdefault(s, set()).add(o)
+                self._inverses.setdefault(o, set()).add(s)
+
+        self.sameas_changed(reload)
+
+    def sameas_changed(self, reload = False):
+        """ Updates the union-find structure of the owl:sameAs equivalences,
+        and its mirror in the 'sameas' table. Only the sets of equivalent
+        resources touched by the added or removed pairs are updated: new
+        pairs are merged, and the sets a removed pair belonged to are split
+        again from their remaining pairs.
+        """
+        pairs = {(s, o) for s, p, o in self._axioms if p == "owl:sameAs"}
+
+        if reload:
+            self._sameas = SameAs(pairs)
+            self._sameaspairs = pairs
+            self._canonical = self._sameas.canonical()
+            self._equivalents = {}
+            for r, c in self._canonical.items():
+                self._equivalents.setdefault(c, []).append(r)
+
+            with self.transaction():
+                self.conn.execute("DELETE FROM sameas")
+                self.conn.executemany("INSERT INTO sameas (resource, canonical) VALUES (?, ?)",
+                                      self._canonical.items())
+            return
+
+        added = pairs - self._sameaspairs
+        removed = self._sameaspairs - pairs
+        if not added and not removed:
+            return
+        self._sameaspairs = pairs
+
+        # the whole sets the changed pairs belong to
+        affected = set()
+        for a, b in added | removed:
+            affected.update(self.equivalents(a))
+            affected.update(self.equivalents(b))
+
+        if removed:
+            self._sameas.split(affected, [(a, b) for a, b in pairs if a in affected])
+        else:
+            for a, b in added:
+                self._sameas.union(a, b)
+
+        canonical = self._sameas.canonical(affected)
+        previous = {r: self._canonical[r] for r in affected if r in self._canonical}
+
+        with self.transaction():
+            self.conn.executemany("DELETE FROM sameas WHERE resource=?",
+                                  [(r,) for r in previous if r not in canonical])
+            self.conn.executemany("INSERT OR REPLACE INTO sameas (resource, canonical) VALUES (?, ?)",
+                                  [(r, c) for r, c in canonical.items() if previous.get(r) != c])
+
+        for r, c in previous.items():
+            del self._canonical[r]
+            self._equivalents.pop(c, None)
+        self._canonical.update(canonical)
+        for r, c in canonical.items():
+            self._equivalents.setdefault(c, []).append(r)
+
+    def propertiesof(self, characteristic):
+        """ Returns the properties that have the given characteristic (one
+        of PROPERTY_CHARACTERISTICS), in any model.
+        """
+        return frozenset(s for s, p, o in self._axioms if p == "rdf:type" and o == characteristic)
+
+    def inversesof(self, property):
+        """ Returns the properties declared as inverse of the given one, in
+        any model.
+        """
+        return frozenset(self._inverses.get(property, []))
+
     def onupdate(self):
-        self._functionalproperties = frozenset(self.instancesof('owl:FunctionalProperty', False))
+        self.refresh_axioms()
+
+        if self.grouped:
+            # the change log is trimmed once the group is committed
+            return
+
+        with self.conn:
+            self.conn.execute("DELETE FROM %s WHERE seq<=(SELECT MAX(seq) FROM %s)-?" % (CHANGELOGTABLENAME, CHANGELOGTABLENAME), (CHANGELOG_SIZE,))
+
+        for listener in self.listeners:
+            listener()
 
     def has_stmt(self, pattern, models):
         """ Returns True if the given statment exist in
@@ -216,29 +1348,25 @@ class SQLStore:
 
         return False
 
-    @memoize
     def is_literal(self, atom):
         """ The definition of a literal follows the Turtle grammar:
         http://www.w3.org/TeamSubmission/turtle/#literal
         """
-        if atom in ["true", "false"]: # only lower-case!
-            return True
-        if atom[0] in ["\"", "'"] and atom[-1] in ["\"", "'"]:
-            return True
-        try:
-            float(atom) # test for integer, double, decimal
-            return True
-        except ValueError:
-            pass
+        return typed(atom)[0] is not None
 
-        if "@" in atom: # langague tag
-            return True
 
-        if "^^" in atom: # covers all XSD datatypes in Turtle syntax
-            return True
+MAX_PARAMS = 500 # max number of SQL parameters used in 'IN' clauses
 
-        return False
+def batches(values, models = []):
+    """ Splits a set of values into batches of at most MAX_PARAMS values.
 
+    Yields, for each batch, the SQL placeholders for the batch and the
+    parameters (the values of the batch, followed by the models).
+    """
+    values = list(values)
+    for i in range(0, len(values), MAX_PARAMS):
+        batch = values[i:i + MAX_PARAMS]
+        yield ",".join("?" * len(batch)), batch + list(models)
 
 def get_vars(s):
     return [x for x in s if x.startswith('?')]
@@ -0,0 +1,351 @@
+import logging; logger = logging.getLogger("minimalKB."+__name__);
+DEBUG_LEVEL=logging.DEBUG
+
+# Constraints ('filters') on the values of query variables, compiled into
+# SQL conditions.
+#
+# The filter language is a subset of SPARQL FILTER expressions. Each
+# constraint is a boolean expression, like:
+#
+# - '?d < 1.5', '?t >= "2014-01-01T00:00:00Z"^^xsd:dateTime' (numeric/date comparisons)
+# - '?a != ?b', '?obj = cup1' (comparisons of resources)
+# - '?label = "red cup"' (comparison of lexical forms)
+# - 'regex(?label, "^red", "i")', 'strstarts(?label, "red")', 'contains(?label, "cup")'
+# - 'lang(?label) = "en"', 'langmatches(lang(?label), "en")'
+# - 'datatype(?v) = xsd:double', 'str(?v) = "42"'
+#
+# Expressions can be combined with '&&', '||', '!' and parenthesis.
+
+import re
+
+from minimalkb.exceptions import KbServerError
+from minimalkb.helpers import parse_literal, literal_value
+
+TOKENS = re.compile(r'''\s*(?:
+                        (?P<string>"""(?:.|\n)*?"""(?:@[a-zA-Z0-9-]+|\^\^\S+?(?=[\s,)]|$))?|
+                                   "(?:[^"\\]|\\.)*"(?:@[a-zA-Z0-9-]+|\^\^\S+?(?=[\s,)]|$))?|
+                                   '(?:[^'\\]|\\.)*')|
+                        (?P<op>&&|\|\||!=|<=|>=|=|<|>|!|\(|\)|,)|
+                        (?P<atom>[^\s,()=<>!&|]+)
+                    )''', re.VERBOSE)
+
+COMPARISONS = ["=", "!=", "<", "<=", ">", ">="]
+FUNCTIONS = ["regex", "strstarts", "strends", "contains", "langmatches", "lang", "str", "datatype"]
+
+def tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        match = TOKENS.match(expr, pos)
+        if not match or match.end() == pos:
+            raise KbServerError("Invalid constraint <%s> (at: %s)" % (expr, expr[pos:]))
+        pos = match.end()
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+    return tokens
+
+class Parser:
+    """ Recursive-descent parser for constraints. Produces a tree of tuples:
+    ('or', a, b), ('and', a, b), ('not', a), ('cmp', op, a, b),
+    ('call', name, [args]), ('var', name), ('const', atom).
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.pos = 0
+
+    def parse(self):
+        tree = self.disjunction()
+        if self.pos != len(self.tokens):
+            self.error("unexpected '%s'" % self.tokens[self.pos][1])
+        return tree
+
+    def error(self, msg):
+        raise KbServerError("Invalid constraint <%s>: %s" % (self.expr, msg))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][1]
+        return None
+
+    def next(self):
+        if self.pos >= len(self.tokens):
+            self.error("unexpected end of expression")
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def expect(self, value):
+        kind, token = self.next()
+        if token != value:
+            self.error("'%s' expected, got '%s'" % (value, token))
+
+    def disjunction(self):
+        tree = self.conjunction()
+        while self.peek() == "||":
+            self.next()
+            tree = ("or", tree, self.conjunction())
+        return tree
+
+    def conjunction(self):
+        tree = self.negation()
+        while self.peek() == "&&":
+            self.next()
+            tree = ("and", tree, self.negation())
+        return tree
+
+    def negation(self):
+        if self.peek() == "!":
+            self.next()
+            return ("not", self.negation())
+        return self.comparison()
+
+    def comparison(self):
+        if self.peek() == "(":
+            self.next()
+            tree = self.disjunction()
+            self.expect(")")
+            return tree
+
+        tree = self.term()
+        if self.peek() in COMPARISONS:
+            op = self.next()[1]
+            tree = ("cmp", op, tree, self.term())
+        elif tree[0] != "call":
+            self.error("a comparison or a function call is expected")
+        return tree
+
+    def term(self):
+        kind, token = self.next()
+        if kind == "string":
+            return ("const", token)
+        if kind != "atom":
+            self.error("unexpected '%s'" % token)
+
+        if token.startswith("?"):
+            return ("var", token)
+
+        if token.lower() in FUNCTIONS and self.peek() == "(":
+            self.next()
+            args = [self.term()]
+            while self.peek() == ",":
+                self.next()
+                args.append(self.term())
+            self.expect(")")
+            return ("call", token.lower(), args)
+
+        return ("const", token)
+
+def parse(expr):
+    return Parser(expr).parse()
+
+def variables(tree):
+    """ Returns the set of variables used in a constraint.
+    """
+    if tree[0] == "var":
+        return {tree[1]}
+    if tree[0] == "const":
+        return set()
+    if tree[0] == "call":
+        return set().union(*[variables(a) for a in tree[2]])
+    return set().union(*[variables(t) for t in tree[1:] if isinstance(t, tuple)])
+
+
+class SQLCompiler:
+    """ Compiles constraints into SQL conditions. 'columns' maps each
+    variable to the SQL column holding its value. The constants are passed
+    as named parameters, stored in 'params'.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.params = {}
+
+    def param(self, value):
+        name = "f%s" % len(self.params)
+        self.params[name] = value
+        return ":" + name
+
+    def column(self, var):
+        if var not in self.columns:
+            raise KbServerError("Variable %s is used in a constraint, but does not appear in the patterns" % var)
+        return self.columns[var]
+
+    def compile(self, tree):
+        kind = tree[0]
+        if kind == "or":
+            return "(%s OR %s)" % (self.compile(tree[1]), self.compile(tree[2]))
+        if kind == "and":
+            return "(%s AND %s)" % (self.compile(tree[1]), self.compile(tree[2]))
+        if kind == "not":
+            return "(NOT %s)" % self.compile(tree[1])
+        if kind == "cmp":
+            return self.comparison(*tree[1:])
+        if kind == "call":
+            return self.predicate(tree[1], tree[2])
+        raise KbServerError("A boolean expression is expected in constraints, got %s" % (tree,))
+
+    def typedcolumn(self, var, column):
+        """ Returns the SQL expression of one of the typed literal columns
+        (lexical, datatype, lang, numeric) for a variable. Only objects can
+        be literals: subjects and predicates are always resources.
+        """
+        value = self.column(var)
+        alias, position = value.split(".")
+        if position != "object":
+            return {"lexical": value, "lang": "''"}.get(column, "NULL")
+
+        if column == "lexical":
+            return "IFNULL(%s.lexical, %s)" % (alias, value)
+        if column == "lang":
+            return "IFNULL(%s.lang, '')" % alias
+        return "%s.%s" % (alias, column)
+
+    # typed views on a term: its numeric value, its lexical form, its
+    # language tag and its datatype.
+
+    def numeric(self, term):
+        if term[0] == "var":
+            return self.typedcolumn(term[1], "numeric")
+        if term[0] == "const":
+            literal = parse_literal(term[1])
+            value = literal_value(*literal[:2]) if literal else None
+            if value is None:
+                raise KbServerError("%s is not a number or a date" % term[1])
+            return self.param(value)
+        return self.value(term)
+
+    def lexical(self, term):
+        if term[0] == "var":
+            return self.typedcolumn(term[1], "lexical")
+        if term[0] == "const":
+            literal = parse_literal(term[1])
+            return self.param(literal[0] if literal else term[1])
+        return self.value(term)
+
+    def value(self, term):
+        """ SQL value of a term, as stored in the KB (or as returned by a
+        function).
+        """
+        if term[0] == "var":
+            return self.column(term[1])
+        if term[0] == "const":
+            return self.param(term[1])
+
+        name, args = term[1], term[2]
+        if name in ["lang", "datatype"]:
+            if args[0][0] == "var":
+                return self.typedcolumn(args[0][1], name)
+            return "kb_%s(%s)" % (name, self.value(args[0]))
+        if name == "str":
+            return self.lexical(args[0])
+        raise KbServerError("Function %s does not return a value" % name)
+
+    def comparison(self, op, left, right):
+
+        def is_typed_constant(term):
+            if term[0] != "const":
+                return False
+            literal = parse_literal(term[1])
+            return literal is not None and literal_value(*literal[:2]) is not None
+
+        def is_plain_literal(term):
+            if term[0] != "const":
+                return False
+            literal = parse_literal(term[1])
+            return literal is not None and literal_value(*literal[:2]) is None
+
+        if op not in ["=", "!="] or is_typed_constant(left) or is_typed_constant(right):
+            # comparison of values: numbers, dates
+            return "(%s %s %s)" % (self.numeric(left), op, self.numeric(right))
+
+        if is_plain_literal(left) or is_plain_literal(right):
+            # string comparison
+            return "(%s %s %s)" % (self.lexical(left), op, self.lexical(right))
+
+        # comparison of resources (or function results)
+        return "(%s %s %s)" % (self.value(left), op, self.value(right))
+
+    def predicate(self, name, args):
+        if name in ["regex", "strstarts", "strends", "contains"]:
+            if len(args) < 2:
+                raise KbServerError("%s expects at least 2 arguments" % name)
+            text = self.lexical(args[0])
+            pattern = self.lexical(args[1])
+
+            if name == "regex":
+                if len(args) > 2:
+                    if args[2][0] != "const":
+                        raise KbServerError("regex flags must be a constant")
+                    if "i" in (parse_literal(args[2][1]) or [args[2][1]])[0]:
+                        pattern = "'(?i)' || %s" % pattern
+                return "(%s REGEXP %s)" % (text, pattern)
+            if name == "strstarts":
+                return "(substr(%s, 1, length(%s)) = %s)" % (text, pattern, pattern)
+            if name == "strends":
+                return "(substr(%s, -length(%s)) = %s)" % (text, pattern, pattern)
+            return "(instr(%s, %s) > 0)" % (text, pattern)
+
+        if name == "langmatches":
+            if len(args) != 2:
+                raise KbServerError("langmatches expects 2 arguments")
+            lang = "lower(%s)" % self.value(args[0])
+            range = self.lexical(args[1])
+            return "(%s != '' AND (%s = '*' OR %s = lower(%s) OR %s LIKE lower(%s) || '-%%'))" % \
+                    (lang, range, lang, range, lang, range)
+
+        raise KbServerError("%s is not a boolean function" % name)
+
+
+def compile(constraints, columns):
+    """ Compiles a list of constraints (that must all hold) into a SQL
+    condition. Returns the condition and its parameters.
+    """
+    compiler = SQLCompiler(columns)
+    conditions = [compiler.compile(parse(c)) for c in constraints]
+    return " AND ".join(conditions), compiler.params
+
+
+##############################################################################
+# SQL functions used by the compiled constraints (when the typed columns can
+# not be used, ie, for constants and function results)
+
+def _lexical(atom):
+    if atom is None:
+        return None
+    literal = parse_literal(unicode(atom))
+    return literal[0] if literal else atom
+
+def _numeric(atom):
+    if atom is None:
+        return None
+    literal = parse_literal(unicode(atom))
+    return literal_value(*literal[:2]) if literal else None
+
+def _lang(atom):
+    if atom is None:
+        return None
+    literal = parse_literal(unicode(atom))
+    return (literal[2] or "") if literal else ""
+
+def _datatype(atom):
+    if atom is None:
+        return None
+    literal = parse_literal(unicode(atom))
+    return literal[1] if literal else None
+
+_regexes = {}
+def _regexp(pattern, text):
+    if pattern is None or text is None:
+        return None
+    if pattern not in _regexes:
+        _regexes[pattern] = re.compile(pattern)
+    return _regexes[pattern].search(text) is not None
+
+def register_functions(conn):
+    conn.create_function("kb_lexical", 1, _lexical)
+    conn.create_function("kb_numeric", 1, _numeric)
+    conn.create_function("kb_lang", 1, _lang)
+    conn.create_function("kb_datatype", 1, _datatype)
+    conn.create_function("regexp", 2, _regexp)
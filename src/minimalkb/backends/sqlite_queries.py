@@ -1,15 +1,163 @@
 import logging; logger = logging.getLogger("minimalKB."+__name__);
 DEBUG_LEVEL=logging.DEBUG
 
+import sys
+import time
+
 from minimalkb.exceptions import KbServerError
+import sqlite_filters
+
+class QueryProfile:
+    """ Wraps a database connection to trace the SQL statements executed
+    by a query: passed to 'query' instead of the connection, it records,
+    for each statement, the function that issued it (the query stage:
+    'simplequery', 'selectfromset', 'joinquery'...), the SQL and its
+    parameters, the output of EXPLAIN QUERY PLAN, the number of rows
+    returned and the execution time.
+
+    'query' also records in 'candidates' the sizes of the candidate sets
+    of the variables.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.statements = []
+        self.candidates = {}
+
+    def execute(self, query, params = ()):
+        plan = [row[3] for row in self.db.execute("EXPLAIN QUERY PLAN " + query, params)]
+
+        starttime = time.time()
+        rows = self.db.execute(query, params).fetchall()
+
+        self.statements.append({"stage": sys._getframe(1).f_code.co_name,
+                                "sql": query,
+                                "params": params,
+                                "plan": plan,
+                                "rows": len(rows),
+                                "time": time.time() - starttime})
+        return rows
+
+    def trace(self):
+        return {"statements": self.statements,
+                "candidates": self.candidates}
+
+# Backward-chaining: closures of the taxonomy, computed at query time (the
+# reasoner does not materialize them), by walking the rdfs:subClassOf and
+# owl:equivalentClass statements from the bound term of the pattern: up from
+# the types of the instance (or from the class) if the subject is known, down
+# from the class otherwise. Each row (start, class, model) of 'walk' is a
+# class reached from 'start' within 'model' (NULL for the starting classes,
+# whose statements may be in any model). '%(models)s' restricts the
+# statements to the queried models.
+#
+# (the recursive CTEs are nested in subqueries: with Python 2 sqlite3, a
+# statement starting with WITH would implicitly commit the current
+# transaction)
+WALK = '''WITH RECURSIVE
+            walk(start, class, model) AS (
+                %(seed)s
+              UNION
+                SELECT w.start, CASE WHEN t.%(from)s=w.class THEN t.%(to)s ELSE t.%(from)s END, t.model
+                FROM walk AS w CROSS JOIN triples AS t
+                WHERE ((t.%(from)s=w.class AND t.predicate IN ('rdfs:subClassOf', 'owl:equivalentClass'))
+                       OR (t.%(to)s=w.class AND t.predicate='owl:equivalentClass'))
+                      AND (w.model IS NULL OR t.model=w.model) %(models)s)'''
+
+# (from, to) columns of the taxonomy statements, walking up or down
+UP = ("subject", "object")
+DOWN = ("object", "subject")
+
+# seeds of the walk: given classes, all the classes, the types of given
+# instances, the types of all the instances
+CLASSES = "SELECT column1, column1, NULL FROM (VALUES %(rows)s)"
+ALLCLASSES = '''SELECT class, class, NULL FROM
+                    (SELECT subject AS class FROM triples AS t
+                     WHERE predicate IN ('rdfs:subClassOf', 'owl:equivalentClass') %(models)s
+                   UNION
+                     SELECT object FROM triples AS t
+                     WHERE predicate='owl:equivalentClass' %(models)s)'''
+TYPES = "SELECT subject, object, model FROM triples AS t WHERE predicate='rdf:type' AND subject IN (%(values)s) %(models)s"
+ALLTYPES = "SELECT subject, object, model FROM triples AS t WHERE predicate='rdf:type' %(models)s"
+
+SUPERCLASSES = '''(%(walk)s
+                   SELECT start AS subject, 'rdfs:subClassOf' AS predicate, class AS object, model,
+                          NULL AS lexical, NULL AS datatype, NULL AS lang, NULL AS numeric
+                   FROM walk WHERE model IS NOT NULL AND start!=class)'''
+SUBCLASSES = '''(%(walk)s
+                 SELECT class AS subject, 'rdfs:subClassOf' AS predicate, start AS object, model,
+                        NULL AS lexical, NULL AS datatype, NULL AS lang, NULL AS numeric
+                 FROM walk WHERE model IS NOT NULL AND start!=class)'''
+CLASSESOF = '''(%(walk)s
+                SELECT start AS subject, 'rdf:type' AS predicate, class AS object, model,
+                       NULL AS lexical, NULL AS datatype, NULL AS lang, NULL AS numeric
+                FROM walk)'''
+INSTANCESOF = '''(%(walk)s
+                  SELECT t.subject AS subject, 'rdf:type' AS predicate, w.start AS object, t.model AS model,
+                         NULL AS lexical, NULL AS datatype, NULL AS lang, NULL AS numeric
+                  FROM walk AS w CROSS JOIN triples AS t
+                  WHERE t.object=w.class AND t.predicate='rdf:type'
+                        AND (w.model IS NULL OR t.model=w.model) %(models)s)'''
+
+CLOSURES = ["rdfs:subClassOf", "rdf:type"]
+
+def closure(predicate, models, subject = None, object = None):
+    """ Returns the SQL subquery computing the closure of a taxonomic
+    predicate (one of CLOSURES) in the given models (passed as named
+    parameters :m0, :m1...), for the bound terms of the pattern.
+
+    :param subject: if the subject of the pattern is known, the named
+    parameters of its values (eg, [':c0', ':c1'] for equivalent resources)
+    :param object: same for the object of the pattern (only used if the
+    subject is not known)
+    """
+    inmodels = "AND t.model IN (%s)" % ",".join(":m%s" % i for i in range(len(models))) if models else ""
+
+    if subject:
+        direction, values = UP, subject
+    elif object:
+        direction, values = DOWN, object
+    else:
+        direction, values = UP, []
+
+    if predicate == "rdf:type" and direction == UP:
+        template, seed = CLASSESOF, TYPES if values else ALLTYPES
+    elif predicate == "rdf:type":
+        template, seed = INSTANCESOF, CLASSES
+    elif direction == UP:
+        template, seed = SUPERCLASSES, CLASSES if values else ALLCLASSES
+    else:
+        template, seed = SUBCLASSES, CLASSES
 
-def query(db, vars, patterns, models):
+    seed = seed % {"values": ",".join(values),
+                   "rows": ",".join("(%s)" % v for v in values),
+                   "models": inmodels}
+    walk = WALK % {"seed": seed, "from": direction[0], "to": direction[1], "models": inmodels}
+    return template % {"walk": walk, "models": inmodels}
+
+def query(db, vars, patterns, models, constraints = None, equivalents = None, backward = False):
     """
     'vars' is the list of unbound variables that are expected to be returned.
     Each of them must start with a '?'.
 
     'patterns' is a list/set of 3-tuples (s,p,o). Each tuple may contain
     unbound variables, that MUST start with a '?'.
+
+    'constraints' is an optional list of filters on the variables (see
+    sqlite_filters). If present, the whole query (patterns and constraints)
+    is compiled into a single SQL query.
+
+    'equivalents' optionally returns, for a resource, the list of resources
+    equivalent to it (owl:sameAs). If present, the query is compiled into a
+    single SQL query as well, that matches equivalent resources (see
+    'joinquery').
+
+    If 'backward' is True, the patterns on rdf:type and rdfs:subClassOf
+    match the closure of the taxonomy (subclasses and equivalent classes),
+    computed at query time. The query is compiled into a single SQL query
+    as well.
+
+    'db' may be a QueryProfile, to trace the query.
     """
 
     vars = set(vars)
@@ -21,7 +169,10 @@ def query(db, vars, patterns, models):
     if not allvars >= vars:
         logger.warn("Some requested vars are not present in the patterns. Returning []")
         return []
-    
+
+    if compiled(vars, patterns, constraints, equivalents, backward):
+        return joinquery(db, vars, patterns, models, constraints, equivalents, backward)
+
     if len(patterns) == 1:
         return singlepattern(db, patterns[0], models)
 
@@ -43,6 +194,9 @@ def query(db, vars, patterns, models):
                 # intersection with previous candidates
                 candidates[v] = candidates[v] & simplequery(db, p, models)
 
+    if isinstance(db, QueryProfile):
+        db.candidates = {var: len(values) for var, values in candidates.items()}
+
     # if any of the requested var appears in an independant pattern but has no match for
     # this pattern, return []
     for var in allvars:
@@ -91,6 +245,160 @@ def query(db, vars, patterns, models):
                 pass
 
 
+def compiled(vars, patterns, constraints = None, equivalents = None, backward = False):
+    """ Returns True if 'query' compiles the query into a single SQL query
+    (see 'joinquery'), False if it resolves the patterns one by one.
+    """
+    # several variables on several patterns: compiled into a join as well
+    return bool(constraints or equivalents or \
+                (backward and any(p[1] in CLOSURES for p in patterns)) or \
+                (len(vars) > 1 and len(patterns) > 1))
+
+def joinquery(db, vars, patterns, models, constraints = None, equivalents = None, backward = False, delta = None):
+    """ Compiles a set of patterns and their constraints into one SQL
+    query, each pattern being one occurence of the triple table, joined on
+    the shared variables.
+
+    The results are formatted like the results of 'query': a list of values
+    for one variable, a list of statements for a single pattern, a list of
+    dictionaries {variable (without '?'): value} otherwise.
+
+    With 'equivalents' (see 'query'), constants match any of their
+    equivalents, variables are joined on equivalent resources (through the
+    'sameas' table of canonical representatives), and the canonical
+    representatives are returned. Constraints apply to the values as
+    stored.
+
+    The equivalents of a variable are reached with (left) joins on the
+    'sameas' table, that SQLite can not reorder: the patterns are then
+    joined in the order given by 'joinorder', each pattern being looked up
+    by its joined subject or object (the index on the other one is
+    disabled with the unary '+').
+
+    With 'backward', the patterns on rdf:type and rdfs:subClassOf are
+    matched against their closure (see 'closure').
+
+    If 'delta' is given (the index of a pattern), this pattern only matches
+    the statements of the temporary 'delta' table (see
+    'SQLStore.stage_delta'), that is joined first: the query then returns
+    the results that depend on these statements.
+    """
+    columns = {}
+    conditions = []
+    params = {}
+    tables = []
+
+    keys = {} # for variables joined on equivalents, SQL expression of the equivalents
+    ordered = equivalents or delta is not None # joined in the order of 'joinorder'
+    if ordered:
+        patterns = joinorder(patterns, delta)
+        if delta is not None:
+            delta = 0
+    if equivalents:
+        occurences = {}
+        for pattern in patterns:
+            for tok in pattern:
+                occurences[tok] = occurences.get(tok, 0) + 1
+
+    # workaround to feed a variable number of models
+    models = list(models)
+    for i in range(len(models)):
+        params["m%s"%i] = models[i]
+
+    for i, pattern in enumerate(patterns):
+        alias = "t%s" % i
+        if i == delta:
+            table = "delta AS %s" % alias
+        elif backward and pattern[1] in CLOSURES:
+            # the closure is walked from the constant subject or object
+            bound = []
+            for tok in (pattern[0], pattern[2]):
+                names = []
+                if not is_variable(tok):
+                    for resource in (equivalents(tok) if equivalents else [tok]):
+                        names.append(":c%s" % len(params))
+                        params[names[-1][1:]] = resource
+                bound.append(names)
+            table = "%s AS %s" % (closure(pattern[1], models, *bound), alias)
+        else:
+            table = "triples AS %s" % alias
+        # columns joined with the previous patterns
+        joined = [c for tok, c in zip(pattern, ["subject", "predicate", "object"]) if tok in columns]
+        for tok, column in zip(pattern, ["subject", "predicate", "object"]):
+            lookup = "+" if ordered and column != "predicate" and joined and column not in joined else ""
+            column = "%s.%s" % (alias, column)
+            if is_variable(tok):
+                if tok in columns:
+                    conditions.append("%s=%s" % (column, keys.get(tok, columns[tok])))
+                else:
+                    columns[tok] = column
+                    if equivalents and occurences[tok] > 1:
+                        n = len(keys)
+                        table += " LEFT JOIN sameas AS e%s ON e%s.resource=%s" % (n, n, column)
+                        table += " LEFT JOIN sameas AS f%s ON f%s.canonical=e%s.canonical" % (n, n, n)
+                        keys[tok] = "IFNULL(f%s.resource, %s)" % (n, column)
+            elif equivalents:
+                names = []
+                for resource in equivalents(tok):
+                    names.append("c%s" % len(params))
+                    params[names[-1]] = resource
+                conditions.append("%s%s IN (%s)" % (lookup, column, ",".join(":" + n for n in names)))
+            else:
+                name = "c%s" % len(params)
+                params[name] = tok
+                conditions.append("%s%s=:%s" % (lookup, column, name))
+        if models:
+            conditions.append("%s.model IN (%s)" % (alias, ",".join([":m%s" % i for i in range(len(models))])))
+        tables.append(table)
+
+    if constraints:
+        filters, filterparams = sqlite_filters.compile(constraints, columns)
+        conditions.append(filters)
+        params.update(filterparams)
+
+    if len(patterns) == 1 and len(vars) != 1:
+        selected = ["t0.subject", "t0.predicate", "t0.object"]
+    else:
+        vars = sorted(vars)
+        selected = [columns[v] for v in vars] or ["1"]
+
+    if equivalents:
+        selected = ["IFNULL((SELECT canonical FROM sameas WHERE resource=%s), %s)" % (c, c) for c in selected]
+
+    query = "SELECT DISTINCT %s FROM %s" % (", ".join(selected),
+                                            (" CROSS JOIN " if ordered else ", ").join(tables))
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    logger.debug("Compiled query: %s (%s)" % (query, params))
+    rows = db.execute(query, params)
+
+    if len(patterns) == 1 and len(vars) != 1:
+        return [list(row) for row in rows]
+    if len(vars) == 1:
+        return [row[0] for row in rows]
+    return [{v[1:]: val for v, val in zip(vars, row)} for row in rows]
+
+def joinorder(patterns, first = None):
+    """ Orders patterns for joins: each pattern is followed by the one with
+    the most terms that are constant or bound by the previous patterns (in
+    case of ties, the first one given).
+
+    'first' optionally gives the index of the pattern to start with.
+    """
+    ordered = []
+    bound = set()
+    remaining = list(patterns)
+    if first is not None:
+        ordered.append(remaining.pop(first))
+        bound |= set(get_vars(ordered[0]))
+    while remaining:
+        pattern = max(remaining, key = lambda p: len([t for t in p if not is_variable(t) or t in bound]))
+        remaining.remove(pattern)
+        ordered.append(pattern)
+        bound |= set(get_vars(pattern))
+    return ordered
+
 def singlepattern(db, pattern, models):
     """ Returns the list of statements that match
     a single pattern (like "* likes ?toto").
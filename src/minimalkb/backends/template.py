@@ -13,24 +13,32 @@ class TemplateBackend:
         """
         raise NotImplementedError()
 
-    def add(self, stmts, model = DEFAULT_MODEL):
-        """ Add the given statements to the given model.
+    def add(self, stmts, models = [DEFAULT_MODEL]):
+        """ Add the given statements to the given models.
         """
         raise NotImplementedError()
 
-    def delete(self, stmts, model = DEFAULT_MODEL):
-        """ remove the given statements from the given model.
+    def delete(self, stmts, models = [DEFAULT_MODEL]):
+        """ remove the given statements from the given models.
         """
         raise NotImplementedError()
 
-    def update(self, stmts, model = DEFAULT_MODEL):
-        """ Add the given statements to the given model, updating the statements
+    def update(self, stmts, models = [DEFAULT_MODEL]):
+        """ Add the given statements to the given models, updating the statements
         with a functional predicate.
         """
         raise NotImplementedError()
 
-    def about(self, resource, models):
-        """ Returns all statements involving the resource.
+    def about(self, resource, models, limit = None):
+        """ Returns all statements involving the resource (optionally, at
+        most 'limit' statements for each of the subject, predicate and
+        object roles).
+        """
+        raise NotImplementedError()
+
+    def search_labels(self, text, models, fuzzy = False, limit = None):
+        """ Returns the resources whose label matches the text, best
+        matches first.
         """
         raise NotImplementedError()
 
@@ -41,7 +49,10 @@ class TemplateBackend:
         raise NotImplementedError()
 
 
-    def query(self, vars, patterns, models):
+    def query(self, vars, patterns, models, constraints = None):
+        """ Returns the values of the variables matching the patterns, and
+        satisfying the (optional) constraints.
+        """
         raise NotImplementedError()
 
     def classesof(self, concept, direct, models):
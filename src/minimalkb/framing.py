@@ -0,0 +1,170 @@
+import logging; logger = logging.getLogger("minimalKB."+__name__);
+
+# Binary framing of the minimalKB protocol, used by the same-host (Unix
+# socket) transport, and negotiated by TCP clients with a first, text,
+# 'framing' request:
+#
+#   framing
+#   "msgpack"
+#   #end#
+#
+# The server answers (in text) with the payload encoding it will use
+# ('msgpack', or 'json' if msgpack is not available), and both sides then
+# switch to binary frames.
+#
+# Each message is a frame made of a 5 bytes header (one byte for the payload
+# encoding, 'm' for MessagePack or 'j' for JSON, followed by the payload
+# length as a 32 bits big-endian unsigned integer), and the payload.
+#
+# Payloads are:
+# - requests: [method, [args...], {kwargs...}]
+# - answers: ["ok", result] or ["error", "kberror", message]
+# - events: ["event", event id, content]
+#
+# The server answers with the encoding of the request. MessagePack is used
+# by default when available.
+#
+# Frames with an unknown payload encoding, or longer than MAX_FRAME_SIZE, are
+# answered with an error, and the connection is closed (the rest of the
+# stream can not be trusted).
+
+import json
+import socket
+import struct
+from Queue import Queue, Empty
+
+from minimalkb.exceptions import KbServerError
+
+hasMsgpack = False
+try:
+    import msgpack
+    hasMsgpack = True
+except ImportError:
+    logger.info("msgpack not available. Binary frames will carry JSON payloads.")
+    pass
+
+MSGPACK = "m"
+JSON = "j"
+
+CODECS = {"msgpack": MSGPACK, "json": JSON}
+
+HEADER = struct.Struct("!cI")
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # bytes
+
+def default_codec():
+    return MSGPACK if hasMsgpack else JSON
+
+def encode(msg, codec):
+    if codec == MSGPACK:
+        return msgpack.packb(msg, use_bin_type = False)
+    return json.dumps(msg, separators = (",", ":"))
+
+def decode(payload, codec):
+    if codec == MSGPACK:
+        if not hasMsgpack:
+            raise KbServerError("Got a MessagePack frame, but msgpack is not available")
+        return msgpack.unpackb(payload, raw = False)
+    if codec == JSON:
+        return json.loads(payload)
+    raise KbServerError("Unknown frame encoding <%s>" % codec)
+
+def parse_header(data):
+    """ Returns the (codec, payload length) of a frame header.
+
+    :raises KbServerError: if the encoding is unknown, or the frame too large.
+    """
+    codec, length = HEADER.unpack(data)
+    if codec not in CODECS.values():
+        raise KbServerError("Unknown frame encoding <%r>" % codec)
+    if length > MAX_FRAME_SIZE:
+        raise KbServerError("Frame too large (%d bytes, max %d)" % (length, MAX_FRAME_SIZE))
+    return codec, length
+
+def frame(msg, codec):
+    payload = encode(msg, codec)
+    return HEADER.pack(codec, len(payload)) + payload
+
+
+class BinaryClient:
+    """ A minimal, blocking client for the binary framed protocol, over the
+    Unix socket of a local minimalKB server (if 'address' is a path) or over
+    TCP (if 'address' is a (host, port) pair).
+
+    Events received while waiting for the answer to a request are stored
+    in the 'events' queue as (id, content) pairs.
+    """
+
+    def __init__(self, address, codec = None):
+        self.codec = codec or default_codec()
+        self.events = Queue()
+
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address)
+            self.negotiate()
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+
+    def negotiate(self):
+        name = [n for n, c in CODECS.items() if c == self.codec][0]
+        self.sock.sendall("framing\n%s\n#end#" % json.dumps(name))
+
+        raw = ""
+        while not raw.endswith("#end#\n"):
+            data = self.sock.recv(1)
+            if not data:
+                raise KbServerError("Connection closed by the server")
+            raw += data
+
+        msg = raw.split("\n")
+        if msg[0] != "ok":
+            raise KbServerError("The server does not support binary framing: %s" % msg[-3])
+        self.codec = CODECS[json.loads(msg[1])]
+
+    def close(self):
+        try:
+            self.sock.sendall(frame(["close", [], {}], self.codec))
+        finally:
+            self.sock.close()
+
+    def call(self, method, *args, **kwargs):
+        self.sock.sendall(frame([method, list(args), kwargs], self.codec))
+
+        while True:
+            msg = self.readmsg()
+            if msg[0] == "ok":
+                return msg[1]
+            elif msg[0] == "error":
+                raise KbServerError(msg[-1])
+            else:
+                self.events.put((msg[1], msg[2]))
+
+    def readevent(self):
+        """ Blocks until the next event is received, and returns it as a
+        (id, content) pair.
+        """
+        try:
+            return self.events.get_nowait()
+        except Empty:
+            pass
+
+        while True:
+            msg = self.readmsg()
+            if msg[0] == "event":
+                return msg[1], msg[2]
+            logger.warn("Unexpected message while waiting for an event: %s" % msg[0])
+
+    def readmsg(self):
+        codec, length = parse_header(self.recv(HEADER.size))
+        return decode(self.recv(length), codec)
+
+    def recv(self, length):
+        chunks = []
+        while length:
+            data = self.sock.recv(min(length, 65536))
+            if not data:
+                raise KbServerError("Connection closed by the server")
+            chunks.append(data)
+            length -= len(data)
+        return "".join(chunks)
@@ -14,3 +14,88 @@ def memoize(obj):
         return cache[key]
     return memoizer
 
+
+import re
+import calendar
+import datetime
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+NUMERIC_DATATYPES = {"xsd:integer", "xsd:decimal", "xsd:double", "xsd:float",
+                     "xsd:int", "xsd:long", "xsd:short", "xsd:byte",
+                     "xsd:nonNegativeInteger", "xsd:positiveInteger",
+                     "xsd:nonPositiveInteger", "xsd:negativeInteger",
+                     "xsd:unsignedInt", "xsd:unsignedLong"}
+DATETIME_DATATYPES = {"xsd:dateTime", "xsd:date"}
+
+TURTLE_INTEGER = re.compile(r"^[+-]?[0-9]+$")
+# (unlike Turtle, decimals may end with a dot: '1.' has always been a number
+# for minimalKB)
+TURTLE_DECIMAL = re.compile(r"^[+-]?([0-9]*\.[0-9]+|[0-9]+\.)$")
+TURTLE_DOUBLE = re.compile(r"^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)[eE][+-]?[0-9]+$")
+QUOTED_LITERAL = re.compile(r'^("""(?P<long>.*)"""|"(?P<short>.*)"|\'(?P<single>.*)\')(@(?P<lang>[a-zA-Z0-9-]+)|\^\^(?P<datatype>\S+))?$', re.DOTALL)
+ISO_DATETIME = re.compile(r"^(\d{4})-(\d{2})-(\d{2})(T(\d{2}):(\d{2}):(\d{2})(\.\d+)?)?(Z|[+-]\d{2}:\d{2})?$")
+
+def parse_literal(atom):
+    """ Splits a literal, in Turtle syntax
+    (http://www.w3.org/TeamSubmission/turtle/#literal), into its lexical
+    form, its datatype (as a 'xsd:' qname for XSD datatypes) and its language
+    tag.
+
+    Returns a tuple (lexical, datatype, lang), or None if the atom is not
+    a literal.
+    """
+    if atom in ["true", "false"]: # only lower-case!
+        return atom, "xsd:boolean", None
+    if TURTLE_INTEGER.match(atom):
+        return atom, "xsd:integer", None
+    if TURTLE_DECIMAL.match(atom):
+        return atom, "xsd:decimal", None
+    if TURTLE_DOUBLE.match(atom):
+        return atom, "xsd:double", None
+
+    match = QUOTED_LITERAL.match(atom)
+    if not match:
+        return None
+
+    lexical = [v for v in match.group("long", "short", "single") if v is not None][0]
+    datatype = match.group("datatype")
+    if datatype:
+        if datatype.startswith("<" + XSD):
+            datatype = "xsd:" + datatype[len(XSD) + 1:-1]
+        return lexical, datatype, None
+
+    return lexical, None, match.group("lang")
+
+def literal_value(lexical, datatype):
+    """ Returns the numeric value of a literal (as a float), or None if the
+    literal is not a number. Dates are converted to seconds since the epoch
+    (UTC), so that they can be compared as numbers.
+    """
+    try:
+        if datatype in NUMERIC_DATATYPES:
+            return float(lexical)
+        if datatype in DATETIME_DATATYPES:
+            return timestamp(lexical)
+    except ValueError:
+        pass
+    return None
+
+def timestamp(iso):
+    """ Converts a ISO 8601 date or date-time into seconds since the epoch.
+    Date-times without timezone are assumed to be UTC.
+    """
+    match = ISO_DATETIME.match(iso)
+    if not match:
+        raise ValueError("Invalid date: %s" % iso)
+
+    year, month, day, _, hour, minute, second, fraction, tz = match.groups()
+    date = datetime.datetime(int(year), int(month), int(day),
+                             int(hour or 0), int(minute or 0), int(second or 0))
+    seconds = calendar.timegm(date.timetuple()) + float(fraction or 0)
+
+    if tz and tz != "Z":
+        offset = int(tz[1:3]) * 3600 + int(tz[4:6]) * 60
+        seconds -= offset if tz[0] == "+" else -offset
+
+    return seconds
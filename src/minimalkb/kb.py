@@ -1,31 +1,77 @@
 import logging; logger = logging.getLogger("minimalKB."+__name__);
 
 from Queue import Queue, Empty
+from collections import deque
 import json
+import time
 import traceback
 
 DEFAULT_MODEL = "default"
 
-import shlex
-from multiprocessing import Process
+# Group commit: consecutive write requests are performed in a single
+# transaction, committed GROUP_COMMIT_DELAY seconds after the first one, once
+# GROUP_COMMIT_SIZE statements have been written, or before serving any other
+# request. The writers are acknowledged once the group is committed.
+GROUP_COMMIT_DELAY = 0.005 # sec
+GROUP_COMMIT_SIZE = 1000 # statements
+WRITE_REQUESTS = ["revise", "add", "safeAdd", "addForAgent", "retract", "remove", "removeForAgent", "update"]
+
+# requests a follower answers while it is not in sync with its primary (see
+# Follower.check): they do not depend on the content of the KB
+LOCAL_REQUESTS = ["hello", "stats", "methods", "listSimpleMethods", "client_stats", "reasoner_stats"]
+
+# number of query traces kept by the query profiler (see MinimalKB.explain)
+PROFILE_BUFFER_SIZE = 100
+
+# requests taking longer than this are logged (see MinimalKB.process)
+SLOW_REQUEST_THRESHOLD = 0.1 # sec
+
+# Outbound queues: the messages to a client wait in the KB while the client
+# has more than CLIENT_BACKLOG chunks of output not yet written to its
+# socket. Once OUTBOUND_QUEUE_SIZE messages are waiting, the event
+# notifications are coalesced (merged with the pending notification of the
+# same event), the oldest ones are dropped, or the client is disconnected.
+# The answers to requests are never dropped.
+OUTBOUND_QUEUE_SIZE = 1000 # messages
+CLIENT_BACKLOG = 16 # chunks (of up to 4KB)
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = [OVERFLOW_COALESCE, OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT]
 
-hasRDFlib = False
-try:
-    import rdflib
-    import rdflib.namespace
-    hasRDFlib = True
-except ImportError:
-    logger.warn("RDFlib not available. You won't be able to load existing ontologies.")
-    pass
+import shlex
+import sqlite3
+import threading
+
+# RDFlib (only needed to load ontologies) and multiprocessing (only needed
+# to run the services in their own processes) are slow to import: they are
+# imported on first use.
+rdflib = None
+
+def import_rdflib():
+    """ Imports RDFlib, and returns it (False if it is not available).
+    """
+    global rdflib
+    if rdflib is None:
+        try:
+            import rdflib
+            import rdflib.namespace
+        except ImportError:
+            logger.warn("RDFlib not available. You won't be able to load existing ontologies.")
+            rdflib = False
+    return rdflib
 
 from exceptions import KbServerError
 from minimalkb import __version__
 
-from backends.sqlite import SQLStore
+from backends.sqlite import SQLStore, EVICTION_OLDEST, EVICTION_LRU, EVICTION_POLICIES
 #from backends.rdflib_backend import RDFlibStore
 
-from services.simple_rdfs_reasoner import start_reasoner, stop_reasoner
+from services.simple_rdfs_reasoner import SQLiteSimpleRDFSReasoner, REASONER_DEBOUNCE, start_reasoner, stop_reasoner
 from services import lifespan
+from replication import Follower, database_id
+from profiler import SamplingProfiler, SAMPLING_INTERVAL
+from views import View
 
 def api(fn):
     fn._api = True
@@ -51,6 +97,7 @@ class Event:
     NEW_CLASS_INSTANCE = "NEW_CLASS_INSTANCE"
     NEW_INSTANCE_ONE_SHOT = "NEW_INSTANCE_ONE_SHOT"
     NEW_CLASS_INSTANCE_ONE_SHOT = "NEW_CLASS_INSTANCE_ONE_SHOT"
+    NEW_BINDINGS = "NEW_BINDINGS" # see BindingsEvent
 
     def __init__(self, kb, type, trigger, var, patterns, models):
         self.kb = kb
@@ -112,6 +159,197 @@ class Event:
             self.content = [i for i in newinstances] # for some reason, calling list() does not work
             return True
 
+    def merge(self, content, newer):
+        """ Merges the contents of two notifications of the event (see
+        OutboundQueue).
+        """
+        known = set(content)
+        return content + [i for i in newer if i not in known]
+
+    def complete(self, content):
+        return content
+
+
+class ChangeFeed:
+    """ A push subscription to the KB change log: each time new changes are
+    recorded, they are sent to the subscribers as an event whose content has
+    the same format as the return value of MinimalKB.changes_since.
+    """
+
+    def __init__(self, kb, seq):
+        self.kb = kb
+        self.seq = seq
+
+        self.id = "changes_" + str(id(self))
+
+        self.content = None
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def evaluate(self, head):
+        if head <= self.seq:
+            return False
+
+        self.content = self.kb.store.changes_since(self.seq)
+        self.seq = self.content["seq"]
+        return True
+
+    def merge(self, content, newer):
+        """ Coalesced notifications only keep the range of changes they
+        cover: the changes are read again from the change log when the
+        notification is sent (see 'complete').
+        """
+        if "since" in content:
+            since = content["since"]
+        else:
+            since = content["changes"][0][0] - 1 if content["changes"] else content["seq"]
+        return {"since": since, "seq": newer["seq"]}
+
+    def complete(self, content):
+        if "since" not in content:
+            return content
+
+        changes = self.kb.store.changes_since(content["since"])
+        changes["changes"] = [c for c in changes["changes"] if c[0] <= content["seq"]]
+        changes["seq"] = content["seq"]
+        return changes
+
+
+class BindingsEvent:
+    """ A NEW_BINDINGS subscription: the bindings of the variables of a set
+    of patterns (with any number of variables) are maintained incrementally
+    from the change log (see minimalkb.views), and the bindings that
+    appeared and disappeared since the last update cycle are notified
+    together, as {'added': [{variable (without '?'): value}, ...],
+    'removed': [...]}.
+    """
+
+    def __init__(self, kb, trigger, vars, patterns, models):
+        self.kb = kb
+        self.trigger = trigger
+
+        self.id =  "evt_" + str(hash(Event.NEW_BINDINGS + \
+                    self.trigger + \
+                    str(sorted(vars or [])) + \
+                    str(sorted(patterns)) + \
+                    str(sorted(models))))
+
+        self.view = View(kb.store, vars, patterns, models)
+        self.names = [v[1:] for v in self.view.vars]
+
+        self.content = None
+
+        self.valid = True
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def evaluate(self, head):
+        added, removed = self.view.update(head)
+        if not added and not removed:
+            return False
+
+        if "ONE_SHOT" in self.trigger:
+            self.valid = False
+
+        self.content = {"added": [dict(zip(self.names, b)) for b in added],
+                        "removed": [dict(zip(self.names, b)) for b in removed]}
+        return True
+
+    def merge(self, content, newer):
+        """ A binding added then removed (or the reverse) by the merged
+        notifications is not notified.
+        """
+        key = lambda b: tuple(sorted(b.items()))
+        added = {key(b) for b in content["added"]}
+        removed = {key(b) for b in content["removed"]}
+        newadded = {key(b) for b in newer["added"]}
+        newremoved = {key(b) for b in newer["removed"]}
+
+        return {"added": [dict(b) for b in (added - newremoved) | (newadded - removed)],
+                "removed": [dict(b) for b in (removed - newadded) | (newremoved - added)]}
+
+    def complete(self, content):
+        return content
+
+
+class Notification:
+    """ A notification of an event (or change feed) to a client: the
+    content of the event when it was triggered.
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self.id = event.id
+        self.content = event.content
+
+
+class OutboundQueue:
+    """ The messages waiting to be sent to a client, with at most 'size'
+    messages (see OUTBOUND_QUEUE_SIZE): beyond, the event notifications
+    overflow according to the 'overflow' policy.
+    """
+
+    def __init__(self, size = OUTBOUND_QUEUE_SIZE, overflow = OVERFLOW_COALESCE):
+        self.size = size
+        self.overflow = overflow
+
+        self.messages = deque()
+        self.pending = {} # {event id: last pending notification}
+
+        self.overflowed = False # with OVERFLOW_DISCONNECT
+        self.peak = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, msg):
+        status, res = msg
+
+        if status == "event" and len(self.messages) >= self.size:
+            if self.overflow == OVERFLOW_DISCONNECT:
+                self.overflowed = True
+                return
+            if self.overflow == OVERFLOW_COALESCE and res.id in self.pending:
+                pending = self.pending[res.id]
+                pending.content = pending.event.merge(pending.content, res.content)
+                self.coalesced += 1
+                return
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                for oldest in self.messages:
+                    if oldest[0] == "event":
+                        self.messages.remove(oldest)
+                        if self.pending.get(oldest[1].id) is oldest[1]:
+                            del self.pending[oldest[1].id]
+                        self.dropped += 1
+                        break
+
+        if status == "event":
+            res = Notification(res)
+            self.pending[res.id] = res
+
+        self.messages.append((status, res))
+        self.peak = max(self.peak, len(self.messages))
+
+    def get(self):
+        status, res = msg = self.messages.popleft()
+        if status == "event":
+            if self.pending.get(res.id) is res:
+                del self.pending[res.id]
+            res.content = res.event.complete(res.content)
+        self.sent += 1
+        return msg
+
+    def stats(self):
+        return {"queued": len(self.messages),
+                "peak": self.peak,
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped}
 
 
 class MinimalKB:
@@ -119,27 +357,109 @@ class MinimalKB:
     MEMORYPROFILE_DEFAULT = ""
     MEMORYPROFILE_SHORTTERM = "SHORTTERM"
 
-    def __init__(self, filename = None):
-        _api = [getattr(self, fn) for fn in dir(self) if hasattr(getattr(self, fn), "_api")]
-        self._api = {fn.__name__:fn for fn in _api}
+    # memory profile -> (capacity of the models, eviction policy)
+    MEMORYPROFILES = {MEMORYPROFILE_DEFAULT: (None, EVICTION_OLDEST),
+                      MEMORYPROFILE_SHORTTERM: (1000, EVICTION_LRU)}
+
+    REASONING_FORWARD = "forward"
+    REASONING_BACKWARD = "backward"
 
-        self.store = SQLStore()
+    SERVICES_PROCESSES = "processes"
+    SERVICES_INPROCESS = "inprocess"
+
+    def __init__(self, filename = None, database = "kb.db", follow = None, reasoning = REASONING_FORWARD, services = SERVICES_PROCESSES, defer_services = False, slow_requests = SLOW_REQUEST_THRESHOLD,
+                 outbound_queue_size = OUTBOUND_QUEUE_SIZE, overflow = OVERFLOW_COALESCE):
+        """
+        :param filename: an initial ontology to load (ignored for followers)
+        :param database: the SQLite database storing the knowledge base
+        :param follow: optionally, a (host, port) pair. If set, the KB is a
+        read replica of the primary minimalKB instance at this address:
+        reads are served from a local copy, synchronized with the primary's
+        change log, and writes are forwarded to the primary.
+        :param reasoning: 'forward' (default): the reasoner materializes the
+        consequences of the KB. 'backward': the closure of the taxonomy
+        (rdf:type, rdfs:subClassOf) is not materialized, but computed at
+        query time: less storage, slower queries.
+        :param services: 'processes' (default): the reasoner and the
+        lifespan manager run in their own processes. 'inprocess': they run
+        within the KB main loop (see 'process'), on the store's own
+        connection: no extra process nor copy of the KB, for small
+        platforms.
+        :param defer_services: if True, the services are started by the main
+        loop (see 'process') once the pending requests have been served, so
+        that the KB answers its first requests sooner.
+        :param slow_requests: the requests taking longer than this duration
+        (in sec) are logged, with the time they waited in the queue. None
+        disables the log.
+        :param outbound_queue_size: the number of messages that may wait to
+        be sent to a slow client, before its event notifications overflow
+        (see OutboundQueue).
+        :param overflow: what happens to the event notifications of a slow
+        client, once its outbound queue is full: 'coalesce' (default): they
+        are merged with the pending notifications of the same event (new
+        events are still queued), 'drop_oldest': the oldest pending
+        notifications are dropped, 'disconnect': the client is disconnected.
+        """
+        if reasoning not in [self.REASONING_FORWARD, self.REASONING_BACKWARD]:
+            raise KbServerError("Unknown reasoning mode <%s>" % reasoning)
+        self.reasoning = reasoning
+
+        if services not in [self.SERVICES_PROCESSES, self.SERVICES_INPROCESS]:
+            raise KbServerError("Unknown services mode <%s>" % services)
+        self.services = services
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise KbServerError("Unknown overflow policy <%s>" % overflow)
+        self.outbound_queue_size = outbound_queue_size
+        self.overflow = overflow
+        self.disconnected = 0
+
+        self.database = database
+        self.store = SQLStore(database, backward = (reasoning == self.REASONING_BACKWARD))
         #self.store = RDFlibStore()
 
         self.models = {DEFAULT_MODEL}
 
-        apilist = [key + (" (compatibility)" if hasattr(val, "_compat") else "") for key, val in self._api.items()]
+        if logger.isEnabledFor(logging.DEBUG):
+            apilist = [key + (" (compatibility)" if hasattr(val, "_compat") else "") for key, val in self._api.items()]
 
-        logger.debug("Initializing the MinimalKB with the following API: \n\t- " + \
-                "\n\t- ".join(apilist))
+            logger.debug("Initializing the MinimalKB with the following API: \n\t- " + \
+                    "\n\t- ".join(apilist))
 
         self.incomingrequests = Queue()
         self.requestresults = {}
 
         self.active_evts = set()
+        self.active_feeds = set()
+        self.active_bindings = {} # {id: BindingsEvent}
         self.eventsubscriptions = {}
 
-        self.start_services()
+        self.views = {} # materialized views: {name: View}
+        self.viewqueries = {} # {query key: view name}
+
+        self.group = None # pending group commit
+
+        # 'reason' requests waiting for the reasoner process: [{'client',
+        # 'head': last change to classify, 'deadline', 'held': the following
+        # requests of the client}], answered by 'process'
+        self.pending_reasons = []
+
+        self.profiling = False
+        self.profiles = deque(maxlen = PROFILE_BUFFER_SIZE)
+        self.slow_requests = slow_requests
+        self.sampler = None
+
+        self.services_started = False
+
+        self.follower = None
+        if follow:
+            # the primary runs the reasoner and the lifespan manager: their
+            # results are replicated with the other changes
+            self.follower = Follower(self, *follow)
+            return
+
+        if not defer_services:
+            self.start_services()
 
         if filename:
             self.load(filename)
@@ -151,13 +471,17 @@ class MinimalKB:
     @compat
     @api
     def stats(self):
-        return {"version": __version__}
+        return {"version": __version__,
+                "database": database_id(self.database)}
 
     @api
     def load(self, filename):
+        if self.follower:
+            return self.follower.forward("load", filename)
+
         logger.info("Loading triples from %s" % filename)
 
-        if hasRDFlib:
+        if import_rdflib():
             g = rdflib.Graph()
             nsm = rdflib.namespace.NamespaceManager(g)
             #namespace_manager.bind(DEFAULT_NAMESPACE[0], self.default_ns)
@@ -200,6 +524,17 @@ class MinimalKB:
 
     @api
     def clear(self):
+        """ Removes all the statements, in all the models. The models
+        created since the KB started are forgotten as well (the capacities
+        set with 'set_capacity' are kept).
+        """
+        self.models = {DEFAULT_MODEL}
+
+        if self.follower:
+            self.follower.forward("clear")
+            self.active_evts.clear()
+            return
+
         logger.warn("Clearing the knowledge base!")
         self.store.clear()
         self.active_evts.clear()
@@ -219,8 +554,14 @@ class MinimalKB:
         return self._api.keys()
 
     @api
-    def about(self, resource, models = None):
-        return self.store.about(resource, self.normalize_models(models))
+    def about(self, resource, models = None, limit = None):
+        """ Returns the statements involving the resource (as subject,
+        predicate or object).
+
+        'limit' optionally limits the number of statements for each role:
+        either an integer, or a dictionary like {"subject": 10, "object": 100}.
+        """
+        return self.store.about(resource, self.normalize_models(models), limit)
 
     @compat
     @api
@@ -228,15 +569,32 @@ class MinimalKB:
         return self.lookup(resource, models = [agent])
 
     @api
-    def lookup(self, resource, models = None):
-        logger.info("Lookup for " + str(resource) + \
+    def lookup(self, resource, models = None, fuzzy = False, limit = None):
+        """ Returns the list of (resource ID, type) matching 'resource',
+        either by ID or by label (rdfs:label).
+
+        If 'fuzzy' is true, 'resource' is matched against the labels of the
+        resources with a full-text search (for instance, 'the red cup' finds
+        the resource labelled 'red cup'), and the best 'limit' matches are
+        returned, best first.
+        """
+        logger.info(("Fuzzy lookup" if fuzzy else "Lookup") + " for " + str(resource) + \
                     " in " + (str(models) if models else "any model."))
         models = self.normalize_models(models)
-        about =  self.store.about(resource, models)
-        if not about:
-            return []
 
-        return [(resource, self.store.typeof(resource, models) )]
+        matches = []
+        if not fuzzy and self.store.about(resource, models):
+            matches.append(resource)
+
+        for match in self.store.search_labels(resource, models, fuzzy, limit):
+            if match not in matches:
+                matches.append(match)
+
+        if limit:
+            matches = matches[:limit]
+
+        types = self.store.typesof(matches, models)
+        return [(match, types[match]) for match in matches]
 
     @api
     def details(self, resource, models = None):
@@ -256,43 +614,76 @@ class MinimalKB:
                 {"name": "Classes","id": "classes", "values":[ids...]}
                 (only direct classes)
         """
+        return self.details_many([resource], models)[0]
+
+    @api
+    def details_many(self, resources, models = None):
+        """
+        Returns the list of the details of each of the resources (see
+        'details' for the format).
+
+        The taxonomy and the labels of all the resources are fetched in
+        batches, with a fixed number of queries independent of the number of
+        resources and of their instances or sub-classes.
+        """
         models = self.normalize_models(models)
-        res = {}
-        res["name"] = self.store.label(resource, models)
-        res["id"] = resource
-        res["type"] = self.store.typeof(resource, models)
-
-        if res["type"] == "class":
-            res["attributes"] = []
-            res["attributes"].append(
-                    {"name": "Parents",
-                     "id": "superClasses", 
-                     "values":
-                        [{"id":r, "name": self.store.label(r, models)}  for r in self.store.superclassesof(resource, True, models)]
-                    })
-
-            res["attributes"].append(
-                    {"name": "Children",
-                     "id": "subClasses", 
-                     "values":
-                        [{"id":r, "name": self.store.label(r, models)}  for r in self.store.subclassesof(resource, True, models)]
-                    })
-
-            res["attributes"].append(
-                    {"name": "Instances",
-                     "id": "instances", 
-                     "values":
-                        [{"id":r, "name": self.store.label(r, models)}  for r in self.store.instancesof(resource, True, models)]
-                    })
-
-        elif res["type"] == "instance":
-            res["attributes"] = [
-                    {"name": "Classes",
-                     "id": "classes", 
-                     "values":
-                        [{"id":r, "name": self.store.label(r, models)}  for r in self.store.classesof(resource, True, models)]
-                    }]
-        return res
+
+        types = self.store.typesof(resources, models)
+        classes = [r for r in resources if types[r] == "class"]
+        instances = [r for r in resources if types[r] == "instance"]
+
+        # only direct super/sub-classes and instances, assumed to be the
+        # asserted ones
+        superclasses = self.store.related(classes, "rdfs:subClassOf", models, assertedonly = True)
+        subclasses = self.store.related(classes, "rdfs:subClassOf", models, inverse = True, assertedonly = True)
+        classinstances = self.store.related(classes, "rdf:type", models, inverse = True, assertedonly = True)
+        instanceclasses = self.store.related(instances, "rdf:type", models, assertedonly = True)
+
+        concepts = set(resources)
+        for related in [superclasses, subclasses, classinstances, instanceclasses]:
+            for values in related.values():
+                concepts.update(values)
+        labels = self.store.labels(concepts, models)
+
+        def values(ids):
+            return [{"id":r, "name": labels[r]} for r in ids]
+
+        details = []
+        for resource in resources:
+            res = {}
+            res["name"] = labels[resource]
+            res["id"] = resource
+            res["type"] = types[resource]
+
+            if res["type"] == "class":
+                res["attributes"] = []
+                res["attributes"].append(
+                        {"name": "Parents",
+                         "id": "superClasses",
+                         "values": values(superclasses[resource])
+                        })
+
+                res["attributes"].append(
+                        {"name": "Children",
+                         "id": "subClasses",
+                         "values": values(subclasses[resource])
+                        })
+
+                res["attributes"].append(
+                        {"name": "Instances",
+                         "id": "instances",
+                         "values": values(classinstances[resource])
+                        })
+
+            elif res["type"] == "instance":
+                res["attributes"] = [
+                        {"name": "Classes",
+                         "id": "classes",
+                         "values": values(instanceclasses[resource])
+                        }]
+            details.append(res)
+
+        return details
 
     @compat
     @api
@@ -326,6 +717,12 @@ class MinimalKB:
 
         if isinstance(stmts, (str, unicode)):
             raise KbServerError("A list of statements is expected")
+
+        if self.follower:
+            self.follower.forward("revise", stmts, policy)
+            self.onupdate()
+            return
+
         stmts = [parse_stmt(s) for s in stmts]
 
         if type(policy) != dict:
@@ -338,13 +735,11 @@ class MinimalKB:
 
             logger.info("Adding to " + str(list(models)) + ":\n\t- " + "\n\t- ".join([str(s) for s in stmts]) + \
                     (" (lifespan: %ssec)"%lifespan if lifespan else ""))
-            for model in models:
-                self.store.add(stmts, model, lifespan=lifespan)
+            self.store.add(stmts, models, lifespan=lifespan)
 
         if policy["method"] == "retract":
             logger.info("Deleting from " + str(list(models)) +":\n\t- " + "\n\t- ".join([str(s) for s in stmts]))
-            for model in models:
-                self.store.delete(stmts, model)
+            self.store.delete(stmts, models)
 
         if policy["method"] in ["update", "safe_update", "revision"]:
 
@@ -352,8 +747,7 @@ class MinimalKB:
             
             logger.info("Updating " + str(list(models)) + " with:\n\t- " + "\n\t- ".join([str(s) for s in stmts]) + \
                     (" (lifespan: %ssec)"%lifespan if lifespan else ""))
-            for model in models:
-                self.store.update(stmts, model, lifespan=lifespan)
+            self.store.update(stmts, models, lifespan=lifespan)
 
 
         self.onupdate()
@@ -401,6 +795,48 @@ class MinimalKB:
                             "models": models,
                             "lifespan":  lifespan})
 
+    @api
+    def set_capacity(self, capacity, models = None, eviction = EVICTION_OLDEST, priorities = None):
+        """ Bounds the number of statements asserted in the models (all the
+        models if None). When a model exceeds its capacity, statements are
+        evicted according to 'eviction':
+        - 'oldest': the statements asserted first,
+        - 'lru': the statements about the least recently accessed
+          resources (through find, exist or about),
+        - 'priority': the statements whose predicate has the lowest priority
+          in 'priorities' ({predicate: priority}, 0 by default), then the
+          oldest ones.
+
+        The inferences depending on the evicted statements are removed as
+        well. A 'capacity' of None or 0 removes the bound.
+
+        With 'models' None, only the models that exist when 'set_capacity'
+        is called are bounded: the models created afterwards are not.
+        """
+        if self.follower:
+            return self.follower.forward("set_capacity", capacity, models, eviction, priorities)
+
+        if eviction not in EVICTION_POLICIES:
+            raise KbServerError("Unknown eviction policy <%s>" % eviction)
+
+        models = self.normalize_models(models)
+        logger.info("Capacity of " + str(list(models)) + ": %s statements (eviction: %s)" % (capacity, eviction))
+        self.store.set_capacity(models, capacity, eviction, priorities)
+        self.onupdate()
+
+    @api
+    def set_memory_profile(self, profile, models = None):
+        """ Applies one of the memory profiles (see MEMORYPROFILES) to the
+        models: the short-term profile (SHORTTERM) bounds them to 1000
+        statements, evicting the least recently accessed ones. The default
+        profile ('') does not bound them.
+        """
+        if profile not in self.MEMORYPROFILES:
+            raise KbServerError("Unknown memory profile <%s>" % profile)
+
+        capacity, eviction = self.MEMORYPROFILES[profile]
+        return self.set_capacity(capacity, models, eviction)
+
 
     @compat
     @api
@@ -422,7 +858,13 @@ class MinimalKB:
             instance, find(["?agent", "?action"], ["?agent desires ?action", "?action rdf:type Jump"])
             would return something like: [{"agent":"james", "action": "jumpHigh"}, {"agent": "laurel", "action":"jumpHigher"}]
 
-        Note that 'constraints' is currently not supported.
+        'constraints' is an optional list of filters that the variables must
+        satisfy, in a subset of the SPARQL FILTER syntax. For instance:
+        find(["?obj"], ["?obj hasDistance ?d", "?obj rdfs:label ?l"],
+             ["?d < 1.5", "strstarts(?l, 'red')"])
+        Supported: comparisons (=, !=, <, <=, >, >=) of variables, numbers,
+        dates, strings and resources; regex(), strstarts(), strends(),
+        contains(), lang(), langmatches(), str(), datatype(); &&, ||, !.
         '''
 
         models = self.normalize_models(models)
@@ -431,19 +873,218 @@ class MinimalKB:
 
         logger.info("Searching " + str(vars) + \
                     " in models " + str(models) + \
-                    " matching:\n\t- " + "\n\t- ".join([str(p) for p in patterns]))
-
-        res = self.store.query(vars, patterns, models)
+                    " matching:\n\t- " + "\n\t- ".join([str(p) for p in patterns]) + \
+                    ("\n  with constraints:\n\t- " + "\n\t- ".join(constraints) if constraints else ""))
+
+        name = self.viewqueries.get(self.query_key(vars, patterns, constraints, models))
+        if name is not None:
+            starttime = time.time()
+            res = self.read_view(self.views[name])
+            if self.profiling:
+                self.record_profile(vars, patterns, constraints, models, res,
+                                    {"view": name,
+                                     "statements": [],
+                                     "candidates": {},
+                                     "time": time.time() - starttime})
+            logger.info("Found (in view <%s>): %s" % (name, res))
+            return res
+
+        if self.profiling:
+            res, trace = self.store.query(vars, patterns, models, constraints, profile = True)
+            self.record_profile(vars, patterns, constraints, models, res, trace)
+        else:
+            res = self.store.query(vars, patterns, models, constraints)
         
         logger.info("Found: " + str(res))
         return res
 
+    @api
+    def explain(self, vars = None, patterns = None, constraints = None, models = None):
+        """ Profiles a query: performs it like 'find', and returns its
+        trace, as a dictionary:
+        - 'vars', 'patterns', 'constraints', 'models': the query,
+        - 'results': the results, 'rows': their number,
+        - 'time': the total duration of the query, in sec,
+        - 'candidates': {variable: number of candidate values}, for the
+          variables resolved by a simple pattern first,
+        - 'statements': the SQL statements executed, in order, as
+          dictionaries {'stage': function of sqlite_queries issuing it,
+          'sql', 'params', 'plan': the lines of its EXPLAIN QUERY PLAN,
+          'rows': number of rows returned, 'time': execution time}.
+
+        Without patterns, returns the traces of the last PROFILE_BUFFER_SIZE
+        queries recorded by the profiling mode (see 'set_profiling'), oldest
+        first.
+        """
+        if not patterns:
+            return list(self.profiles)
+
+        models = self.normalize_models(models)
+        patterns = [parse_stmt(p) for p in patterns]
+
+        res, trace = self.store.query(vars, patterns, models, constraints, profile = True)
+        return self.record_profile(vars, patterns, constraints, models, res, trace)
+
+    @api
+    def set_profiling(self, enabled = True):
+        """ Enables (or disables) the profiling mode: the traces of all
+        the queries performed by 'find' are recorded (see 'explain').
+        """
+        logger.info("Query profiling " + ("enabled" if enabled else "disabled"))
+        self.profiling = enabled
+
+    @api
+    def client_stats(self):
+        """ Returns the statistics of the outbound queues of the clients, as
+        a dictionary {'overflow': overflow policy, 'disconnected': number of
+        clients disconnected because of an overflow, 'clients': [{'client':
+        client address, 'queued': number of messages waiting, 'peak':
+        maximum number of messages waiting, 'sent', 'coalesced', 'dropped':
+        number of messages sent, coalesced and dropped}, ...]}.
+        """
+        clients = []
+        for client, outbound in self.requestresults.items():
+            stats = outbound.stats()
+            stats["client"] = str(getattr(client, "addr", None) or id(client))
+            clients.append(stats)
+
+        return {"overflow": self.overflow,
+                "disconnected": self.disconnected,
+                "clients": clients}
+
+    @api
+    def start_sampling(self, interval = SAMPLING_INTERVAL):
+        """ Starts sampling the stack of the KB main loop, every 'interval'
+        seconds of CPU time (see minimalkb.profiler). The previous samples
+        are discarded.
+        """
+        self.stop_sampling()
+        self.sampler = SamplingProfiler(interval)
+        self.sampler.start()
+
+    @api
+    def stop_sampling(self):
+        """ Stops the sampling profiler, and returns the samples as a list of
+        folded stacks ('frame;frame;... count'), that can be rendered as a
+        flame graph (eg, with FlameGraph's flamegraph.pl).
+        """
+        if self.sampler is None:
+            return []
+        self.sampler.stop()
+        return self.sampler.folded()
+
+    def record_profile(self, vars, patterns, constraints, models, res, trace):
+        trace.update({"vars": vars,
+                      "patterns": [" ".join(p) for p in patterns],
+                      "constraints": constraints,
+                      "models": sorted(models),
+                      "results": res,
+                      "rows": len(res)})
+        self.profiles.append(trace)
+        return trace
+
     @api
     def findmpe(self, vars, pattern, constraints = None, models = None):
         """ Finds the most probable explanation. Strictly equivalent to
         'find' until we support probabilities.
         """
-        return find(self, vars, pattern, constraints = None, models = None)
+        return self.find(vars, pattern, constraints, models)
+
+    @api
+    def register_view(self, name, vars, patterns, constraints = None, models = None):
+        """ Registers a query (same arguments as 'find') as a materialized
+        view: its results are computed once, then maintained incrementally
+        from the change log (see minimalkb.views), after every write and
+        every round of the reasoner.
+
+        The results are then read with 'view(name)', or with 'find' and the
+        same query, at a cost proportional to their number: no join is
+        performed. A view with the same name is replaced.
+
+        Views are kept in memory: they have to be registered again after
+        a restart of the KB.
+
+        Returns the number of results.
+        """
+        models = self.normalize_models(models)
+        patterns = [parse_stmt(p) for p in patterns]
+
+        allvars = {tok for p in patterns for tok in p if tok.startswith("?")}
+        if not set(vars) <= allvars:
+            raise KbServerError("Some variables of the view <%s> are not present in its patterns" % name)
+
+        self.drop_view(name)
+
+        starttime = time.time()
+        view = View(self.store, vars, patterns, models, constraints)
+        self.views[name] = view
+        self.viewqueries[self.query_key(vars, patterns, constraints, models)] = name
+
+        logger.info("View <%s> registered (%s results, computed in %.1fms)" % \
+                    (name, len(view.results), (time.time() - starttime) * 1000))
+        return len(view.counts)
+
+    @api
+    def drop_view(self, name):
+        """ Unregisters a materialized view. Returns False if there is no
+        view with this name.
+        """
+        if name not in self.views:
+            return False
+
+        del self.views[name]
+        for key, view in self.viewqueries.items():
+            if view == name:
+                del self.viewqueries[key]
+        logger.info("View <%s> dropped" % name)
+        return True
+
+    @api
+    def view(self, name):
+        """ Returns the results of a materialized view (see 'register_view'),
+        in the same format as 'find'.
+        """
+        if name not in self.views:
+            raise KbServerError("Unknown view <%s>" % name)
+        return self.read_view(self.views[name])
+
+    @api
+    def list_views(self):
+        """ Returns the materialized views, as a dictionary {name: {'vars',
+        'patterns', 'constraints', 'models', 'size': number of results}}.
+        """
+        return {name: {"vars": view.vars,
+                       "patterns": [" ".join(p) for p in view.patterns],
+                       "constraints": view.constraints,
+                       "models": sorted(view.models),
+                       "size": len(view.counts)}
+                for name, view in self.views.items()}
+
+    def query_key(self, vars, patterns, constraints, models):
+        return (tuple(sorted(vars)),
+                tuple(sorted(tuple(p) for p in patterns)),
+                tuple(constraints or ()),
+                frozenset(models))
+
+    def read_view(self, view):
+        """ Returns the results of a view, formatted like the results of
+        'find'. The changes not yet applied to the view (since the last
+        loop) are applied first.
+        """
+        view.update(self.store.head())
+
+        if self.store.returns_statements(view.vars, view.patterns, view.constraints):
+            pattern = view.patterns[0]
+            indices = [view.allvars.index(tok) if tok.startswith("?") else None for tok in pattern]
+            res = [[r[i] if i is not None else tok for i, tok in zip(indices, pattern)] for r in view.results]
+        elif len(view.vars) == 1:
+            res = [b[0] for b in view.counts]
+        else:
+            names = [v[1:] for v in view.vars]
+            res = [dict(zip(names, b)) for b in view.counts]
+
+        self.store.touch(value for b in view.counts for value in b)
+        return res
 
     @api
     def subscribe(self, type, trigger, var, patterns, models = None):
@@ -454,6 +1095,14 @@ class MinimalKB:
         logger.info("Registering a new event: %s %s for %s on %s" % (type, trigger, var, patterns) + \
                     " in " + (str(models) if models else "any model."))
 
+        if type == Event.NEW_BINDINGS:
+            # 'var': one or several variables (all the variables of the
+            # patterns if None)
+            vars = [var] if isinstance(var, basestring) else var
+            event = BindingsEvent(self, trigger, vars, patterns, models)
+            self.active_bindings.setdefault(event.id, event)
+            return event.id
+
         event = Event(self, type, trigger, var, patterns, models)
 
         self.active_evts.add(event)
@@ -465,6 +1114,129 @@ class MinimalKB:
     def registerEvent(self, type, trigger, patterns):
         return self.subscribe(type, trigger, None, patterns)
 
+    @api
+    def changes_since(self, seq = 0, limit = None):
+        """ Returns the changes (assertions, retractions, inferences and
+        expirations) recorded in the change log after the change 'seq'.
+
+        The result is a dictionary {'seq': last seq, 'resync': bool, 'changes': [[seq, op, s, p, o, model, inferred], ...]}.
+        If 'resync' is true, older changes have already been discarded and
+        the client needs to reload the whole KB.
+        """
+        return self.store.changes_since(seq, limit)
+
+    @api
+    def snapshot(self):
+        """ Returns the whole content of the KB, as a dictionary {'seq': seq,
+        'triples': [[s, p, o, model, inferred], ...]}. Used to initialize
+        replicas, that then apply the changes recorded after 'seq'.
+        """
+        return self.store.snapshot()
+
+    @api
+    def reasoner_stats(self):
+        """ Returns the statistics of the reasoner, as a dictionary {'runs':
+        number of classifications, 'rules': [{'rule': name, 'firings':
+        number of inferred statements, 'time': evaluation time in sec}, ...]},
+        the rules being sorted by decreasing evaluation time.
+        """
+        stats = self.store.rule_stats()
+        return {"runs": max([runs for rule, firings, t, runs in stats] or [0]),
+                "rules": [{"rule": rule, "firings": firings, "time": t} for rule, firings, t, runs in stats]}
+
+    @api
+    def reason(self, timeout = 5.):
+        """ Waits until the reasoner has classified the current content of
+        the KB, so that the following queries see the inferred statements.
+        Returns False if the reasoner did not complete within 'timeout'
+        seconds, True otherwise.
+
+        With in-process services, the KB is classified synchronously. When
+        requested by a client, the main loop is not blocked while the
+        reasoner process classifies the KB (see 'defer_reason').
+        """
+        if self.follower:
+            return self.follower.forward("reason", timeout)
+
+        if self.group is not None:
+            self.commit_group()
+
+        if not self.services_started:
+            self.start_services()
+
+        if self.services == self.SERVICES_INPROCESS:
+            return self.run_reasoner()
+
+        head = self.store.head()
+        self._reasoner_wakeup.set()
+
+        deadline = time.time() + timeout
+        with self._reasoner_classified:
+            while self._reasoner_progress.value < head:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.warn("The reasoner did not complete within %ssec" % timeout)
+                    return False
+                self._reasoner_classified.wait(remaining)
+        return True
+
+    def defer_reason(self, client, timeout = 5.):
+        """ Serves a 'reason' request of a client without waiting for the
+        reasoner process: the client is answered by 'answer_reasons', once
+        the current content of the KB has been classified, or after
+        'timeout' seconds. Its following requests are held until then (see
+        'serve'), so that its answers stay in order.
+        """
+        if self.group is not None:
+            self.commit_group()
+
+        if not self.services_started:
+            self.start_services()
+
+        self._reasoner_wakeup.set()
+        self.pending_reasons.append({"client": client,
+                                     "head": self.store.head(),
+                                     "deadline": time.time() + timeout,
+                                     "held": []})
+
+    def answer_reasons(self):
+        """ Answers the pending 'reason' requests whose changes have been
+        classified (True), or whose deadline has passed (False), and serves
+        the requests their clients sent in the meantime.
+        """
+        if not self.pending_reasons:
+            return
+
+        progress = self._reasoner_progress.value
+        now = time.time()
+        for pending in list(self.pending_reasons):
+            if progress >= pending["head"]:
+                res = True
+            elif now >= pending["deadline"]:
+                logger.warn("The reasoner did not complete within the timeout")
+                res = False
+            else:
+                continue
+
+            self.pending_reasons.remove(pending)
+            self.queue_message(pending["client"], ("ok", res))
+            for request in pending["held"]:
+                self.serve(*request)
+
+    @api
+    def subscribe_changes(self, seq = None):
+        """ Subscribes to the change log: every new change is pushed to the
+        client as an event (with the same content as 'changes_since').
+
+        If 'seq' is given, the changes recorded since 'seq' are sent first.
+        Returns the id of the subscription.
+        """
+        feed = ChangeFeed(self, self.store.head() if seq is None else seq)
+        logger.info("New subscription to the change log (%s), starting after change %s" % (feed.id, feed.seq))
+        self.active_feeds.add(feed)
+
+        return feed.id
+
 
     @compat
     @api
@@ -504,30 +1276,162 @@ class MinimalKB:
     ################################################################################
     ################################################################################
     def onupdate(self):
+        if self.group is not None:
+            # events are evaluated once the group is committed
+            self.group["updated"] = True
+            return
+
         for e in self.active_evts:
             if e.evaluate():
                 clients = self.eventsubscriptions[e.id]
                 logger.info("Event %s triggered. Informing %s clients." % (e.id, len(clients)))
                 for client in clients:
                     msg = ("event", e)
-                    self.requestresults.setdefault(client,Queue()).put(msg)
+                    self.queue_message(client, msg)
                 if not e.valid:
                     self.active_evts.discard(e)
 
+    def publish_changes(self):
+        """ Pushes the new changes to the change feeds, and updates the
+        NEW_BINDINGS subscriptions and the materialized views: once per loop,
+        whatever the number of changes.
+        """
+        if not (self.active_feeds or self.active_bindings or self.views) or self.group is not None:
+            return
+
+        head = self.store.head()
+        for view in self.views.values():
+            view.update(head)
+
+        for feed in self.active_feeds:
+            if feed.evaluate(head):
+                for client in self.eventsubscriptions.get(feed.id, []):
+                    self.queue_message(client, ("event", feed))
+
+        for event in self.active_bindings.values():
+            if event.evaluate(head):
+                clients = self.eventsubscriptions.get(event.id, [])
+                logger.info("Event %s triggered. Informing %s clients." % (event.id, len(clients)))
+                for client in clients:
+                    self.queue_message(client, ("event", event))
+                if not event.valid:
+                    del self.active_bindings[event.id]
+
     def start_services(self, *args):
-        self._reasoner = Process(target = start_reasoner, args = ('kb.db',))
+        if self.services_started:
+            return
+        self.services_started = True
+
+        if self.services == self.SERVICES_INPROCESS:
+            # the services share the store's connection, and are run by
+            # the main loop (see 'run_services')
+            self._reasoner_wakeup = threading.Event()
+            self.store.listeners.append(self._reasoner_wakeup.set)
+
+            self._reasoner = SQLiteSimpleRDFSReasoner(self.database,
+                                                      self.reasoning == self.REASONING_BACKWARD,
+                                                      self._reasoner_wakeup,
+                                                      conn = self.store.conn)
+            self._lifespan_manager = lifespan.SQLiteLifespanManager(self.database,
+                                                                    self.services_updated,
+                                                                    store = self.store)
+            self._next_cleaning = time.time()
+            self._next_classification = None
+            return
+
+        import multiprocessing
+
+        # the reasoner is woken up by the writes, and publishes the last
+        # change it has classified (see 'reason'). The progress is written
+        # under 'classified': it has no lock of its own, that the main loop
+        # could wait for forever if the reasoner died holding it (see
+        # 'answer_reasons')
+        self._reasoner_wakeup = multiprocessing.Event()
+        self._reasoner_progress = multiprocessing.Value("l", 0, lock = False)
+        self._reasoner_classified = multiprocessing.Condition()
+        self.store.listeners.append(self._reasoner_wakeup.set)
+
+        self._reasoner = multiprocessing.Process(target = start_reasoner,
+                                                 args = (self.database,
+                                                         self.reasoning == self.REASONING_BACKWARD,
+                                                         self._reasoner_wakeup,
+                                                         self._reasoner_progress,
+                                                         self._reasoner_classified))
         self._reasoner.start()
 
-        self._lifespan_manager = Process(target = lifespan.start_service, args = ('kb.db',))
+        self._lifespan_manager = multiprocessing.Process(target = lifespan.start_service,
+                                                         args = (self.database, self._reasoner_wakeup.set))
         self._lifespan_manager.start()
 
     def stop_services(self):
+        if self.group is not None:
+            self.commit_group()
+
+        if self.follower:
+            self.follower.stop()
+            return
+
+        if self.services == self.SERVICES_INPROCESS or not self.services_started:
+            return
+
         self._reasoner.terminate()
         self._lifespan_manager.terminate()
 
         self._reasoner.join()
         self._lifespan_manager.join()
 
+    def run_services(self):
+        """ Runs the in-process services that are due: the lifespan manager
+        every 1/CLEANING_RATE sec, and the reasoner REASONER_DEBOUNCE sec
+        after a write, once the pending requests have been served.
+        """
+        if self.follower or self.group is not None:
+            return
+
+        if not self.services_started:
+            if self.incomingrequests.empty():
+                self.start_services()
+            return
+
+        if self.services != self.SERVICES_INPROCESS:
+            return
+
+        if time.time() >= self._next_cleaning:
+            self._next_cleaning = time.time() + 1. / lifespan.CLEANING_RATE
+            self._lifespan_manager.clean()
+
+        if self._reasoner_wakeup.is_set():
+            if self._next_classification is None:
+                self._next_classification = time.time() + REASONER_DEBOUNCE
+            if time.time() >= self._next_classification and self.incomingrequests.empty():
+                self.run_reasoner()
+
+    def run_reasoner(self):
+        """ Classifies the KB with the in-process reasoner. Returns False if
+        the classification failed.
+        """
+        self._reasoner_wakeup.clear()
+        self._next_classification = None
+        try:
+            newstmts = self._reasoner.classify()
+        except sqlite3.OperationalError as e:
+            logger.warn("Classification failed (%s). Retrying." % e)
+            self._reasoner_wakeup.set()
+            return False
+
+        if newstmts:
+            self.services_updated()
+            # the reasoner's own writes do not need to be classified
+            self._reasoner_wakeup.clear()
+
+        return self._reasoner.seq is not None
+
+    def services_updated(self):
+        """ Called after the in-process services have modified the KB.
+        """
+        self.store.onupdate()
+        self.onupdate()
+
     def normalize_models(self, models):
         """ If 'models' is None, [] or contains 'all', then
         returns the set of all models known to the KB.
@@ -550,45 +1454,198 @@ class MinimalKB:
 
         if name == "close":
             logger.info("Closing connection to client.")
+            self.unsubscribe_client(client)
+            return
+
+        if name == "reason" and self.services == self.SERVICES_PROCESSES and not self.follower:
+            try:
+                self.defer_reason(client, *args, **kwargs)
+            except Exception as e:
+                logger.error("request failed: %s" % e)
+                self.queue_message(client, ("error", e))
             return
 
-        f = getattr(self, name)
-        if hasattr(f, "_compat"):
-                logger.warn("Using non-standard method %s. This may be " % f.__name__ + \
-                        "removed in the future!")
-        
         msg = None
         try:
-            res = None
-            if args or kwargs:
-                res = f(*args, **kwargs)
-                if name in ["subscribe", "registerEvent"]:
-                    self.eventsubscriptions.setdefault(res, []).append(client)
-            else:
-                res = f()
+            if self.follower and name not in LOCAL_REQUESTS:
+                self.follower.check()
+
+            f = getattr(self, name)
+            if hasattr(f, "_compat"):
+                    logger.warn("Using non-standard method %s. This may be " % f.__name__ + \
+                            "removed in the future!")
+
+            res = f(*args, **kwargs)
+            if name in ["subscribe", "registerEvent", "subscribe_changes"]:
+                self.eventsubscriptions.setdefault(res, []).append(client)
             msg = ("ok", res)
         except Exception as e:
             logger.debug(traceback.format_exc())
             logger.error("request failed: %s" % e)
             msg = ("error", e)
 
-        self.requestresults.setdefault(client,Queue()).put(msg)
+        if self.group is not None:
+            # acknowledged once the group is committed
+            self.group["failed"] |= (msg[0] == "error")
+            self.group["results"].append((client, msg))
+        else:
+            self.queue_message(client, msg)
+
+    def unsubscribe_client(self, client):
+        for clients in self.eventsubscriptions.values():
+            if client in clients:
+                clients.remove(client)
+        self.active_feeds = {f for f in self.active_feeds if self.eventsubscriptions.get(f.id)}
+        self.pending_reasons = [r for r in self.pending_reasons if r["client"] is not client]
+        self.requestresults.pop(client, None)
+        for id in self.active_bindings.keys():
+            if not self.eventsubscriptions.get(id):
+                del self.active_bindings[id]
+
+    def queue_message(self, client, msg):
+        if client not in self.requestresults:
+            self.requestresults[client] = OutboundQueue(self.outbound_queue_size, self.overflow)
+        self.requestresults[client].put(msg)
+
+    def send_messages(self):
+        """ Sends the queued messages to the clients, as long as their
+        output buffers are not full (if the clients tell: see
+        CLIENT_BACKLOG). Disconnects the clients whose outbound queue
+        overflowed, with the 'disconnect' policy.
+        """
+        for client, outbound in self.requestresults.items():
+            if outbound.overflowed:
+                logger.warn("Disconnecting a slow client (%s messages waiting)" % len(outbound))
+                self.unsubscribe_client(client)
+                self.disconnected += 1
+                client.close()
+                continue
+
+            backlog = getattr(client, "backlog", None)
+            while outbound and (backlog is None or backlog() < CLIENT_BACKLOG):
+                client.sendmsg(outbound.get())
+
+    def begin_group(self):
+        self.group = {"start": time.time(),
+                      "size": 0,
+                      "requests": [],
+                      "results": [],
+                      "failed": False,
+                      "updated": False}
+        self.store.begin_group()
+
+    def commit_group(self):
+        """ Commits the pending group of write requests, and acknowledges
+        them. If one of the requests (or the commit) fails, the whole group is
+        rolled back, and its requests are performed again one by one.
+        """
+        group, self.group = self.group, None
+
+        try:
+            if group["failed"]:
+                raise KbServerError("one of the requests failed")
+            started = time.time()
+            self.store.commit_group()
+            if self.slow_requests is not None and time.time() - started >= self.slow_requests:
+                logger.warn("Slow commit: group of %s requests (%s statements) took %.1fms" % \
+                                (len(group["requests"]), group["size"], (time.time() - started) * 1000))
+        except Exception as e:
+            logger.warn("Group commit of %s requests failed (%s). Performing them one by one." % (len(group["requests"]), e))
+            self.store.rollback_group()
+            for client, name, args, kwargs in group["requests"]:
+                self.execute(client, name, *args, **kwargs)
+            return
+
+        logger.debug("Committed %s requests (%s statements)" % (len(group["requests"]), group["size"]))
+        if group["updated"]:
+            self.onupdate()
+        for client, msg in group["results"]:
+            self.queue_message(client, msg)
+
+    def poll_timeout(self):
+        """ Returns how long the server may wait for incoming requests
+        before calling 'process' again.
+        """
+        if not self.incomingrequests.empty():
+            return 0
+        if self.group is None:
+            return 0.05
+        return max(0, self.group["start"] + GROUP_COMMIT_DELAY - time.time())
 
     def submitrequest(self, client, name, *args, **kwargs):
-        self.incomingrequests.put((client, name, args, kwargs))
+        self.incomingrequests.put((client, name, args, kwargs, time.time()))
+
+    def log_slow_request(self, name, args, kwargs, received, started):
+        duration = time.time() - started
+        if self.slow_requests is None or duration < self.slow_requests:
+            return
+
+        summary = ", ".join([repr(a) for a in args] + ["%s=%r" % kv for kv in kwargs.items()])
+        if len(summary) > 200:
+            summary = summary[:200] + "... (%s chars)" % len(summary)
+
+        logger.warn("Slow request: %s(%s) took %.1fms (queued for %.1fms)" % \
+                        (name, summary, duration * 1000, (started - received) * 1000))
+
+    def serve(self, client, name, args, kwargs, received):
+        """ Performs a request (or adds it to the pending group of writes).
+        The requests of a client waiting for the reasoner are held.
+        """
+        for pending in self.pending_reasons:
+            if pending["client"] is client and name != "close":
+                pending["held"].append((client, name, args, kwargs, received))
+                return
+
+        logger.debug("Processing <%s(%s,%s)>..." % \
+                        (name, 
+                         ", ".join([str(a) for a in args]),
+                         ", ".join(str(k)+"="+str(v) for k,v in kwargs.items())))
+
+        if self.group is not None and name not in WRITE_REQUESTS:
+            self.commit_group()
+
+        if name in WRITE_REQUESTS and not self.follower:
+            if self.group is None:
+                self.begin_group()
+            self.group["requests"].append((client, name, args, kwargs))
+            self.group["size"] += sum(len(a) for a in args if isinstance(a, list))
+
+        started = time.time()
+        self.execute(client, name, *args, **kwargs)
+        self.log_slow_request(name, args, kwargs, received, started)
+
+    def process(self, timeout = 0.05):
+        """ Serves the next incoming request, if any, and runs the rest of
+        the main loop.
+
+        :param timeout: how long to wait for a request (in seconds). The
+        server waits for requests on its sockets instead (see
+        'poll_timeout'), and passes 0.
+        """
+
+        if self.follower and self.follower.sync():
+            self.onupdate()
 
-    def process(self):
         try:
-            client, name, args, kwargs = self.incomingrequests.get(True, 0.05)
-            logger.debug("Processing <%s(%s,%s)>..." % \
-                            (name, 
-                             ", ".join([str(a) for a in args]),
-                             ", ".join(str(k)+"="+str(v) for k,v in kwargs.items())))
-            self.execute(client, name, *args, **kwargs)
+            if timeout:
+                self.serve(*self.incomingrequests.get(True, timeout))
+            else:
+                self.serve(*self.incomingrequests.get_nowait())
         except Empty:
             pass
 
-        for client, pendingmsg in self.requestresults.items():
-            while not pendingmsg.empty():
-                client.sendmsg(pendingmsg.get())
+        if self.group is not None and \
+           (self.group["size"] >= GROUP_COMMIT_SIZE or \
+            time.time() - self.group["start"] >= GROUP_COMMIT_DELAY):
+            self.commit_group()
+
+        self.publish_changes()
+
+        self.run_services()
+
+        self.answer_reasons()
+
+        self.send_messages()
 
+# the API, collected once at class definition: {name: method}
+MinimalKB._api = {name: fn for name, fn in vars(MinimalKB).items() if hasattr(fn, "_api")}
@@ -0,0 +1,74 @@
+import logging; logger = logging.getLogger("minimalKB."+__name__);
+
+# A statistical profiler for the KB main loop: a profiling timer (SIGPROF)
+# interrupts the process every 'interval' seconds of CPU time, and the stack
+# of the main thread is sampled. Cheap enough to be turned on on a running
+# server (see MinimalKB.start_sampling).
+#
+# The samples are output in the 'folded stacks' format of FlameGraph
+# (https://github.com/brendangregg/FlameGraph), also read by speedscope: one
+# line per distinct stack, with its frames from the outermost one, separated
+# by semicolons, followed by the number of samples:
+#
+#   <module> (minimalkb:243);process (kb.py:1089);execute (kb.py:1001) 12
+#
+# Signals are only delivered to the main thread: the KB must run in it. The
+# time spent waiting (for requests, or for a locked database) is not
+# sampled.
+
+import os
+import signal
+
+SAMPLING_INTERVAL = 0.005 # sec
+
+class SamplingProfiler:
+
+    def __init__(self, interval = SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks = {} # {folded stack: number of samples}
+        self.samples = 0
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        signal.signal(signal.SIGPROF, self.sample)
+        # system calls interrupted by the timer are restarted, instead of
+        # failing with EINTR (eg, in asyncore)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        logger.info("Sampling profiler started (one sample every %sms of CPU time)" % (self.interval * 1000))
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        logger.info("Sampling profiler stopped (%s samples)" % self.samples)
+
+    def sample(self, signum, frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+
+        stack = ";".join(reversed(frames))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def folded(self):
+        """ Returns the samples, as a list of folded stacks ('frame;frame;...
+        count'), by decreasing number of samples.
+        """
+        return ["%s %s" % (stack, count) for stack, count in \
+                    sorted(self.stacks.items(), key = lambda s: -s[1])]
+
+    def save(self, filename):
+        with open(filename, "w") as output:
+            for line in self.folded():
+                output.write(line + "\n")
+        logger.info("%s samples written to %s" % (self.samples, filename))
+
@@ -0,0 +1,214 @@
+import logging; logger = logging.getLogger("minimalKB."+__name__);
+
+import os
+import time
+import socket
+import threading
+from Queue import Queue, Empty
+
+from minimalkb.exceptions import KbServerError
+from minimalkb.framing import BinaryClient
+
+# delays before trying again to connect to a primary that went away: doubled
+# after each failed attempt, up to MAX_RECONNECT_DELAY
+RECONNECT_DELAY = 0.1 # sec
+MAX_RECONNECT_DELAY = 5 # sec
+
+def database_id(database):
+    """ Identifies a database file on a host, as [host name, absolute path]
+    (None for in-memory databases). Two KBs with the same id share their
+    database.
+    """
+    if database == ":memory:":
+        return None
+    return [socket.gethostname(), os.path.realpath(database)]
+
+
+class Follower:
+    """ Keeps a local replica of a primary minimalKB instance synchronized,
+    by applying the primary's change log to the local store.
+
+    The changes pushed by the primary are received by a background thread,
+    and applied to the store by 'sync', that must be called from the thread
+    that owns the store (typically, the KB main loop).
+
+    Writes are forwarded to the primary. They return only once the local
+    replica reflects them, so that clients read their own writes.
+
+    If the connection to the primary is lost, the follower connects again
+    (waiting longer after each failed attempt, see RECONNECT_DELAY), and
+    reloads the whole KB from the primary. Meanwhile, it is not in sync:
+    the requests fail (see 'check') instead of returning stale results.
+    """
+
+    def __init__(self, kb, host, port):
+        self.kb = kb
+        self.host = host
+        self.port = port
+
+        self.seq = 0
+
+        self.pending = Queue()
+
+        self.writer, self.stream = self.connect()
+
+        self.resync()
+        self.feed = self.stream.call("subscribe_changes", self.seq)
+
+        self.insync = True
+        self.running = True
+        self.receiver = threading.Thread(target = self.receive)
+        self.receiver.daemon = True
+        self.receiver.start()
+
+        logger.info("Following the knowledge base at %s:%s" % (host, port))
+
+    def connect(self):
+        """ Opens two connections to the primary: one for the requests, one
+        for the change feed.
+        """
+        # binary framing: snapshots and changes may be large, and contain
+        # arbitrary literals
+        writer = BinaryClient((self.host, self.port))
+
+        # loading the snapshot first clears the local KB: if it is the
+        # primary's own database, the primary would be wiped out (and the
+        # changes applied by the follower would be logged again by the
+        # primary, and sent back to the follower)
+        primary = writer.call("stats").get("database")
+        if primary is not None and primary == database_id(self.kb.database):
+            writer.close()
+            raise KbServerError("The primary KB at %s:%s uses the same database (%s): "
+                                "a follower needs its own database" % (self.host, self.port, self.kb.database))
+
+        return writer, BinaryClient((self.host, self.port))
+
+    def resync(self):
+        """ Reloads the whole KB from the primary.
+        """
+        self.load(self.writer.call("snapshot"))
+
+    def load(self, snapshot):
+        logger.info("Loading a snapshot of the primary KB (%s statements, up to change %s)" % (len(snapshot["triples"]), snapshot["seq"]))
+
+        self.kb.store.clear()
+        self.apply([[0, "add", s, p, o, model, inferred] for s, p, o, model, inferred in snapshot["triples"]])
+        self.seq = snapshot["seq"]
+
+    def receive(self):
+        while self.running:
+            try:
+                id, content = self.stream.readevent()
+            except (KbServerError, socket.error) as e:
+                if not self.running:
+                    return
+                logger.error("Lost the connection to the primary KB: %s" % e)
+                self.insync = False
+                self.reconnect()
+                continue
+
+            if id == self.feed:
+                self.pending.put(content)
+
+    def reconnect(self):
+        """ Connects again to the primary, and queues a snapshot of its KB
+        for 'sync', followed by the changes after the snapshot.
+        """
+        for client in [self.writer, self.stream]:
+            try:
+                client.close()
+            except socket.error:
+                pass
+
+        delay = RECONNECT_DELAY
+        while self.running:
+            time.sleep(delay)
+            try:
+                writer, stream = self.connect()
+            except (KbServerError, socket.error) as e:
+                logger.debug("Can not connect to the primary KB: %s" % e)
+                delay = min(2 * delay, MAX_RECONNECT_DELAY)
+                continue
+
+            try:
+                snapshot = writer.call("snapshot")
+                feed = stream.call("subscribe_changes", snapshot["seq"])
+            except (KbServerError, socket.error) as e:
+                logger.debug("Can not resync with the primary KB: %s" % e)
+                writer.sock.close()
+                stream.sock.close()
+                delay = min(2 * delay, MAX_RECONNECT_DELAY)
+                continue
+
+            logger.info("Connected again to the knowledge base at %s:%s" % (self.host, self.port))
+            self.writer, self.stream, self.feed = writer, stream, feed
+            self.pending.put({"snapshot": snapshot})
+            return
+
+    def check(self):
+        """ Raises a KbServerError if the local replica may be stale (the
+        connection to the primary is lost, or the KB not reloaded yet).
+        """
+        if not self.insync:
+            raise KbServerError("Not in sync with the primary KB at %s:%s: reconnecting" % (self.host, self.port))
+
+    def sync(self):
+        """ Applies the changes received from the primary. Returns True if
+        the local KB has been modified.
+        """
+        modified = False
+        while True:
+            try:
+                content = self.pending.get_nowait()
+            except Empty:
+                return modified
+
+            if "snapshot" in content:
+                self.load(content["snapshot"])
+                self.insync = True
+                modified = True
+                continue
+
+            if content["resync"]:
+                logger.warn("Changes have been missed. Reloading the whole KB from the primary.")
+                self.resync()
+                modified = True
+                continue
+
+            # changes already applied (eg, after a forwarded write) are skipped
+            changes = [c for c in content["changes"] if c[0] > self.seq]
+            if changes:
+                self.apply(changes)
+                self.seq = changes[-1][0]
+                modified = True
+
+    def forward(self, method, *args, **kwargs):
+        """ Forwards a request to the primary, and waits for the local
+        replica to catch up with the resulting changes.
+        """
+        self.check()
+        res = self.writer.call(method, *args, **kwargs)
+
+        # the primary commits the write before acknowledging it: the
+        # changes are therefore all available in its change log.
+        self.sync()
+        changes = self.writer.call("changes_since", self.seq)
+        if changes["resync"]:
+            self.resync()
+        elif changes["changes"]:
+            self.apply(changes["changes"])
+            self.seq = changes["seq"]
+
+        return res
+
+    def apply(self, changes):
+        self.kb.models |= {c[5] for c in changes if c[5]}
+        self.kb.store.apply_changes(changes)
+
+    def stop(self):
+        self.running = False
+        for client in [self.writer, self.stream]:
+            try:
+                client.close()
+            except socket.error:
+                pass
@@ -2,15 +2,24 @@ import logging; logger = logging.getLogger("minimalKB."+__name__);
 DEBUG_LEVEL=logging.DEBUG
 
 import time
-import datetime
 import sqlite3
 
 CLEANING_RATE = 2 #Hz
 
 class SQLiteLifespanManager:
 
-    def __init__(self, database = "kb.db"):
-        self.db = sqlite3.connect(database)
+    def __init__(self, database = "kb.db", onremoval = None, store = None):
+        """
+        :param onremoval: optional callable, called after expired statements
+        have been removed.
+        :param store: optional, an existing store on the database (eg, the
+        KB's one, when the manager runs within the KB process)
+        """
+        if store is None:
+            from minimalkb.backends.sqlite import SQLStore
+            store = SQLStore(database)
+        self.store = store
+        self.onremoval = onremoval
 
         self.running = True
         logger.info("Knowledge lifespan manager started. Running at %sHz" % CLEANING_RATE)
@@ -18,39 +27,40 @@ class SQLiteLifespanManager:
     ####################################################################
     ####################################################################
     def clean(self):
+        """ Removes the expired statements, and the inferences that depend
+        on them.
+        """
         starttime = time.time()
 
-        timestamp = datetime.datetime.now().isoformat()
+        expired = self.store.expire()
 
-        stmts_to_remove = [(row[0],) for row in self.db.execute(
-                '''SELECT hash FROM triples 
-                    WHERE (expires<?)
-                ''', (timestamp,))]
+        if expired:
+            logger.info("Cleaning %s stmts (took %fsec)." % (expired, time.time() - starttime))
 
-        if stmts_to_remove:
-            with self.db:
-                self.db.executemany('''DELETE FROM triples WHERE hash=?''', 
-                                    stmts_to_remove)
-
-
-            logger.info("Cleaning %s stmts (took %fsec)." % (len(stmts_to_remove), time.time() - starttime))
+            if self.onremoval:
+                self.onremoval()
 
     def __call__(self, *args):
 
         try:
             while self.running:
                 time.sleep(1./CLEANING_RATE)
-                self.clean()
+                try:
+                    self.clean()
+                except sqlite3.OperationalError as e:
+                    # eg, the database is locked by a long write, or the KB
+                    # is being cleared
+                    logger.warn("Cleaning failed (%s). Retrying." % e)
         except KeyboardInterrupt:
             return
 
 manager = None
 
-def start_service(db):
+def start_service(db, onremoval = None):
     global manager
 
     if not manager:
-        manager = SQLiteLifespanManager()
+        manager = SQLiteLifespanManager(db, onremoval)
     manager.running = True
     manager()
 
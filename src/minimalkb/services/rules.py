@@ -0,0 +1,435 @@
+import logging; logger = logging.getLogger("minimalKB."+__name__);
+DEBUG_LEVEL=logging.DEBUG
+
+# Forward-chaining rule engine.
+#
+# Rules are Horn clauses over triple patterns, like:
+#
+#   ?x rdf:type ?c1, ?c1 rdfs:subClassOf ?c2 -> ?x rdf:type ?c2
+#
+# The body of each rule is compiled once into SQL joins over an (in-memory)
+# table of facts. Rules are then evaluated up to a fixpoint with semi-naive
+# evaluation: at each iteration, only the joins involving at least one fact
+# derived at the previous iteration (the 'delta') are computed.
+#
+# The same evaluation makes it possible to extend a closed set of facts
+# incrementally: the new facts are the initial delta.
+#
+# Facts are removed as in the DRed algorithm: the caller removes the facts,
+# together with the derived facts that may depend on them (an
+# over-estimate). The removed facts that can still be derived in one step
+# from the remaining ones (the rules being evaluated with their head bound to
+# the removed facts) are derived again, and are the initial delta of the
+# semi-naive evaluation that re-derives the others.
+#
+# The facts are either a private copy, in an in-memory database, or an
+# existing table (typically, the KB's triples), the rules being then
+# evaluated in place.
+#
+# All the patterns of a rule are matched within the same model.
+
+import sqlite3
+import time
+
+FACTSTABLE = '''CREATE TABLE IF NOT EXISTS %s
+                    ("subject" TEXT NOT NULL ,
+                    "predicate" TEXT NOT NULL ,
+                    "object" TEXT NOT NULL ,
+                    "model" TEXT NOT NULL ,
+                    "lexical" TEXT ,
+                    "derived" INTEGER DEFAULT 0 NOT NULL ,
+                    PRIMARY KEY (subject, predicate, object, model))'''
+
+FACTSINDICES = ['''CREATE INDEX IF NOT EXISTS %s_po ON %s (predicate, object)''',
+                '''CREATE INDEX IF NOT EXISTS %s_ps ON %s (predicate, subject)''']
+
+# facts: all the facts; delta: facts derived at the previous iteration; new:
+# facts derived at the current iteration; candidates: removed facts, that may
+# still be derivable
+FACTS = "facts"
+DELTA = "delta_facts"
+NEW = "new_facts"
+CANDIDATES = "candidate_facts"
+
+COLUMNS = ["subject", "predicate", "object"]
+
+def parse_patterns(patterns):
+    return [tuple(p.split()) for p in patterns.split(",")]
+
+class Rule:
+    """ A rule, 'body -> head'. The variables listed in 'resources' must not
+    be bound to literals (for instance, because they become subjects in the
+    head).
+
+    'firings' counts the facts derived by the rule, and 'time' the time spent
+    evaluating it.
+    """
+
+    def __init__(self, name, rule, resources = []):
+        self.name = name
+
+        body, head = rule.split("->")
+        self.body = parse_patterns(body)
+        self.head = parse_patterns(head)
+        self.resources = resources
+
+        self.firings = 0
+        self.time = 0.
+
+        self._plans = {}
+        self._rederivations = {}
+
+    def __repr__(self):
+        return "%s: %s -> %s" % (self.name,
+                                 ", ".join(" ".join(p) for p in self.body),
+                                 ", ".join(" ".join(p) for p in self.head))
+
+    def plans(self, facts = FACTS):
+        """ Returns the compiled plans of the rule over the given table of
+        facts, as a dictionary {position of the delta in the body: plans}.
+        The plans for the position None evaluate the rule on the facts only.
+        """
+        if facts not in self._plans:
+            self._plans[facts] = {i: self.compile(i, facts) for i in range(len(self.body)) + [None]}
+        return self._plans[facts]
+
+    def compile(self, delta, facts = FACTS):
+        """ Compiles the rule into SQL statements inserting the facts derived
+        from the body, when the delta-th pattern is matched against the
+        delta (if 'delta' is None, all the patterns are matched against the
+        facts). Returns a list of (SQL, parameters), the parameters being a
+        function of the current run number.
+
+        The delta is joined first (CROSS JOIN forces the join order in
+        SQLite): it is usually much smaller than the facts, that are then
+        accessed through their indices.
+        """
+        tables = []
+        conditions = []
+        params = []
+        columns = {}  # variable -> SQL column
+        lexicals = {} # variable -> SQL column of the lexical form, for variables bound to objects
+
+        for i, pattern in enumerate(self.body):
+            alias = "t%s" % i
+            if i == delta:
+                tables.insert(0, "%s AS %s" % (DELTA, alias))
+            else:
+                tables.append("%s AS %s" % (facts, alias))
+            if i > 0:
+                conditions.append("%s.model=t0.model" % alias)
+
+            self.match(pattern, alias, columns, lexicals, conditions, params)
+
+        for var in self.resources:
+            if var in lexicals:
+                conditions.append("%s IS NULL" % lexicals[var])
+
+        # the facts of the KB are not indexed on (subject, predicate,
+        # object): the derived facts are looked up by subject, an object
+        # (eg, a class) having possibly many subjects
+        lookup = "f.object" if facts == FACTS else "+f.object"
+
+        plans = []
+        for pattern in self.head:
+            values = []
+            headparams = []
+            for term in pattern:
+                if term.startswith("?"):
+                    values.append(columns[term])
+                else:
+                    values.append("?")
+                    headparams.append(term)
+            lexical = lexicals.get(pattern[2], "NULL") if pattern[2].startswith("?") else "NULL"
+
+            sql = '''INSERT OR IGNORE INTO %s (subject, predicate, object, model, lexical, derived)
+                     SELECT DISTINCT %s, t0.model, %s, ? FROM %s
+                     WHERE %s AND NOT EXISTS
+                        (SELECT 1 FROM %s AS f WHERE f.subject=%s AND f.predicate=%s AND %s=%s AND f.model=t0.model)''' % \
+                    (NEW, ", ".join(values), lexical, (", " if delta is None else " CROSS JOIN ").join(tables),
+                     " AND ".join(conditions) if conditions else "1",
+                     facts, values[0], values[1], lookup, values[2])
+
+            plans.append((sql, lambda run, before = headparams, after = params + headparams: before + [run] + after))
+
+        return plans
+
+    def rederivations(self, facts = FACTS):
+        """ Returns the compiled plans deriving again the candidate facts
+        that follow from the facts (see 'compile_rederivation').
+        """
+        if facts not in self._rederivations:
+            self._rederivations[facts] = [self.compile_rederivation(head, facts) for head in self.head]
+        return self._rederivations[facts]
+
+    def compile_rederivation(self, head, facts = FACTS):
+        """ Compiles the rule into an SQL statement inserting the candidate
+        facts that match the given pattern of the head, and that the body
+        derives from the facts. Returns (SQL, parameters), as 'compile'.
+
+        The candidates are joined first: the variables of the head are bound
+        to their terms before the body is matched.
+        """
+        tables = []
+        conditions = []
+        params = []
+        columns = {}
+        lexicals = {}
+
+        self.match(head, "h", columns, lexicals, conditions, params)
+
+        for i, pattern in enumerate(self.body):
+            alias = "t%s" % i
+            tables.append("%s AS %s" % (facts, alias))
+            conditions.append("%s.model=h.model" % alias)
+
+            self.match(pattern, alias, columns, lexicals, conditions, params)
+
+        for var in self.resources:
+            if var in lexicals:
+                conditions.append("%s IS NULL" % lexicals[var])
+
+        lookup = "f.object" if facts == FACTS else "+f.object"
+
+        sql = '''INSERT OR IGNORE INTO %s (subject, predicate, object, model, lexical, derived)
+                 SELECT DISTINCT h.subject, h.predicate, h.object, h.model, h.lexical, ?
+                 FROM %s AS h CROSS JOIN %s
+                 WHERE %s AND NOT EXISTS
+                    (SELECT 1 FROM %s AS f WHERE f.subject=h.subject AND f.predicate=h.predicate AND %s=h.object AND f.model=h.model)''' % \
+                (NEW, CANDIDATES, ", ".join(tables), " AND ".join(conditions), facts, lookup)
+
+        return sql, lambda run, after = params: [run] + after
+
+    def match(self, pattern, alias, columns, lexicals, conditions, params):
+        """ Adds the conditions matching a pattern against the table
+        'alias', and binds the variables seen for the first time to its
+        columns.
+        """
+        for term, column in zip(pattern, COLUMNS):
+            ref = "%s.%s" % (alias, column)
+            if term.startswith("?"):
+                if term in columns:
+                    conditions.append("%s=%s" % (ref, columns[term]))
+                else:
+                    columns[term] = ref
+                if column == "object":
+                    lexicals.setdefault(term, "%s.lexical" % alias)
+            else:
+                conditions.append("%s=?" % ref)
+                params.append(term)
+
+# The supported subset of OWL 2 RL (rule names from the OWL 2 RL profile)
+RULES = [
+    # classes
+    Rule("cax-sco", "?x rdf:type ?c1, ?c1 rdfs:subClassOf ?c2 -> ?x rdf:type ?c2"),
+    Rule("scm-sco", "?c1 rdfs:subClassOf ?c2, ?c2 rdfs:subClassOf ?c3 -> ?c1 rdfs:subClassOf ?c3"),
+    Rule("cax-eqc1", "?x rdf:type ?c1, ?c1 owl:equivalentClass ?c2 -> ?x rdf:type ?c2"),
+    Rule("cax-eqc2", "?x rdf:type ?c2, ?c1 owl:equivalentClass ?c2 -> ?x rdf:type ?c1"),
+    Rule("scm-eqc-sco1", "?c1 owl:equivalentClass ?c2, ?c1 rdfs:subClassOf ?c3 -> ?c2 rdfs:subClassOf ?c3"),
+    Rule("scm-eqc-sco2", "?c1 owl:equivalentClass ?c2, ?c2 rdfs:subClassOf ?c3 -> ?c1 rdfs:subClassOf ?c3"),
+
+    # properties
+    Rule("prp-dom", "?p rdfs:domain ?c, ?x ?p ?y -> ?x rdf:type ?c"),
+    Rule("prp-rng", "?p rdfs:range ?c, ?x ?p ?y -> ?y rdf:type ?c", resources = ["?y"]),
+    Rule("prp-spo1", "?p1 rdfs:subPropertyOf ?p2, ?x ?p1 ?y -> ?x ?p2 ?y"),
+    Rule("scm-spo", "?p1 rdfs:subPropertyOf ?p2, ?p2 rdfs:subPropertyOf ?p3 -> ?p1 rdfs:subPropertyOf ?p3"),
+    Rule("prp-inv1", "?p1 owl:inverseOf ?p2, ?x ?p1 ?y -> ?y ?p2 ?x", resources = ["?y"]),
+    Rule("prp-inv2", "?p1 owl:inverseOf ?p2, ?x ?p2 ?y -> ?y ?p1 ?x", resources = ["?y"]),
+    Rule("prp-symp", "?p rdf:type owl:SymmetricProperty, ?x ?p ?y -> ?y ?p ?x", resources = ["?y"]),
+    Rule("prp-trp", "?p rdf:type owl:TransitiveProperty, ?x ?p ?y, ?y ?p ?z -> ?x ?p ?z"),
+
+    # built-in symmetric predicates
+    Rule("eq-sym", "?x owl:sameAs ?y -> ?y owl:sameAs ?x"),
+    Rule("prp-dif-sym", "?x owl:differentFrom ?y -> ?y owl:differentFrom ?x"),
+    Rule("cax-dw-sym", "?c1 owl:disjointWith ?c2 -> ?c2 owl:disjointWith ?c1"),
+]
+
+# Rules computing the closure of the taxonomy. They are not used in the
+# backward reasoning mode, where this closure is computed at query time.
+TAXONOMY_RULES = ["cax-sco", "scm-sco", "cax-eqc1", "cax-eqc2", "scm-eqc-sco1", "scm-eqc-sco2"]
+
+class RuleEngine:
+    """ Computes the closure of a set of facts under a set of rules, in an
+    in-memory SQLite database. The facts are kept between runs, so that new
+    facts can be added incrementally ('run', 'extend').
+
+    Alternatively, if a database connection 'db' is given, the rules are
+    evaluated over its table 'facts' (with at least the columns subject,
+    predicate, object, model and lexical), without copy ('infer'). The facts
+    derived at each iteration are passed to 'insert', that must add them to
+    this table.
+    """
+
+    def __init__(self, rules = RULES, db = None, facts = FACTS, insert = None):
+        self.rules = rules
+        self.runs = 0
+
+        self.facts = facts
+        self.insert = insert
+
+        if db:
+            self.db = db
+            tables = [DELTA, NEW, CANDIDATES]
+            temp = "TEMP "
+        else:
+            self.db = sqlite3.connect(':memory:')
+            tables = [FACTS, DELTA, NEW, CANDIDATES]
+            temp = ""
+
+        with self.db:
+            for table in tables:
+                self.db.execute((FACTSTABLE % table).replace("CREATE ", "CREATE " + temp))
+                for index in FACTSINDICES:
+                    self.db.execute(index % (table, table))
+
+    def run(self, facts):
+        """ Computes the facts entailed by the given facts (a list of
+        (subject, predicate, object, model, lexical)), and returns the ones
+        that are not part of them, as (subject, predicate, object, model).
+        The previous facts are discarded.
+        """
+        with self.db:
+            self.db.execute("DELETE FROM %s" % FACTS)
+        return self.extend(facts)
+
+    def extend(self, facts, removed = None):
+        """ Adds facts to the current (closed) set of facts, and returns the
+        newly entailed facts (as 'run').
+
+        'removed' are facts to remove first (same format), including the
+        derived facts that may depend on them. The ones that still follow
+        from the remaining facts are derived again, and returned as well.
+        """
+        self.runs += 1
+
+        with self.db:
+            for table in [DELTA, NEW]:
+                self.db.execute("DELETE FROM %s" % table)
+
+            if removed:
+                self.stage_candidates(removed)
+                self.db.execute('''DELETE FROM %s WHERE EXISTS
+                                    (SELECT 1 FROM %s AS c WHERE c.subject=%s.subject AND c.predicate=%s.predicate AND
+                                                                 c.object=%s.object AND c.model=%s.model)''' % \
+                                    (FACTS, CANDIDATES, FACTS, FACTS, FACTS, FACTS))
+
+            # the initial delta: the facts that are actually new...
+            self.db.executemany('''INSERT OR IGNORE INTO %s (subject, predicate, object, model, lexical)
+                                   VALUES (?, ?, ?, ?, ?)''' % DELTA, facts)
+            self.db.execute('''DELETE FROM %s WHERE EXISTS
+                                (SELECT 1 FROM %s AS f WHERE f.subject=%s.subject AND f.predicate=%s.predicate AND
+                                                             f.object=%s.object AND f.model=%s.model)''' % \
+                                (DELTA, FACTS, DELTA, DELTA, DELTA, DELTA))
+            self.db.execute("INSERT INTO %s SELECT * FROM %s" % (FACTS, DELTA))
+
+            # ...and the removed facts that still hold
+            if removed:
+                self.rederive()
+                self.db.execute("INSERT OR IGNORE INTO %s SELECT * FROM %s" % (FACTS, NEW))
+                self.db.execute("INSERT OR IGNORE INTO %s SELECT * FROM %s" % (DELTA, NEW))
+                self.db.execute("DELETE FROM %s" % NEW)
+
+            self.fixpoint(semi = True)
+
+            return self.db.execute('''SELECT subject, predicate, object, model FROM %s
+                                      WHERE derived=?''' % FACTS, (self.runs,)).fetchall()
+
+    def infer(self, facts = None, removed = None):
+        """ Evaluates the rules over an existing table of facts (see the
+        constructor), and returns the derived facts, as (subject, predicate,
+        object, model).
+
+        'facts' are the facts that have been added to the table (as
+        (subject, predicate, object, model, lexical)), the other ones being
+        already closed. If None, the whole table is closed.
+
+        'removed' are the facts that have been removed from the table,
+        including the derived facts that may depend on them (see 'extend').
+
+        Transactions are left to the caller.
+        """
+        self.runs += 1
+
+        for table in [DELTA, NEW]:
+            self.db.execute("DELETE FROM %s" % table)
+
+        if facts is not None:
+            self.db.executemany('''INSERT OR IGNORE INTO %s (subject, predicate, object, model, lexical)
+                                   VALUES (?, ?, ?, ?, ?)''' % DELTA, facts)
+
+        derived = []
+        def insert(new):
+            derived.extend((s, p, o, model) for s, p, o, model, lexical in new)
+            self.insert(new)
+
+        if facts is not None and removed:
+            self.stage_candidates(removed)
+            self.rederive()
+            insert(self.db.execute('''SELECT subject, predicate, object, model, lexical
+                                      FROM %s''' % NEW).fetchall())
+            self.db.execute("INSERT OR IGNORE INTO %s SELECT * FROM %s" % (DELTA, NEW))
+            self.db.execute("DELETE FROM %s" % NEW)
+
+        self.fixpoint(semi = facts is not None, insert = insert)
+        return derived
+
+    def stage_candidates(self, removed):
+        self.db.execute("DELETE FROM %s" % CANDIDATES)
+        self.db.executemany('''INSERT OR IGNORE INTO %s (subject, predicate, object, model, lexical)
+                               VALUES (?, ?, ?, ?, ?)''' % CANDIDATES, removed)
+
+    def rederive(self):
+        """ Derives again (in the table of new facts) the candidate facts
+        that follow in one step from the facts.
+        """
+        for rule in self.rules:
+            starttime = time.time()
+            fired = 0
+            for sql, params in rule.rederivations(self.facts):
+                fired += self.db.execute(sql, params(self.runs)).rowcount
+            rule.time += time.time() - starttime
+            rule.firings += fired
+
+    def fixpoint(self, semi, insert = None):
+        """ Evaluates the rules until no new fact is derived. If 'semi' is
+        False, the first iteration evaluates the rules on the whole set of
+        facts (instead of the delta).
+
+        The new facts are added to the facts with 'insert' if provided.
+        """
+        iterations = 0
+        while True:
+            iterations += 1
+            derived = 0
+            for rule in self.rules:
+                starttime = time.time()
+                fired = 0
+                for delta, plans in rule.plans(self.facts).items():
+                    if (delta is None) == semi:
+                        continue
+                    for sql, params in plans:
+                        fired += self.db.execute(sql, params(self.runs)).rowcount
+                rule.time += time.time() - starttime
+                rule.firings += fired
+                derived += fired
+
+            if not derived:
+                break
+            semi = True
+
+            if insert:
+                insert(self.db.execute('''SELECT subject, predicate, object, model, lexical
+                                          FROM %s''' % NEW).fetchall())
+            else:
+                self.db.execute("INSERT OR IGNORE INTO %s SELECT * FROM %s" % (FACTS, NEW))
+            self.db.execute("DELETE FROM %s" % DELTA)
+            self.db.execute("INSERT INTO %s SELECT * FROM %s" % (DELTA, NEW))
+            self.db.execute("DELETE FROM %s" % NEW)
+
+        logger.debug("Fixpoint reached after %s iterations" % iterations)
+
+    def stats(self):
+        """ Returns, for each rule, the number of facts it derived and the
+        time spent evaluating it (in seconds), since the engine started.
+        """
+        return [(rule.name, rule.firings, rule.time) for rule in self.rules]
@@ -4,207 +4,207 @@ DEBUG_LEVEL=logging.DEBUG
 import time
 import datetime
 import sqlite3
+import threading
 
-from minimalkb.backends.sqlite import sqlhash
-from minimalkb.kb import DEFAULT_MODEL
+from minimalkb.backends.sqlite import sqlhash, typed, \
+                                      CHANGELOGTABLENAME, TRIPLETABLENAME, RULESTATSTABLENAME
+from minimalkb.services.rules import RuleEngine, RULES, TAXONOMY_RULES
 
-REASONER_RATE = 5 #Hz
-
-class OntoClass:
-    def __init__(self, name):
-        self.name = name
-        self.parents = set()
-        self.children = set()
-        self.instances = set()
-        self.equivalents = set()
-
-    def __repr__(self):
-        return self.name + \
-               "\n\tParents: " + str(self.parents) + \
-               "\n\tChildren: " + str(self.children) + \
-               "\n\tInstances: " + str(self.instances)
+# The reasoner is woken up by the writes to the KB. The writes notified
+# within REASONER_DEBOUNCE are classified together. Without notification, the
+# change log is checked every REASONER_IDLE_PERIOD (for writes from other
+# processes).
+REASONER_DEBOUNCE = 0.01 # sec
+REASONER_IDLE_PERIOD = 1. # sec
 
 class SQLiteSimpleRDFSReasoner:
-
-    SYMMETRIC_PREDICATES = {"owl:differentFrom", "owl:sameAs", "owl:disjointWith"}
-
-    def __init__(self, database = "kb.db"):
-        self.db = sqlite3.connect(':memory:') # create a memory database
-        self.shareddb = sqlite3.connect(database)
-
-        # create the tables
-        # taken from http://stackoverflow.com/questions/4019081
-        query = None
-        for line in self.shareddb.iterdump():
-            if "triples" in line:
-                    query = line
-                    break
-        self.db.executescript(query)
+    """ Materializes the consequences of the KB under a subset of the OWL 2
+    RL rules (see services/rules.py).
+
+    The reasoner follows the change log of the shared database: new
+    assertions are incrementally added to the closure maintained by the rule
+    engine. The statements removed (retracted or expired, with the
+    inferences that the store invalidated together with them) are derived
+    again if they still hold. Only a cleared KB, or a truncated change log,
+    require the closure to be recomputed from the triples.
+
+    With 'backward', the closure of the taxonomy is not materialized (it is
+    computed at query time by the store).
+
+    'wakeup' is an event set to request a classification. After each
+    classification, the last change taken into account is stored in
+    'progress' (a shared integer), and 'classified' (a condition) is
+    notified.
+
+    If 'conn' (a connection to the database) is given, the rules are
+    evaluated directly over the triples, without copying them to a private
+    database. The reasoner must then be run from the thread that owns the
+    connection (see 'classify').
+    """
+
+    def __init__(self, database = "kb.db", backward = False, wakeup = None, progress = None, classified = None, conn = None):
+        self.shareddb = conn or sqlite3.connect(database)
+        self.inplace = conn is not None
+
+        rules = RULES
+        if backward:
+            rules = [rule for rule in RULES if rule.name not in TAXONOMY_RULES]
+
+        if self.inplace:
+            self.engine = RuleEngine(rules, db = conn, facts = TRIPLETABLENAME,
+                                     insert = lambda facts: self.insert([f[:4] for f in facts]))
+        else:
+            self.engine = RuleEngine(rules)
+
+        # last change of the log taken into account (None: the closure must
+        # be recomputed)
+        self.seq = None
+
+        self.wakeup = wakeup or threading.Event()
+        self.progress = progress
+        self.classified = classified
 
         self.running = True
-        logger.info("Reasoner (simple RDFS) started. Classification running at %sHz" % REASONER_RATE)
+        logger.info("Reasoner (OWL-RL subset) started, waiting for changes.")
 
     ####################################################################
     ####################################################################
     def classify(self):
-
+        """ Classifies the changes since the last classification, and
+        returns the inferred statements.
+        """
+        head = self.head()
+        if head == self.seq:
+            return []
 
         starttime = time.time()
-        self.copydb()
-
-        models = self.get_models()
-        newstmts = []
-
-        for model in models:
-            rdftype, subclassof = self.get_missing_taxonomy_stmts(model)
 
-            newstmts += [(i, "rdf:type", c, model) for i,c in rdftype]
-            newstmts += [(cc, "rdfs:subClassOf", cp, model) for cc,cp in subclassof]
-
-            newstmts += self.symmetric_statements(model)
+        if self.seq is None or self.needs_recompute(head):
+            logger.debug("Recomputing the closure of the KB")
+            facts = removed = None
+        else:
+            facts, removed = self.changes(head)
 
+        try:
+            if self.inplace:
+                with self.shareddb:
+                    newstmts = self.engine.infer(facts, removed)
+                    self.update_stats()
+                    # the inferred statements are already classified
+                    head = self.head()
+            else:
+                if facts is None:
+                    newstmts = self.engine.run(self.shareddb.execute(
+                                    '''SELECT subject, predicate, object, model, lexical
+                                       FROM %s''' % TRIPLETABLENAME).fetchall())
+                else:
+                    newstmts = self.engine.extend(facts, removed)
+                self.update_shared_db(newstmts)
+        except sqlite3.Error as e:
+            logger.warn("The reasoner could not write the inferred statements (%s). Retrying." % e)
+            self.seq = None
+            self.wakeup.set()
+            return []
+
+        self.seq = head
 
         if newstmts:
-            logger.debug("Reasoner added new statements to the knowledge base:\n -" +\
-                         "\n - ".join(["%s %s %s (in %s)" % stmt for stmt in newstmts]))
-
-            self.update_shared_db(newstmts)
-
+            logger.debug("Reasoner added %s new statements: %s" % (len(newstmts), newstmts))
             logger.info("Classification took %fsec." % (time.time() - starttime))
 
-    def get_models(self):
-        with self.db:
-            return [row[0] for row in self.db.execute("SELECT DISTINCT model FROM triples")]
-
-    def get_onto(self, db, model = DEFAULT_MODEL):
-
-        onto = {}
-
-        rdftype = None
-        subclassof = None
-        equivalentclasses = None
-        with db:
-            rdftype = {(row[0], row[1]) for row in db.execute(
-                    '''SELECT subject, object FROM triples 
-                       WHERE (predicate='rdf:type' AND model=?)
-                    ''', [model])}
-            subclassof = {(row[0], row[1]) for row in db.execute(
-                    '''SELECT subject, object FROM triples 
-                       WHERE (predicate='rdfs:subClassOf' AND model=?)
-                    ''', [model])}
-            equivalentclasses = {(row[0], row[1]) for row in db.execute(
-                    '''SELECT subject, object FROM triples 
-                       WHERE (predicate='owl:equivalentClass' AND model=?)
-                    ''', [model])}
-
-
-        for cc, cp in subclassof:
-            parent = onto.setdefault(cp, OntoClass(cp))
-            child = onto.setdefault(cc, OntoClass(cc))
-            child.parents.add(parent)
-            parent.children.add(child)
-
-        for i, c in rdftype:
-            onto.setdefault(c, OntoClass(c)).instances.add(i)
-
-        for ec1, ec2 in equivalentclasses:
-            equi1 = onto.setdefault(ec1, OntoClass(ec1))
-            equi2 = onto.setdefault(ec2, OntoClass(ec2))
-            equi1.equivalents.add(equi2)
-            equi2.equivalents.add(equi1)
-
-
-        return onto, rdftype, subclassof
-
-    def get_missing_taxonomy_stmts(self, model = DEFAULT_MODEL):
+        return newstmts
 
-        onto, rdftype, subclassof = self.get_onto(self.db, model)
-
-        newrdftype = set()
-        newsubclassof = set()
-
-        def addinstance(instance, cls):
-            newrdftype.add((instance, cls.name))
-            for p in cls.parents:
-                addinstance(instance, p)
-
-        def addsubclassof(scls, cls):
-            newsubclassof.add((scls.name, cls.name))
-            for p in cls.parents:
-                addsubclassof(scls, p)
-
-        for name, cls in onto.items():
-            for i in cls.instances:
-                addinstance(i, cls)
-            for p in cls.parents:
-                addsubclassof(cls, p)
-
-            for equivalent in cls.equivalents:
-                for i in cls.instances:
-                    addinstance(i, equivalent)
-                for p in cls.parents:
-                    addsubclassof(equivalent, p)
-
-
-        newrdftype -= rdftype
-        newsubclassof -= subclassof
-        return newrdftype, newsubclassof
-
-    def symmetric_statements(self, model):
-
-
-        with self.db:
-            stmts = {(row[0], row[1], row[2], model) for row in self.db.execute(
-                    '''SELECT subject, predicate, object FROM triples 
-                        WHERE (predicate IN ('%s') AND model=?)
-                        ''' % "', '".join(self.SYMMETRIC_PREDICATES), [model])}
-
-        return {(o, p, s, m) for s, p, o, m in stmts} - stmts # so we keep only the new symmetrical statements
+    def head(self):
+        return self.shareddb.execute("SELECT IFNULL(MAX(seq), 0) FROM %s" % CHANGELOGTABLENAME).fetchone()[0]
 
+    def needs_recompute(self, head):
+        """ Returns True if some changes since the last classification can
+        not be handled incrementally (the KB has been cleared, or changes
+        are missing from the log).
+        """
+        oldest, clears = self.shareddb.execute(
+                '''SELECT MIN(seq), SUM(op='clear')
+                   FROM %s WHERE seq>? AND seq<=?''' % CHANGELOGTABLENAME,
+                (self.seq, head)).fetchone()
 
+        return oldest is None or oldest > self.seq + 1 or clears > 0
 
+    def changes(self, head):
+        """ Returns the statements added and the statements removed since
+        the last classification, as two lists of (subject, predicate, object,
+        model, lexical). Only the last change of each statement counts.
+        """
+        last = {}
+        for op, s, p, o, model in self.shareddb.execute(
+                '''SELECT op, subject, predicate, object, model FROM %s
+                   WHERE seq>? AND seq<=? ORDER BY seq''' % CHANGELOGTABLENAME,
+                (self.seq, head)):
+            last[(s, p, o, model)] = op
+
+        added = []
+        removed = []
+        for (s, p, o, model), op in last.items():
+            (added if op == "add" else removed).append((s, p, o, model, typed(o)[0]))
+        return added, removed
 
     ######################################################################
     ######################################################################
-    def copydb(self):
-        """ Tried several other options (with ATTACH DATABASE -> that would likely lock the shared database as well, with iterdump, we miss the 'OR IGNORE')
-        """
-        res = self.shareddb.execute("SELECT * FROM triples")
-        with self.db:
-            self.db.execute("DELETE FROM triples")
-            self.db.executemany('''INSERT INTO triples
-                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                               res)
-
     def update_shared_db(self, stmts):
 
-        logger.debug("Reasoner added %s new statements: %s" % (len(stmts), stmts))
+        with self.shareddb:
+            self.insert(stmts)
+            self.update_stats()
 
+    def insert(self, stmts):
         timestamp = datetime.datetime.now().isoformat()
-        stmts = [[sqlhash(s,p,o,model), s, p, o, model, timestamp] for s,p,o,model in stmts]
+        stmts = [(sqlhash(s,p,o,model), s, p, o, model, timestamp) + typed(o) for s,p,o,model in stmts]
 
-        with self.shareddb:
-            self.shareddb.executemany('''INSERT OR IGNORE INTO triples
-                     (hash, subject, predicate, object, model, timestamp, inferred)
-                     VALUES (?, ?, ?, ?, ?, ?, 1)''', stmts)
+        self.shareddb.executemany('''INSERT OR IGNORE INTO triples
+                 (hash, subject, predicate, object, model, timestamp, inferred, lexical, datatype, lang, numeric)
+                 VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?)''', stmts)
+
+    def update_stats(self):
+        self.shareddb.executemany('''INSERT OR REPLACE INTO %s (rule, firings, time, runs)
+                                     VALUES (?, ?, ?, ?)''' % RULESTATSTABLENAME,
+                                  [(rule, firings, t, self.engine.runs) for rule, firings, t in self.engine.stats()])
+
+
+    def publish(self):
+        """ Publishes the last change taken into account, and notifies the
+        processes waiting for the classification.
+        """
+        if self.progress is None or self.seq is None:
+            return
 
+        with self.classified:
+            self.progress.value = self.seq
+            self.classified.notify_all()
 
     def __call__(self, *args):
 
         try:
             while self.running:
-                time.sleep(1./REASONER_RATE)
-                self.classify()
+                if self.wakeup.wait(REASONER_IDLE_PERIOD):
+                    time.sleep(REASONER_DEBOUNCE)
+                    self.wakeup.clear()
+                try:
+                    self.classify()
+                except sqlite3.OperationalError as e:
+                    # eg, the database is locked by a long write
+                    logger.warn("Classification failed (%s). Retrying." % e)
+                    time.sleep(REASONER_DEBOUNCE)
+                    self.wakeup.set()
+                self.publish()
         except KeyboardInterrupt:
             return
 
 reasoner = None
 
-def start_reasoner(db):
+def start_reasoner(db, backward = False, wakeup = None, progress = None, classified = None):
     global reasoner
 
     if not reasoner:
-        reasoner = SQLiteSimpleRDFSReasoner()
+        reasoner = SQLiteSimpleRDFSReasoner(db, backward, wakeup, progress, classified)
     reasoner.running = True
     reasoner()
 
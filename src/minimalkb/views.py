@@ -0,0 +1,173 @@
+import logging; logger = logging.getLogger("minimalKB."+__name__);
+
+# Incremental maintenance of the results of a query (a set of patterns, with
+# optional constraints), from the change log of the store.
+#
+# The results are the bindings of the variables of the patterns. After a
+# batch of changes:
+# - the new bindings all depend on an added statement: each pattern matching
+#   one of the added statements is joined, against these statements only,
+#   with the other patterns (see 'SQLStore.bindings'),
+# - the bindings that may have disappeared all match a removed statement:
+#   they are checked again.
+#
+# Changes that may affect the results without matching the patterns
+# (owl:sameAs statements, the taxonomy with backward reasoning, the clearing
+# of the KB), or a gap in the change log, cause the results to be computed
+# again.
+
+from minimalkb.backends.sqlite_queries import CLOSURES
+
+SAMEAS = "owl:sameAs"
+TAXONOMY = ["rdfs:subClassOf", "owl:equivalentClass", "rdf:type"]
+
+def is_variable(tok):
+    return tok.startswith("?")
+
+class View:
+
+    def __init__(self, store, vars, patterns, models, constraints = None):
+        """
+        :param vars: the variables (starting with '?') whose bindings are
+        maintained. If None, all the variables of the patterns.
+        :param patterns: list of (s, p, o) patterns
+        :param models: the set of models the patterns are matched in
+        """
+        self.store = store
+        self.patterns = patterns
+        self.models = models
+        self.constraints = constraints
+
+        # the bindings of all the variables are maintained ('results'), and
+        # projected on 'vars': {projected binding: number of results}
+        self.allvars = sorted({tok for p in patterns for tok in p if is_variable(tok)})
+        self.vars = sorted(vars) if vars else self.allvars
+        self.projection = [self.allvars.index(v) for v in self.vars]
+        # for each pattern, the indices of its variables in the results, and
+        # the results indexed by the values of these variables (to find the
+        # results depending on a removed statement)
+        self.patternvars = [sorted({self.allvars.index(tok) for tok in p if is_variable(tok)}) for p in self.patterns]
+        self.index = [{} for p in self.patterns]
+
+        self.seq = store.head()
+        self.results = set()
+        self.counts = {}
+        self.apply(store.bindings(self.allvars, patterns, models, constraints), set())
+
+    def bindings(self):
+        """ Returns the (projected) bindings, as a set of tuples of values of
+        'vars'.
+        """
+        return set(self.counts)
+
+    def match(self, pattern, stmt):
+        """ Returns the values of the variables of a pattern ({var: value})
+        matching a statement (s, p, o), or None.
+        """
+        values = {}
+        for tok, value in zip(pattern, stmt):
+            if not is_variable(tok):
+                if value not in self.store.equivalents(tok):
+                    return None
+            elif values.setdefault(tok, self.store.canonical(value)) != self.store.canonical(value):
+                return None
+        return values
+
+    def apply(self, added, removed):
+        """ Adds and removes results, and returns the (projected) bindings
+        that appeared and disappeared.
+        """
+        appeared, disappeared = set(), set()
+        for r in removed & self.results:
+            self.results.discard(r)
+            for index, vars in zip(self.index, self.patternvars):
+                key = tuple(r[j] for j in vars)
+                index[key].discard(r)
+                if not index[key]:
+                    del index[key]
+            b = tuple(r[i] for i in self.projection)
+            self.counts[b] -= 1
+            if not self.counts[b]:
+                del self.counts[b]
+                disappeared.add(b)
+        for r in added - self.results:
+            self.results.add(r)
+            for index, vars in zip(self.index, self.patternvars):
+                index.setdefault(tuple(r[j] for j in vars), set()).add(r)
+            b = tuple(r[i] for i in self.projection)
+            self.counts[b] = self.counts.get(b, 0) + 1
+            if self.counts[b] == 1:
+                appeared.add(b)
+        return appeared, disappeared
+
+    def update(self, head):
+        """ Applies the changes recorded in the change log up to 'head', and
+        returns the (projected) bindings that appeared and disappeared, as
+        two sets.
+        """
+        if head <= self.seq:
+            return set(), set()
+
+        log = self.store.changes_since(self.seq)
+        self.seq = log["seq"]
+
+        added, removed = [], []
+        recompute = log["resync"]
+        for seq, op, s, p, o, model, inferred in log["changes"]:
+            if op == "clear" or p == SAMEAS or \
+               (self.store.backward and p in TAXONOMY and any(pattern[1] in CLOSURES for pattern in self.patterns)):
+                recompute = True
+                break
+            if model not in self.models:
+                continue
+            if op == "add":
+                added.append((s, p, o, model))
+            else:
+                removed.append((s, p, o, model))
+
+        if recompute:
+            results = self.store.bindings(self.allvars, self.patterns, self.models, self.constraints)
+            disappeared = self.apply(set(), self.results - results)[1]
+            appeared = self.apply(results - self.results, set())[0]
+        else:
+            disappeared = self.apply(set(), self.removed(removed))[1]
+            appeared = self.apply(self.added(added), set())[0]
+
+        # bindings that disappeared and appeared again (or the reverse) did
+        # not change
+        return appeared - disappeared, disappeared - appeared
+
+    def removed(self, stmts):
+        """ Returns the results that do not hold anymore, after the removal
+        of the given statements.
+        """
+        # the results where a pattern matches a removed statement
+        candidates = set()
+        for stmt in stmts:
+            for pattern, index in zip(self.patterns, self.index):
+                values = self.match(pattern, stmt[:3])
+                if values is not None:
+                    candidates |= index.get(tuple(values[tok] for tok in sorted(values)), set())
+
+        removed = set()
+        for r in candidates:
+            values = dict(zip(self.allvars, r))
+            stmts = [tuple(values.get(tok, tok) for tok in p) for p in self.patterns]
+            if not self.store.holds(stmts, self.models):
+                removed.add(r)
+        return removed
+
+    def added(self, stmts):
+        """ Returns the results depending on the given added statements.
+        """
+        deltas = [i for i, pattern in enumerate(self.patterns) if \
+                    any(self.match(pattern, stmt[:3]) is not None for stmt in stmts)]
+
+        if not deltas:
+            return set()
+
+        self.store.stage_delta(stmts)
+        added = set()
+        for i in deltas:
+            added |= self.store.bindings(self.allvars, self.patterns, self.models, self.constraints, i)
+        return added
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Measures the startup time of the minimalKB server: the time between the
+launch of the process and its first answer to a client.
+"""
+
+import os
+import sys
+import time
+import socket
+import signal
+import tempfile
+import subprocess
+
+from minimalkb import __version__
+
+PORT = 6970
+
+def hello(port):
+    """ Returns True once the server at 'port' answers a 'hello' request.
+    """
+    try:
+        sock = socket.create_connection(("localhost", port))
+    except socket.error:
+        return False
+
+    try:
+        sock.sendall("hello\n#end#")
+        answer = ""
+        while not answer.endswith("#end#\n"):
+            data = sock.recv(4096)
+            if not data:
+                return False
+            answer += data
+        return answer.startswith("ok")
+    finally:
+        sock.close()
+
+def startup(server, db, port, timeout = 10.):
+    """ Starts a server, and returns the time (in sec) until it answers.
+    """
+    starttime = time.time()
+    process = subprocess.Popen([sys.executable, server, "-q", "-p", str(port), "--db", db])
+
+    try:
+        while not hello(port):
+            if time.time() - starttime > timeout:
+                raise RuntimeError("The server did not answer within %ssec" % timeout)
+            if process.poll() is not None:
+                raise RuntimeError("The server exited (code: %s)" % process.returncode)
+            time.sleep(0.001)
+        return time.time() - starttime
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait()
+
+def report(name, times):
+    times = sorted(times)
+    print("%s: min %.1fms, median %.1fms, max %.1fms" % \
+            (name, times[0] * 1000, times[len(times) // 2] * 1000, times[-1] * 1000))
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Startup benchmark for minimalKB.')
+    parser.add_argument('-v', '--version', action='version',
+                       version="minimalKB startup benchmark %s" % __version__, help='returns minimalKB version')
+    parser.add_argument('-n', '--runs', default=10, type=int,
+                                help='number of startups (default: 10)')
+    parser.add_argument('-p', '--port', default=PORT, type=int,
+                                help='port of the benchmarked server (default: %s)' % PORT)
+    parser.add_argument('--server', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin", "minimalkb"),
+                                help='minimalKB server script (default: the one of this source tree)')
+
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    db = os.path.join(tmpdir, "kb.db")
+
+    # first startup: the database is created
+    report("new database", [startup(args.server, db, args.port)])
+
+    report("existing database", [startup(args.server, db, args.port) for i in range(args.runs)])
+
+    os.remove(db)
+    os.rmdir(tmpdir)
@@ -91,11 +91,11 @@ class TestSequenceFunctions(unittest.TestCase):
         """ Requires a RDFS reasoner to run.
         """
         self.kb += ["alfred rdf:type Human", "Human rdfs:subClassOf Animal"]
-        time.sleep(REASONING_DELAY)
+        self.assertTrue(self.kb.reason())
         self.assertTrue('alfred rdf:type Animal' in self.kb)
 
         self.kb += ["Animal rdfs:subClassOf Thing"]
-        time.sleep(REASONING_DELAY)
+        self.assertTrue(self.kb.reason())
         self.assertTrue('alfred rdf:type Thing' in self.kb)
 
     def test_lookup(self):
@@ -159,6 +159,13 @@ class TestSequenceFunctions(unittest.TestCase):
         #    with self.assertRaises():
         #        self.kb += ["robert rel%s %s" % (i, val)]
 
+    def test_fuzzy_lookup(self):
+        self.kb += ["cup1 rdfs:label \"red cup\"@en", "cup2 rdfs:label \"blue mug\"", "cup1 rdf:type Cup"]
+
+        self.assertItemsEqual(self.kb.lookup("Red Cup"), [["cup1", "instance"]])
+        self.assertEqual(self.kb.lookup("the red cup", fuzzy = True, limit = 1), [["cup1", "instance"]])
+        self.assertEqual(self.kb.lookup("blue mgu", fuzzy = True)[0][0], "cup2")
+
     def test_retrieval(self):
 
         self.assertFalse(self.kb.about("Human"))
@@ -198,6 +205,17 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertItemsEqual(self.kb["?agent desires ?act", "?act rdf:type Action"], [{"agent":"nono", "act":"jump"}])
         self.assertItemsEqual(self.kb["?agent desires ?obj"], [{"agent":"alfred", "obj":"oil"}, {"agent":"nono", "obj":"jump"}])
 
+    def test_constraints(self):
+        self.kb += ["cup1 hasDistance 1.2", "cup2 hasDistance \"3\"^^xsd:double", "cup3 hasDistance 0.5"]
+        self.kb += ["cup1 rdfs:label \"red cup\"@en", "cup3 rdfs:label \"tasse rouge\"@fr"]
+
+        self.assertItemsEqual(self.kb.find(["?o"], ["?o hasDistance ?d"], ["?d < 1.5"]), ["cup1", "cup3"])
+        self.assertItemsEqual(self.kb.find(["?o"], ["?o hasDistance ?d"], ["?d >= 1.2", "?d <= 3"]), ["cup1", "cup2"])
+        self.assertItemsEqual(self.kb.find(["?o"], ["?o rdfs:label ?l"], ["strstarts(?l, 'red')"]), ["cup1"])
+        self.assertItemsEqual(self.kb.find(["?o"], ["?o rdfs:label ?l"], ["regex(?l, 'ROUGE$', 'i')"]), ["cup3"])
+        self.assertItemsEqual(self.kb.find(["?o"], ["?o rdfs:label ?l"], ["lang(?l) = 'en'"]), ["cup1"])
+        self.assertItemsEqual(self.kb.find(["?a"], ["?a hasDistance ?d1", "?b hasDistance ?d2"], ["?a != ?b", "?d1 > ?d2", "?b = cup1"]), ["cup2"])
+
     def test_update(self):
         self.kb += ["nono isNice true", "isNice rdf:type owl:FunctionalProperty"]
         self.assertItemsEqual(self.kb["* isNice true"], ['nono'])
@@ -383,6 +401,22 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(id, evtid)
         self.assertItemsEqual(value, [u"alfred"])
 
+    def test_changelog(self):
+
+        seq = self.kb.changes_since()["seq"]
+
+        self.kb += ["alfred rdf:type Human"]
+        self.kb -= ["alfred rdf:type Human"]
+
+        changes = self.kb.changes_since(seq)
+        self.assertFalse(changes["resync"])
+        self.assertEqual([c[1:5] for c in changes["changes"]],
+                         [["add", "alfred", "rdf:type", "Human"],
+                          ["retract", "alfred", "rdf:type", "Human"]])
+        self.assertEqual(changes["seq"], changes["changes"][-1][0])
+
+        self.assertFalse(self.kb.changes_since(changes["seq"])["changes"])
+
     def test_taxonomy_walking(self):
 
         self.assertFalse(self.kb.classesof("john"))
@@ -399,11 +433,11 @@ class TestSequenceFunctions(unittest.TestCase):
         self.kb += ["john rdf:type Human"]
         self.assertItemsEqual(self.kb.classesof("john"), [u'Human'])
         self.kb += ["Human rdfs:subClassOf Animal"]
-        time.sleep(REASONING_DELAY)
+        self.kb.reason()
         self.assertItemsEqual(self.kb.classesof("john"), [u'Human', u'Animal'])
         self.assertItemsEqual(self.kb.classesof("john", True), [u'Human'])
         self.kb -= ["john rdf:type Human"]
-        time.sleep(REASONING_DELAY)
+        self.kb.reason()
         self.assertFalse(self.kb.classesof("john"))
 
     def test_memory(self):
@@ -418,6 +452,58 @@ class TestSequenceFunctions(unittest.TestCase):
         time.sleep(0.6)
         self.assertFalse('john' in self.kb)
 
+    def test_capacity(self):
+
+        self.kb.set_capacity(10, ["episodic"])
+        try:
+            for i in range(20):
+                self.kb.add(["e%d happened yes" % i], ["episodic"])
+
+            events = self.kb.find(["?e"], ["?e happened yes"], None, ["episodic"])
+            self.assertTrue(len(events) <= 10)
+            self.assertIn("e19", events)
+            self.assertNotIn("e0", events)
+        finally:
+            self.kb.set_capacity(None, ["episodic"])
+
+    def test_client_stats(self):
+
+        stats = self.kb.client_stats()
+        self.assertEqual(stats["overflow"], "coalesce")
+        self.assertEqual(stats["disconnected"], 0)
+        for client in stats["clients"]:
+            self.assertEqual(client["dropped"], 0)
+
+    def test_explain(self):
+
+        self.kb += ["johnny rdf:type Human", "johnny likes icecream"]
+
+        trace = self.kb.explain(["?h"], ["?h rdf:type Human", "?h likes icecream"])
+        self.assertItemsEqual(trace["results"], ["johnny"])
+        self.assertEqual(trace["candidates"], {"?h": 1})
+        for statement in trace["statements"]:
+            self.assertEqual(statement["stage"], "simplequery")
+            self.assertTrue(statement["plan"])
+
+        self.assertEqual(self.kb.explain()[-1]["patterns"], ["?h rdf:type Human", "?h likes icecream"])
+
+    def test_views(self):
+
+        self.kb += ["johnny rdf:type Human", "johnny likes icecream"]
+
+        self.assertEqual(self.kb.register_view("fans", ["?h"], ["?h rdf:type Human", "?h likes icecream"]), 1)
+        self.assertItemsEqual(self.kb.view("fans"), ["johnny"])
+
+        self.kb += ["alfred rdf:type Human", "alfred likes icecream"]
+        self.assertItemsEqual(self.kb.view("fans"), ["johnny", "alfred"])
+        self.assertItemsEqual(self.kb.find(["?h"], ["?h rdf:type Human", "?h likes icecream"]), ["johnny", "alfred"])
+
+        self.kb -= ["johnny likes icecream"]
+        self.assertItemsEqual(self.kb.view("fans"), ["alfred"])
+
+        self.assertTrue(self.kb.drop_view("fans"))
+        self.assertFalse(self.kb.drop_view("fans"))
+
 
 def version():
     print("minimalKB tests %s" % __version__)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Tests the binary framing of the protocol, over the Unix socket transport
+('minimalkb --socket') and over TCP, after negotiation.
+"""
+
+import os
+import time
+import socket
+import shutil
+import unittest
+import tempfile
+
+from minimalkb import __version__
+from minimalkb import framing
+from minimalkb.framing import BinaryClient, KbServerError
+
+from test_replication import start_server, stop_server
+
+PORT = 6982
+
+class FramingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.tmpdir, "kb.sock")
+        self.server = start_server(PORT, "--db", os.path.join(self.tmpdir, "kb.db"), "--socket", self.socket)
+
+    def tearDown(self):
+        stop_server(self.server)
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self):
+        """ Returns a client, connected to the server with the transport
+        under test.
+        """
+        raise NotImplementedError
+
+    def assertRejected(self, client, data):
+        """ Sends raw bytes, and checks that the server answers with an error
+        and closes the connection.
+        """
+        client.sock.sendall(data)
+        msg = client.readmsg()
+        self.assertEqual(msg[0], "error")
+        self.assertIn("Invalid frame", msg[-1])
+        self.assertEqual(client.sock.recv(1), "")
+        client.sock.close()
+
+    def test_call(self):
+
+        client = self.connect()
+        client.call("add", ["johnny rdf:type Human"])
+        self.assertEqual(client.call("find", ["?h"], ["?h rdf:type Human"]), ["johnny"])
+
+        # a payload that does not decode is an error, but the frames are
+        # still in sync
+        client.sock.sendall(framing.HEADER.pack(framing.JSON, 3) + "[1,")
+        self.assertEqual(client.readmsg()[0], "error")
+        self.assertTrue(client.call("exist", ["johnny rdf:type Human"]))
+        client.close()
+
+    def test_disconnect(self):
+
+        client = self.connect()
+        client.call("subscribe", "NEW_INSTANCE", "ON_TRUE", "?h", ["?h rdf:type Human"])
+
+        # the connection is closed without a 'close' request: the server
+        # drops the client all the same
+        client.sock.close()
+        other = self.connect()
+        deadline = time.time() + 2
+        while len(other.call("client_stats")["clients"]) > 1:
+            self.assertLess(time.time(), deadline, "The closed connection was not dropped")
+            time.sleep(0.05)
+        other.call("add", ["johnny rdf:type Human"])
+        self.assertEqual(len(other.call("client_stats")["clients"]), 1)
+        other.close()
+
+    def test_unknown_codec(self):
+
+        client = self.connect()
+        self.assertRejected(client, framing.HEADER.pack("x", 2) + "[]")
+
+        # the server still serves the other clients
+        client = self.connect()
+        self.assertEqual(client.call("find", ["?h"], ["?h rdf:type Human"]), [])
+        client.close()
+
+    def test_frame_too_large(self):
+
+        client = self.connect()
+        # only the header is sent: the server does not wait for the payload
+        self.assertRejected(client, framing.HEADER.pack(framing.JSON, framing.MAX_FRAME_SIZE + 1))
+
+        client = self.connect()
+        self.assertEqual(client.call("find", ["?h"], ["?h rdf:type Human"]), [])
+        client.close()
+
+
+class TestUnixSocket(FramingTestCase):
+
+    def connect(self):
+        return BinaryClient(self.socket, framing.JSON)
+
+
+class TestTCP(FramingTestCase):
+
+    def connect(self):
+        return BinaryClient(("localhost", PORT), framing.JSON)
+
+    def test_negotiation(self):
+
+        sock = socket.create_connection(("localhost", PORT))
+        sock.sendall('framing\n"xml"\n#end#')
+        self.assertTrue(sock.recv(4096).startswith("error\n"))
+
+        # the connection is still usable with the text protocol
+        sock.sendall('exist\n["johnny rdf:type Human"]\n#end#')
+        self.assertEqual(sock.recv(4096), "ok\nfalse\n#end#\n")
+        sock.close()
+
+del FramingTestCase
+
+
+def version():
+    print("minimalKB tests %s" % __version__)
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Binary framing tests for minimalKB.')
+    parser.add_argument('-v', '--version', action='version',
+                       version=version(), help='returns minimalKB version')
+    parser.add_argument('-f', '--failfast', action='store_true',
+                                help='stops at first failed test')
+
+    args = parser.parse_args()
+
+    unittest.main(failfast=args.failfast)
@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Tests of the KB main loop (requests, group commit, services, events),
+with an embedded KB: the requests of fake clients are submitted and served
+with 'process', like the server does.
+"""
+
+import os
+import time
+import sqlite3
+import unittest
+import threading
+import tempfile
+
+from minimalkb import __version__
+from minimalkb.kb import MinimalKB, OutboundQueue, CLIENT_BACKLOG, \
+                         OVERFLOW_COALESCE, OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT
+
+class Client:
+    """ Collects the messages the KB sends to a client.
+    """
+    def __init__(self):
+        self.messages = []
+        self.closed = False
+
+    def sendmsg(self, msg):
+        self.messages.append(msg)
+
+    def close(self):
+        self.closed = True
+
+class KBTestCase(unittest.TestCase):
+
+    services = MinimalKB.SERVICES_INPROCESS
+
+    def setUp(self):
+        self.database = tempfile.mktemp(suffix = ".db")
+        self.kb = MinimalKB(database = self.database, services = self.services)
+
+    def tearDown(self):
+        self.kb.stop_services()
+        self.kb.store.conn.close()
+        os.remove(self.database)
+
+    def serve(self, timeout = 1):
+        """ Runs the main loop until the submitted requests are served (and
+        their groups of writes committed).
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.kb.process()
+            if self.kb.incomingrequests.empty() and self.kb.group is None:
+                self.kb.process()
+                return
+            time.sleep(self.kb.poll_timeout())
+        self.fail("The requests were not served in %s sec" % timeout)
+
+
+class TestProcess(KBTestCase):
+
+    def test_timeout(self):
+
+        # embedded users looping on 'process' wait for the requests...
+        started = time.time()
+        self.kb.process()
+        self.assertGreaterEqual(time.time() - started, 0.04)
+
+        # ...and are served as soon as a request comes
+        client = Client()
+        threading.Timer(0.02, self.kb.submitrequest, [client, "exist", ["johnny rdf:type Human"]]).start()
+        started = time.time()
+        self.kb.process(1)
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(client.messages, [("ok", False)])
+
+        # the server waits on its sockets instead
+        started = time.time()
+        self.kb.process(0)
+        self.assertLess(time.time() - started, 0.04)
+
+
+class TestGroupCommit(KBTestCase):
+
+    def committed(self):
+        """ Returns the statements visible to another connection.
+        """
+        conn = sqlite3.connect(self.database)
+        try:
+            return {row for row in conn.execute("SELECT subject, predicate, object FROM triples")}
+        finally:
+            conn.close()
+
+    def test_group(self):
+
+        clients = [Client() for i in range(3)]
+        for i, client in enumerate(clients):
+            self.kb.submitrequest(client, "add", ["robot%s rdf:type Robot" % i])
+        self.serve()
+
+        for client in clients:
+            self.assertEqual(client.messages, [("ok", None)])
+        self.assertEqual(self.committed(), {("robot%s" % i, "rdf:type", "Robot") for i in range(3)})
+
+    def test_failed_request(self):
+
+        good, bad = Client(), Client()
+        self.kb.submitrequest(good, "add", ["johnny rdf:type Human"])
+        self.kb.submitrequest(bad, "add", ["malformed statement"])
+        self.kb.submitrequest(good, "add", ["alfred rdf:type Human"])
+        self.kb.submitrequest(good, "retract", ["johnny rdf:type Human"])
+        self.kb.submitrequest(good, "add", ["batman rdf:type Human"])
+
+        # the group is performed, fails, and is rolled back: its requests
+        # are performed again, one by one
+        self.kb.process()
+        self.assertTrue(self.kb.group is not None)
+        self.serve()
+
+        self.assertEqual(good.messages, [("ok", None)] * 4)
+        self.assertEqual(len(bad.messages), 1)
+        self.assertEqual(bad.messages[0][0], "error")
+
+        self.assertEqual(self.committed(), {("alfred", "rdf:type", "Human"), ("batman", "rdf:type", "Human")})
+
+        # the rolled back writes left no trace in the change log
+        changes = [(op, s) for seq, op, s, p, o, model, inferred in self.kb.changes_since(0)["changes"] if not inferred]
+        self.assertEqual(changes, [("add", "johnny"), ("add", "alfred"), ("retract", "johnny"), ("add", "batman")])
+
+
+class Notified:
+    """ An event whose notifications are lists of values.
+    """
+    def __init__(self, id, content):
+        self.id = id
+        self.content = content
+
+    def merge(self, content, newer):
+        return content + newer
+
+    def complete(self, content):
+        return content
+
+class SlowClient(Client):
+    """ A client that does not read its messages.
+    """
+    def backlog(self):
+        return CLIENT_BACKLOG
+
+class TestOutboundQueue(unittest.TestCase):
+
+    def content(self, queue):
+        messages = []
+        while queue:
+            status, res = queue.get()
+            messages.append((status, res.id, res.content) if status == "event" else (status, res))
+        return messages
+
+    def test_coalesce(self):
+
+        queue = OutboundQueue(2, OVERFLOW_COALESCE)
+        queue.put(("ok", 1))
+        queue.put(("event", Notified("e1", [1])))
+        queue.put(("event", Notified("e1", [2])))
+        queue.put(("event", Notified("e2", [3])))
+        queue.put(("ok", 2))
+
+        # merged with the pending notification of the same event, if any
+        self.assertEqual(self.content(queue), [("ok", 1), ("event", "e1", [1, 2]), ("event", "e2", [3]), ("ok", 2)])
+        self.assertEqual(queue.stats()["coalesced"], 1)
+
+        # once sent, a notification is not merged anymore
+        queue.put(("event", Notified("e1", [4])))
+        queue.put(("event", Notified("e1", [5])))
+        self.assertEqual(self.content(queue), [("event", "e1", [4]), ("event", "e1", [5])])
+
+    def test_drop_oldest(self):
+
+        queue = OutboundQueue(2, OVERFLOW_DROP_OLDEST)
+        queue.put(("event", Notified("e1", [1])))
+        queue.put(("ok", 1))
+        queue.put(("event", Notified("e1", [2])))
+        queue.put(("ok", 2))
+
+        # the answers are never dropped
+        self.assertEqual(self.content(queue), [("ok", 1), ("event", "e1", [2]), ("ok", 2)])
+        self.assertEqual(queue.stats()["dropped"], 1)
+        self.assertEqual(queue.stats()["peak"], 3)
+
+    def test_disconnect(self):
+
+        queue = OutboundQueue(1, OVERFLOW_DISCONNECT)
+        queue.put(("ok", 1))
+        self.assertFalse(queue.overflowed)
+        queue.put(("event", Notified("e1", [1])))
+        self.assertTrue(queue.overflowed)
+        self.assertEqual(self.content(queue), [("ok", 1)])
+
+    def test_disconnect_client(self):
+
+        database = tempfile.mktemp(suffix = ".db")
+        kb = MinimalKB(database = database, services = MinimalKB.SERVICES_INPROCESS,
+                       outbound_queue_size = 1, overflow = OVERFLOW_DISCONNECT)
+        try:
+            slow, other = SlowClient(), Client()
+            kb.queue_message(slow, ("ok", 1))
+            kb.queue_message(slow, ("event", Notified("e1", [1])))
+            kb.queue_message(other, ("ok", 1))
+            kb.send_messages()
+
+            self.assertTrue(slow.closed)
+            self.assertFalse(slow.messages)
+            self.assertEqual(other.messages, [("ok", 1)])
+            self.assertEqual(kb.client_stats()["disconnected"], 1)
+            self.assertEqual(len(kb.client_stats()["clients"]), 1)
+        finally:
+            kb.store.conn.close()
+            os.remove(database)
+
+
+class TestClose(KBTestCase):
+
+    def test_close(self):
+
+        client = SlowClient()
+        self.kb.submitrequest(client, "subscribe", "NEW_INSTANCE", "ON_TRUE", "?h", ["?h rdf:type Human"])
+        self.serve()
+        self.assertIn(client, self.kb.requestresults)
+
+        # the subscriptions and the waiting messages of the client are dropped
+        self.kb.submitrequest(client, "close")
+        self.serve()
+        self.assertNotIn(client, self.kb.requestresults)
+        self.assertFalse([c for clients in self.kb.eventsubscriptions.values() for c in clients if c is client])
+
+        self.kb.add(["johnny rdf:type Human"])
+        self.kb.process()
+        self.assertNotIn(client, self.kb.requestresults)
+
+
+class TestBindings(KBTestCase):
+    """ NEW_BINDINGS subscriptions, notified once per loop.
+    """
+
+    def subscribe(self, trigger, vars, patterns):
+        self.client = Client()
+        self.kb.submitrequest(self.client, "subscribe", "NEW_BINDINGS", trigger, vars, patterns)
+        self.serve()
+        return self.client.messages.pop()[1]
+
+    def notifications(self):
+        """ Returns the notifications received since the last call, as a
+        list of (sorted added bindings, sorted removed bindings).
+        """
+        self.kb.process()
+        notifications = [(sorted(res.content["added"]), sorted(res.content["removed"])) \
+                            for status, res in self.client.messages if status == "event"]
+        self.client.messages = []
+        return notifications
+
+    def test_added_and_removed(self):
+
+        self.kb.add(["alfred looksAt cup"])
+        self.subscribe("ON_TRUE", None, ["?agent looksAt ?obj", "?obj isOn table"])
+        self.assertEqual(self.notifications(), [])
+
+        # all the changes of a loop are notified together
+        self.kb.add(["cup isOn table", "johnny looksAt cup", "johnny looksAt cup2"])
+        self.kb.add(["cup2 isOn table"])
+        self.assertEqual(self.notifications(), [([{"agent": "alfred", "obj": "cup"},
+                                                  {"agent": "johnny", "obj": "cup"},
+                                                  {"agent": "johnny", "obj": "cup2"}], [])])
+
+        self.kb.retract(["cup isOn table"])
+        self.kb.add(["alfred looksAt cup2"])
+        self.assertEqual(self.notifications(), [([{"agent": "alfred", "obj": "cup2"}],
+                                                 [{"agent": "alfred", "obj": "cup"},
+                                                  {"agent": "johnny", "obj": "cup"}])])
+
+        # a binding removed and added again in the same loop did not change
+        self.kb.retract(["johnny looksAt cup2"])
+        self.kb.add(["johnny looksAt cup2"])
+        self.kb.add(["alfred looksAt spoon"])
+        self.assertEqual(self.notifications(), [])
+
+    def test_projection(self):
+
+        self.subscribe("ON_TRUE", ["?agent"], ["?agent looksAt ?obj"])
+        self.kb.add(["alfred looksAt cup", "alfred looksAt spoon"])
+        self.assertEqual(self.notifications(), [([{"agent": "alfred"}], [])])
+
+        # the binding holds as long as one of the statements does
+        self.kb.retract(["alfred looksAt cup"])
+        self.assertEqual(self.notifications(), [])
+        self.kb.retract(["alfred looksAt spoon"])
+        self.assertEqual(self.notifications(), [([], [{"agent": "alfred"}])])
+
+    def test_recompute(self):
+
+        self.kb.add(["alfred looksAt cup", "mug isOn table"])
+        self.subscribe("ON_TRUE", None, ["?agent looksAt ?obj", "?obj isOn table"])
+
+        # owl:sameAs changes the bindings without matching the patterns
+        self.kb.add(["cup owl:sameAs mug"])
+        added = self.notifications()[0][0]
+        self.assertEqual(len(added), 1)
+        self.assertEqual(added[0]["agent"], "alfred")
+        self.assertIn(added[0]["obj"], ["cup", "mug"])
+
+        self.kb.retract(["cup owl:sameAs mug"])
+        self.assertEqual(self.notifications(), [([], added)])
+
+        self.kb.add(["cup isOn table"])
+        self.assertEqual(self.notifications(), [([{"agent": "alfred", "obj": "cup"}], [])])
+
+        self.kb.clear()
+        self.assertEqual(self.notifications(), [([], [{"agent": "alfred", "obj": "cup"}])])
+
+        self.kb.add(["johnny looksAt mug", "mug isOn table"])
+        self.assertEqual(self.notifications(), [([{"agent": "johnny", "obj": "mug"}], [])])
+
+    def test_one_shot(self):
+
+        id = self.subscribe("ONE_SHOT", None, ["?agent looksAt ?obj"])
+        self.kb.add(["alfred looksAt cup"])
+        self.assertEqual(self.notifications(), [([{"agent": "alfred", "obj": "cup"}], [])])
+        self.assertNotIn(id, self.kb.active_bindings)
+
+        self.kb.add(["johnny looksAt cup"])
+        self.assertEqual(self.notifications(), [])
+
+    def test_merge(self):
+
+        self.subscribe("ON_TRUE", None, ["?agent looksAt ?obj"])
+        event = self.kb.active_bindings.values()[0]
+
+        # coalesced notifications: a binding added then removed (or removed
+        # then added) is not notified
+        merged = event.merge({"added": [{"agent": "alfred", "obj": "cup"}, {"agent": "johnny", "obj": "cup"}],
+                              "removed": [{"agent": "alfred", "obj": "spoon"}]},
+                             {"added": [{"agent": "alfred", "obj": "spoon"}, {"agent": "alfred", "obj": "mug"}],
+                              "removed": [{"agent": "alfred", "obj": "cup"}]})
+        self.assertEqual(sorted(merged["added"]), [{"agent": "alfred", "obj": "mug"}, {"agent": "johnny", "obj": "cup"}])
+        self.assertEqual(merged["removed"], [])
+
+
+# (variables, patterns, constraints) of the query shapes read from views
+VIEW_QUERIES = [(["?obj"], ["?obj isOn table"], None),
+                (["?obj"], ["?obj isOn ?place"], None),
+                (["?obj", "?place"], ["?obj isOn ?place"], None),
+                (["?obj"], ["?obj isOn ?place"], ["?place != shelf"]),
+                (["?agent"], ["?agent looksAt ?obj", "?obj isOn table"], None),
+                (["?agent", "?obj"], ["?agent looksAt ?obj", "?obj isOn table"], None)]
+
+class TestViews(KBTestCase):
+
+    def assertSameResults(self):
+        """ 'find' returns the same results with and without the views.
+        """
+        for i, (vars, patterns, constraints) in enumerate(VIEW_QUERIES):
+            self.kb.drop_view("v%s" % i)
+            expected = sorted(self.kb.find(vars, patterns, constraints))
+            self.kb.register_view("v%s" % i, vars, patterns, constraints)
+            self.assertEqual(sorted(self.kb.find(vars, patterns, constraints)), expected, (vars, patterns))
+            self.assertEqual(sorted(self.kb.view("v%s" % i)), expected, (vars, patterns))
+
+    def test_query_shapes(self):
+
+        self.kb.add(["cup isOn table", "spoon isOn shelf", "fork isOn table",
+                     "alfred looksAt cup", "johnny looksAt spoon"])
+        self.assertSameResults()
+
+        # the statements are compared with their equivalents from now on
+        self.kb.add(["mug owl:sameAs cup", "johnny looksAt mug"])
+        self.assertSameResults()
+
+
+class TestModels(KBTestCase):
+
+    def test_clear(self):
+
+        self.kb.add(["e0 happened yes"], ["episodic"])
+        self.assertEqual(self.kb.models, {"default", "episodic"})
+
+        # the models are forgotten with their statements
+        self.kb.clear()
+        self.assertEqual(self.kb.models, {"default"})
+        self.assertEqual(self.kb.find(["?e"], ["?e happened yes"]), [])
+
+    def test_capacity_of_all_models(self):
+
+        self.kb.add(["e0 happened yes"], ["episodic"])
+        self.kb.set_capacity(10)
+
+        # only the existing models are bounded
+        self.kb.add(["e1 happened yes"], ["semantic"])
+        self.assertEqual(set(self.kb.store._capacities), {"default", "episodic"})
+
+
+class TestInProcessServices(KBTestCase):
+    """ The reasoner and the lifespan manager, run by the main loop.
+    """
+
+    def request(self, name, *args, **kwargs):
+        client = Client()
+        self.kb.submitrequest(client, name, *args, **kwargs)
+        self.serve()
+        self.assertEqual(len(client.messages), 1)
+        self.assertEqual(client.messages[0][0], "ok")
+        return client.messages[0][1]
+
+    def test_reasoning(self):
+
+        self.request("add", ["Human rdfs:subClassOf Animal", "johnny rdf:type Human", "alfred rdf:type Human"])
+        self.assertTrue(self.request("reason"))
+        self.assertEqual(sorted(self.request("find", ["?x"], ["?x rdf:type Animal"])), ["alfred", "johnny"])
+
+        self.request("retract", ["johnny rdf:type Human"])
+        self.assertTrue(self.request("reason"))
+        self.assertEqual(self.request("find", ["?x"], ["?x rdf:type Animal"]), ["alfred"])
+
+    def test_classified_by_main_loop(self):
+
+        # no explicit 'reason': the writes wake up the reasoner, run once
+        # the requests have been served
+        self.request("add", ["Human rdfs:subClassOf Animal", "johnny rdf:type Human"])
+        deadline = time.time() + 1
+        while not self.kb.exist(["johnny rdf:type Animal"]):
+            self.assertLess(time.time(), deadline, "Not classified by the main loop")
+            self.kb.process()
+            time.sleep(0.01)
+
+    def test_lifespan(self):
+
+        self.request("add", ["Human rdfs:subClassOf Animal", "alfred rdf:type Human"])
+        self.request("add", ["johnny rdf:type Human"], lifespan = 1)
+        self.assertTrue(self.request("reason"))
+        self.assertTrue(self.request("exist", ["johnny rdf:type Animal"]))
+
+        # the statement expires, with its inferences
+        deadline = time.time() + 3
+        while self.kb.exist(["johnny rdf:type Human"]):
+            self.assertLess(time.time(), deadline, "The statement did not expire")
+            self.kb.process()
+            time.sleep(0.05)
+
+        self.assertTrue(self.request("reason"))
+        self.assertFalse(self.request("exist", ["johnny rdf:type Animal"]))
+        self.assertTrue(self.request("exist", ["alfred rdf:type Animal"]))
+
+        changes = [(op, s, o) for seq, op, s, p, o, model, inferred in self.kb.changes_since(0)["changes"] if s == "johnny"]
+        self.assertIn(("expire", "johnny", "Human"), changes)
+        self.assertIn(("retract", "johnny", "Animal"), changes)
+
+
+class TestReason(KBTestCase):
+
+    services = MinimalKB.SERVICES_PROCESSES
+
+    def wait_for(self, client, timeout = 5):
+        """ Runs the main loop until the client gets an answer.
+        """
+        deadline = time.time() + timeout
+        while not client.messages:
+            if time.time() > deadline:
+                self.fail("No answer within %s sec" % timeout)
+            self.kb.process()
+            time.sleep(self.kb.poll_timeout())
+        return client.messages.pop(0)
+
+    def test_reason(self):
+
+        writer = Client()
+        self.kb.submitrequest(writer, "add", ["Human rdfs:subClassOf Animal", "johnny rdf:type Human"])
+        self.kb.submitrequest(writer, "reason")
+        self.kb.submitrequest(writer, "exist", ["johnny rdf:type Animal"])
+
+        self.assertEqual(self.wait_for(writer), ("ok", None))
+        self.assertEqual(self.wait_for(writer), ("ok", True))
+        self.assertEqual(self.wait_for(writer), ("ok", True))
+
+    def test_not_blocking(self):
+
+        self.kb.start_services()
+        self.kb._reasoner.terminate()
+        self.kb._reasoner.join()
+
+        # (the dead reasoner may have been waiting for its wake up event,
+        # that could not be set anymore: it is replaced)
+        self.kb.store.listeners.remove(self.kb._reasoner_wakeup.set)
+        self.kb._reasoner_wakeup = threading.Event()
+        self.kb.store.listeners.append(self.kb._reasoner_wakeup.set)
+
+        # the reasoner does not answer: the main loop still serves the other
+        # clients, until the request times out
+        waiting, other = Client(), Client()
+        self.kb.submitrequest(waiting, "add", ["johnny rdf:type Human"])
+        self.kb.submitrequest(waiting, "reason", 0.5)
+        self.kb.submitrequest(waiting, "exist", ["johnny rdf:type Human"])
+        self.kb.submitrequest(other, "exist", ["johnny rdf:type Human"])
+
+        started = time.time()
+        self.assertEqual(self.wait_for(waiting), ("ok", None))
+        self.assertEqual(self.wait_for(other), ("ok", True))
+        self.assertLess(time.time() - started, 0.4)
+
+        # ...and the following requests of the waiting client are held, to
+        # keep its answers in order
+        self.assertFalse(waiting.messages)
+        self.assertEqual(self.wait_for(waiting), ("ok", False))
+        self.assertGreaterEqual(time.time() - started, 0.5)
+        self.assertEqual(self.wait_for(waiting), ("ok", True))
+
+        # the pending requests of a client that closed its connection are
+        # dropped
+        self.kb.submitrequest(waiting, "reason")
+        self.kb.submitrequest(waiting, "close")
+        self.serve()
+        self.assertFalse(self.kb.pending_reasons)
+
+
+def version():
+    print("minimalKB tests %s" % __version__)
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Main loop tests for minimalKB.')
+    parser.add_argument('-v', '--version', action='version',
+                       version=version(), help='returns minimalKB version')
+    parser.add_argument('-f', '--failfast', action='store_true',
+                                help='stops at first failed test')
+
+    args = parser.parse_args()
+
+    unittest.main(failfast=args.failfast)
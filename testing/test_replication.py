@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Tests read replicas ('minimalkb --follow'), with a primary and a
+follower running as two local server processes.
+"""
+
+import os
+import sys
+import time
+import socket
+import signal
+import shutil
+import unittest
+import tempfile
+import subprocess
+
+from minimalkb import __version__
+from minimalkb.exceptions import KbServerError
+from minimalkb.framing import BinaryClient
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin", "minimalkb")
+
+PRIMARY_PORT = 6980
+FOLLOWER_PORT = 6981
+
+REPLICATION_DELAY = 0.2
+
+def start_server(port, *args):
+    """ Starts a minimalKB server, and waits until it accepts connections.
+    """
+    process = subprocess.Popen([sys.executable, SERVER, "-q", "-p", str(port)] + list(args))
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return process
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return process
+        except socket.error:
+            time.sleep(0.05)
+
+    stop_server(process)
+    raise RuntimeError("The server on port %s did not start" % port)
+
+def stop_server(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+        process.wait()
+
+class TestReplication(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.primary = start_server(PRIMARY_PORT, "--db", os.path.join(self.tmpdir, "kb.db"))
+        self.processes = [self.primary]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for process in self.processes:
+            stop_server(process)
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self, port):
+        client = BinaryClient(("localhost", port))
+        self.clients.append(client)
+        return client
+
+    def follow(self, *args):
+        follower = start_server(FOLLOWER_PORT, "--follow", "localhost:%s" % PRIMARY_PORT, *args)
+        self.processes.append(follower)
+        return follower
+
+    def test_follow(self):
+
+        primary = self.connect(PRIMARY_PORT)
+        primary.call("add", ["johnny rdf:type Human", "johnny likes icecream"])
+
+        self.follow()
+        follower = self.connect(FOLLOWER_PORT)
+
+        # initial snapshot
+        self.assertItemsEqual(follower.call("find", ["?h"], ["?h rdf:type Human"]), ["johnny"])
+
+        # changes of the primary are pushed to the follower
+        primary.call("add", ["alfred rdf:type Human"])
+        primary.call("retract", ["johnny likes icecream"])
+        time.sleep(REPLICATION_DELAY)
+        self.assertItemsEqual(follower.call("find", ["?h"], ["?h rdf:type Human"]), ["johnny", "alfred"])
+        self.assertFalse(follower.call("exist", ["johnny likes icecream"]))
+
+        # writes are forwarded to the primary, and visible on the follower
+        # as soon as they are acknowledged
+        follower.call("add", ["batman rdf:type Human"])
+        self.assertTrue(follower.call("exist", ["batman rdf:type Human"]))
+        self.assertTrue(primary.call("exist", ["batman rdf:type Human"]))
+
+    def wait_for(self, fn, expected, timeout = 10):
+        """ Calls 'fn' until it returns 'expected' (the KbServerErrors it
+        raises meanwhile are ignored).
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                res = fn()
+                if res == expected:
+                    return
+            except KbServerError as e:
+                res = e
+            self.assertLess(time.time(), deadline, "Last result: %s" % res)
+            time.sleep(0.05)
+
+    def test_restart_primary(self):
+
+        primary = self.connect(PRIMARY_PORT)
+        primary.call("add", ["johnny rdf:type Human"])
+        self.follow()
+        follower = self.connect(FOLLOWER_PORT)
+        self.assertTrue(follower.call("exist", ["johnny rdf:type Human"]))
+
+        # the primary goes away: the follower does not answer with stale
+        # results, nor accepts writes
+        self.clients.remove(primary)
+        primary.sock.close()
+        stop_server(self.primary)
+        deadline = time.time() + REPLICATION_DELAY * 10
+        while True:
+            try:
+                follower.call("exist", ["johnny rdf:type Human"])
+            except KbServerError as e:
+                self.assertIn("Not in sync", str(e))
+                break
+            self.assertLess(time.time(), deadline, "The follower still answers without its primary")
+            time.sleep(0.05)
+        self.assertRaises(KbServerError, follower.call, "add", ["batman rdf:type Human"])
+        self.assertEqual(follower.call("hello")[:9], "MinimalKB")
+
+        # the primary is restarted (and changed meanwhile): the follower
+        # connects again and reloads the KB
+        self.primary = start_server(PRIMARY_PORT, "--db", os.path.join(self.tmpdir, "kb.db"))
+        self.processes[0] = self.primary
+        primary = self.connect(PRIMARY_PORT)
+        primary.call("retract", ["johnny rdf:type Human"])
+        primary.call("add", ["alfred rdf:type Human"])
+
+        self.wait_for(lambda: follower.call("find", ["?h"], ["?h rdf:type Human"]), ["alfred"])
+
+        # ...and follows its changes, and forwards the writes again
+        primary.call("add", ["robin rdf:type Human"])
+        time.sleep(REPLICATION_DELAY)
+        self.assertItemsEqual(follower.call("find", ["?h"], ["?h rdf:type Human"]), ["alfred", "robin"])
+        follower.call("add", ["batman rdf:type Human"])
+        self.assertTrue(primary.call("exist", ["batman rdf:type Human"]))
+
+    def test_shared_database(self):
+
+        primary = self.connect(PRIMARY_PORT)
+        primary.call("add", ["johnny rdf:type Human"])
+        head = primary.call("changes_since", 0)["seq"]
+
+        # same directory, same (default) database file
+        follower = self.follow("--db", os.path.join(self.tmpdir, "kb.db"))
+        follower.wait()
+        self.assertNotEqual(follower.returncode, 0)
+
+        # the primary is left untouched
+        time.sleep(REPLICATION_DELAY)
+        self.assertTrue(primary.call("exist", ["johnny rdf:type Human"]))
+        self.assertEqual(primary.call("changes_since", 0)["seq"], head)
+
+
+def version():
+    print("minimalKB tests %s" % __version__)
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Replication tests for minimalKB.')
+    parser.add_argument('-v', '--version', action='version',
+                       version=version(), help='returns minimalKB version')
+    parser.add_argument('-f', '--failfast', action='store_true',
+                                help='stops at first failed test')
+
+    args = parser.parse_args()
+
+    unittest.main(failfast=args.failfast)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Tests of the rules of the reasoner (services/rules.py): the closure of
+the asserted statements, and its incremental maintenance when statements are
+retracted.
+
+Each case is checked with the rule engine alone (on its private copy of the
+facts), and through an embedded KB (the rules being then evaluated over the
+triples). The expected closure is always the one computed from scratch.
+"""
+
+import os
+import unittest
+import tempfile
+
+from minimalkb import __version__
+from minimalkb.kb import MinimalKB, parse_stmt
+from minimalkb.backends.sqlite import typed
+from minimalkb.services.rules import RuleEngine
+
+# name: (asserted statements, retracted statements, statements expected to
+# hold after the retraction, statements expected not to)
+CASES = {
+    "domain": (["likes rdfs:domain Human", "johnny likes icecream", "johnny likes ball", "alfred likes ball"],
+               ["johnny likes icecream", "alfred likes ball"],
+               ["johnny rdf:type Human"],
+               ["alfred rdf:type Human"]),
+    "range": (["likes rdfs:range Object", "johnny likes ball", "alfred likes ball", "alfred likes cup",
+               "johnny likes \"chocolate\""],
+              ["johnny likes ball", "alfred likes cup"],
+              ["ball rdf:type Object"],
+              ["cup rdf:type Object", "\"chocolate\" rdf:type Object"]),
+    "subPropertyOf": (["loves rdfs:subPropertyOf likes", "likes rdfs:subPropertyOf knows",
+                       "johnny loves mary", "johnny likes mary", "alfred likes batman"],
+                      ["johnny likes mary", "alfred likes batman"],
+                      ["johnny likes mary", "johnny knows mary", "loves rdfs:subPropertyOf knows"],
+                      ["alfred knows batman"]),
+    "inverseOf": (["hasParent owl:inverseOf hasChild", "alfred hasParent bruce", "bruce hasChild alfred",
+                   "dick hasParent bruce"],
+                  ["alfred hasParent bruce", "dick hasParent bruce"],
+                  ["alfred hasParent bruce"],
+                  ["bruce hasChild dick"]),
+    "transitive": (["ancestorOf rdf:type owl:TransitiveProperty",
+                    "a ancestorOf b", "b ancestorOf c", "c ancestorOf d", "a ancestorOf c"],
+                   ["b ancestorOf c"],
+                   ["a ancestorOf c", "a ancestorOf d"],
+                   ["b ancestorOf d", "b ancestorOf c"]),
+    "sameAs": (["a owl:sameAs b", "c owl:sameAs b", "d owl:sameAs e"],
+               ["a owl:sameAs b", "d owl:sameAs e"],
+               ["b owl:sameAs c"],
+               ["b owl:sameAs a", "e owl:sameAs d"]),
+    "schema": (["likes rdfs:domain Human", "likes rdfs:range Object", "johnny likes ball"],
+               ["likes rdfs:range Object"],
+               ["johnny rdf:type Human"],
+               ["ball rdf:type Object"]),
+}
+
+def facts(stmts, model = "default"):
+    return [(s, p, o, model, typed(o)[0]) for s, p, o in [parse_stmt(stmt) for stmt in stmts]]
+
+def statements(stmts):
+    return {tuple(parse_stmt(stmt)) for stmt in stmts}
+
+def closure(asserted):
+    """ The closure of the asserted statements, computed from scratch.
+    """
+    return {f[:3] for f in facts(asserted)} | {f[:3] for f in RuleEngine().run(facts(asserted))}
+
+
+class RulesTestCase(unittest.TestCase):
+
+    def check(self, name):
+        asserted, retracted, holds, gone = CASES[name]
+        remaining = [stmt for stmt in asserted if stmt not in retracted]
+
+        before, after = self.closures(asserted, retracted)
+
+        self.assertEqual(before, closure(asserted))
+        self.assertEqual(after, closure(remaining))
+        self.assertTrue(statements(holds) <= after)
+        self.assertFalse(statements(gone) & after)
+
+    def closures(self, asserted, retracted):
+        """ Returns the closures before and after the retraction.
+        """
+        raise NotImplementedError
+
+    def test_domain_range(self):
+        self.check("domain")
+        self.check("range")
+
+    def test_subpropertyof(self):
+        self.check("subPropertyOf")
+
+    def test_inverseof(self):
+        self.check("inverseOf")
+
+    def test_transitive(self):
+        self.check("transitive")
+
+    def test_sameas(self):
+        self.check("sameAs")
+
+    def test_schema(self):
+        self.check("schema")
+
+
+class TestEngine(RulesTestCase):
+
+    def closures(self, asserted, retracted):
+        engine = RuleEngine()
+        derived = engine.run(facts(asserted))
+        before = {f[:3] for f in facts(asserted)} | {f[:3] for f in derived}
+
+        # the retracted statements, and (over-estimating) all the derived
+        # ones: only the ones that still hold are derived again
+        removed = facts(retracted) + [(s, p, o, model, typed(o)[0]) for s, p, o, model in derived]
+        rederived = engine.extend([], removed)
+        self.assertTrue(set(rederived) <= set(derived) | {f[:4] for f in facts(retracted)})
+
+        after = {row for row in engine.db.execute("SELECT subject, predicate, object FROM facts")}
+        return before, after
+
+    def test_add_and_remove(self):
+
+        # statements removed and added in the same round
+        engine = RuleEngine()
+        engine.run(facts(["likes rdfs:domain Human", "johnny likes icecream"]))
+        engine.extend(facts(["alfred likes icecream"]),
+                      facts(["johnny likes icecream", "johnny rdf:type Human"]))
+        after = {row for row in engine.db.execute("SELECT subject, predicate, object FROM facts")}
+        self.assertEqual(after, closure(["likes rdfs:domain Human", "alfred likes icecream"]))
+
+
+class TestInPlace(RulesTestCase):
+
+    def setUp(self):
+        self.database = tempfile.mktemp(suffix = ".db")
+        self.kb = MinimalKB(database = self.database, services = MinimalKB.SERVICES_INPROCESS)
+
+        # the closure must never be recomputed from scratch after a
+        # retraction
+        self.full = 0
+        infer = self.kb._reasoner.engine.infer
+        def spy(facts = None, removed = None):
+            if facts is None:
+                self.full += 1
+            return infer(facts, removed)
+        self.kb._reasoner.engine.infer = spy
+
+    def tearDown(self):
+        self.kb.stop_services()
+        self.kb.store.conn.close()
+        os.remove(self.database)
+
+    def content(self):
+        return {row for row in self.kb.store.conn.execute("SELECT subject, predicate, object FROM triples")}
+
+    def closures(self, asserted, retracted):
+        self.kb.clear()
+        self.kb.add(asserted)
+        self.kb.reason()
+        before = self.content()
+
+        self.full = 0
+        self.kb.retract(retracted)
+        self.kb.reason()
+        self.assertEqual(self.full, 0)
+        return before, self.content()
+
+    def test_functional_update(self):
+
+        self.kb.add(["hasAge rdf:type owl:FunctionalProperty", "hasAge rdfs:domain Agent",
+                     "johnny hasAge 42"])
+        self.kb.reason()
+        self.full = 0
+        self.kb.update(["johnny hasAge 43"])
+        self.kb.reason()
+        self.assertEqual(self.full, 0)
+        self.assertEqual(self.content(), closure(["hasAge rdf:type owl:FunctionalProperty", "hasAge rdfs:domain Agent",
+                                                  "johnny hasAge 43"]))
+
+del RulesTestCase
+
+
+def version():
+    print("minimalKB tests %s" % __version__)
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Reasoner rules tests for minimalKB.')
+    parser.add_argument('-v', '--version', action='version',
+                       version=version(), help='returns minimalKB version')
+    parser.add_argument('-f', '--failfast', action='store_true',
+                                help='stops at first failed test')
+
+    args = parser.parse_args()
+
+    unittest.main(failfast=args.failfast)
@@ -0,0 +1,635 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Tests of the SQLite store, through an embedded KB whose services (the
+reasoner, the lifespan manager) run in-process: the tests do not need a
+running minimalKB server.
+"""
+
+import os
+import sqlite3
+import unittest
+import tempfile
+
+from minimalkb import __version__
+from minimalkb.kb import MinimalKB
+from minimalkb.backends.sqlite import MAX_PARAMS, LABEL_CANDIDATES
+from minimalkb.backends.sameas import SameAs
+from minimalkb.backends.sqlite_queries import simplequery, matchingstmt, query, joinquery
+
+class StoreTestCase(unittest.TestCase):
+
+    reasoning = MinimalKB.REASONING_FORWARD
+
+    def setUp(self):
+        self.database = tempfile.mktemp(suffix = ".db")
+        self.open()
+
+    def tearDown(self):
+        self.close()
+        os.remove(self.database)
+
+    def open(self):
+        self.kb = MinimalKB(database = self.database,
+                            reasoning = self.reasoning,
+                            services = MinimalKB.SERVICES_INPROCESS)
+        self.store = self.kb.store
+
+    def close(self):
+        self.kb.stop_services()
+        self.store.conn.close()
+
+    def changes(self, since):
+        """ Returns the statements changed after the change 'since', as a
+        set of (op, s, p, o) tuples.
+        """
+        return {(op, s, p, o) for seq, op, s, p, o, model, inferred in self.store.changes_since(since)["changes"]}
+
+
+class TestInvalidation(StoreTestCase):
+
+    def test_retract_dependents(self):
+
+        self.kb.add(["alfred rdf:type Human", "batman rdf:type Human", "Human rdfs:subClassOf Animal",
+                     "alfred likes icecream"])
+        self.kb.reason()
+        self.assertTrue(self.kb.exist(["alfred rdf:type Animal"]))
+        self.assertTrue(self.kb.exist(["batman rdf:type Animal"]))
+
+        # only the inference about alfred depends on the retracted statement
+        head = self.store.head()
+        self.kb.retract(["alfred rdf:type Human"])
+        self.assertEqual(self.changes(head), {("retract", "alfred", "rdf:type", "Human"),
+                                              ("retract", "alfred", "rdf:type", "Animal")})
+
+        # ...and it does not hold anymore
+        head = self.store.head()
+        self.kb.reason()
+        self.assertFalse(self.changes(head))
+        self.assertFalse(self.kb.exist(["alfred rdf:type Animal"]))
+        self.assertTrue(self.kb.exist(["batman rdf:type Animal"]))
+        self.assertTrue(self.kb.exist(["alfred likes icecream"]))
+
+    def test_retract_still_holds(self):
+
+        self.kb.add(["alfred rdf:type Human", "alfred rdf:type Robot",
+                     "Human rdfs:subClassOf Animal", "Robot rdfs:subClassOf Animal"])
+        self.kb.reason()
+
+        # still inferred from 'alfred rdf:type Robot'
+        self.kb.retract(["alfred rdf:type Human"])
+        self.kb.reason()
+        self.assertTrue(self.kb.exist(["alfred rdf:type Animal"]))
+
+    def test_retract_taxonomy(self):
+
+        self.kb.add(["alfred rdf:type Human", "Human rdfs:subClassOf Mammal", "Mammal rdfs:subClassOf Animal",
+                     "nemo rdf:type Fish", "Fish rdfs:subClassOf Animal"])
+        self.kb.reason()
+        self.assertTrue(self.kb.exist(["alfred rdf:type Animal"]))
+
+        # the inferences about the classes inheriting from Mammal (and their
+        # instances) depend on the retracted statement, the ones about Fish
+        # do not
+        head = self.store.head()
+        self.kb.retract(["Mammal rdfs:subClassOf Animal"])
+        changes = self.changes(head)
+        self.assertIn(("retract", "Human", "rdfs:subClassOf", "Animal"), changes)
+        self.assertIn(("retract", "alfred", "rdf:type", "Animal"), changes)
+        self.assertFalse([c for c in changes if "nemo" in c or "Fish" in c])
+
+        self.kb.reason()
+        self.assertFalse(self.kb.exist(["alfred rdf:type Animal"]))
+        self.assertTrue(self.kb.exist(["alfred rdf:type Mammal"]))
+        self.assertTrue(self.kb.exist(["nemo rdf:type Animal"]))
+
+
+# the triple table of minimalKB 0.7, before the typed literal columns
+LEGACY_TRIPLETABLE = '''CREATE TABLE triples
+                    ("hash" INTEGER PRIMARY KEY NOT NULL  UNIQUE ,
+                    "subject" TEXT NOT NULL ,
+                    "predicate" TEXT NOT NULL ,
+                    "object" TEXT NOT NULL ,
+                    "model" TEXT NOT NULL ,
+                    "timestamp" DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL ,
+                    "expires" DATETIME ,
+                    "inferred" BOOLEAN DEFAULT 0 NOT NULL)'''
+
+LITERALS = [("johnny", (None, None, None, None)),
+            ("42", ("42", "xsd:integer", None, 42.)),
+            ("-1.5", ("-1.5", "xsd:decimal", None, -1.5)),
+            ("1.", ("1.", "xsd:decimal", None, 1.)),
+            ("1e3", ("1e3", "xsd:double", None, 1000.)),
+            ("true", ("true", "xsd:boolean", None, None)),
+            ('"A que Johnny"', ("A que Johnny", None, None, None)),
+            ('"bonjour"@fr', ("bonjour", None, "fr", None)),
+            ('"2.5"^^xsd:float', ("2.5", "xsd:float", None, 2.5)),
+            ('"1970-01-02"^^xsd:date', ("1970-01-02", "xsd:date", None, 86400.)),
+            ('"1970-01-01T01:00:00+01:00"^^<http://www.w3.org/2001/XMLSchema#dateTime>',
+                ("1970-01-01T01:00:00+01:00", "xsd:dateTime", None, 0.))]
+
+class TestTypedLiterals(StoreTestCase):
+
+    def typedcolumns(self):
+        return {row[0]: tuple(row[1:]) for row in \
+                    self.store.conn.execute("SELECT object, lexical, datatype, lang, numeric FROM triples")}
+
+    def test_typed_columns(self):
+
+        self.kb.add(["johnny hasValue %s" % literal for literal, columns in LITERALS])
+        self.assertEqual(self.typedcolumns(), dict(LITERALS))
+
+        self.assertItemsEqual(self.kb.find(["?v"], ["johnny hasValue ?v"], ["?v > 0", "?v < 100"]),
+                              ["42", "1.", '"2.5"^^xsd:float'])
+
+    def test_migrate(self):
+
+        # a database created by a previous version of minimalKB
+        self.close()
+        os.remove(self.database)
+        conn = sqlite3.connect(self.database)
+        with conn:
+            conn.execute(LEGACY_TRIPLETABLE)
+            conn.executemany("INSERT INTO triples (hash, subject, predicate, object, model) VALUES (?, ?, ?, ?, 'default')",
+                             [(i, "johnny", "hasValue", literal) for i, (literal, columns) in enumerate(LITERALS)])
+        conn.close()
+
+        self.open()
+        self.assertEqual(self.typedcolumns(), dict(LITERALS))
+        self.assertItemsEqual(self.kb.find(["?v"], ["johnny hasValue ?v"], ["?v >= 1000", "?v < 2000"]), ["1e3"])
+
+        # the indices and triggers of the new tables are in place
+        self.kb.add(["johnny hasValue 7"])
+        self.assertItemsEqual(self.kb.find(["?v"], ["johnny hasValue ?v"], ["?v > 5", "?v < 50"]), ["7", "42"])
+        self.assertEqual(self.store.typeof("hasValue", ["default"]), "datatype_property")
+
+
+def legacy_typeof(store, concept, models):
+    """ 'typeof' as computed before the kinds index, from the statements.
+    """
+    classes = simplequery(store.conn, (concept, "rdf:type", "?class"), models)
+    if classes:
+        if "owl:ObjectProperty" in classes:
+            return "object_property"
+        elif "owl:DatatypeProperty" in classes:
+            return "datatype_property"
+        elif "owl:Class" in classes:
+            return "class"
+        elif store.is_literal(concept):
+            return "literal"
+        else:
+            return "instance"
+    if simplequery(store.conn, ("?instances", "rdf:type", concept), models) or \
+       simplequery(store.conn, ("?subclass", "rdfs:subClassOf", concept), models) or \
+       simplequery(store.conn, (concept, "rdfs:subClassOf", "?superclass"), models):
+        return "class"
+
+    stmts_if_predicate = matchingstmt(store.conn, ("?s", concept, "?o"), models)
+    if stmts_if_predicate:
+        if store.is_literal(stmts_if_predicate[0][3]):
+            return "datatype_property"
+        else:
+            return "object_property"
+
+    return "undefined"
+
+class TestKinds(StoreTestCase):
+
+    def resources(self):
+        return {r for stmt in self.store.conn.execute("SELECT subject, predicate, object FROM triples")
+                  for r in stmt} | {"unknown"}
+
+    def assertLegacyKinds(self, models = ["default"]):
+        resources = self.resources()
+        self.assertEqual(self.store.typesof(resources, models),
+                         {r: legacy_typeof(self.store, r, models) for r in resources})
+
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.kb.add(["johnny rdf:type Human", "Human rdfs:subClassOf Animal", "Animal rdf:type owl:Class",
+                     "likes rdf:type owl:ObjectProperty", "johnny likes icecream",
+                     "hasAge rdf:type owl:DatatypeProperty", "johnny hasAge 42",
+                     "loves rdfs:subPropertyOf likes", "alfred loves batman", "alfred hasName \"Alfred\"",
+                     "R2D2 rdf:type Robot", "Robot rdfs:subClassOf Machine"])
+        self.kb.add(["nemo rdf:type Fish", "nemo swimsIn sea"], models = ["fishes"])
+        self.kb.reason()
+
+    def test_kinds(self):
+
+        self.assertLegacyKinds()
+        self.assertLegacyKinds(["fishes"])
+        self.assertLegacyKinds(["default", "fishes"])
+        self.assertEqual(self.store.typeof("johnny", ["default"]), "instance")
+        self.assertEqual(self.store.typeof("Animal", ["default"]), "class")
+        self.assertEqual(self.store.typeof("loves", ["default"]), "object_property")
+        self.assertEqual(self.store.typeof("hasName", ["default"]), "datatype_property")
+
+        self.kb.retract(["R2D2 rdf:type Robot", "Animal rdf:type owl:Class", "alfred hasName \"Alfred\""])
+        self.kb.retract(["nemo swimsIn sea"], models = ["fishes"])
+        self.kb.reason()
+        self.assertLegacyKinds()
+        self.assertLegacyKinds(["default", "fishes"])
+        self.assertEqual(self.store.typeof("hasName", ["default"]), "undefined")
+        self.assertEqual(self.store.typeof("swimsIn", ["fishes"]), "undefined")
+
+        # no count left behind
+        self.assertFalse(self.store.conn.execute("SELECT * FROM kinds WHERE count <= 0").fetchall())
+
+    def test_backfill(self):
+
+        kinds = sorted(self.store.conn.execute("SELECT * FROM kinds"))
+
+        # a database created before the kinds index
+        self.close()
+        conn = sqlite3.connect(self.database)
+        with conn:
+            conn.execute("DROP TABLE kinds")
+            conn.execute("DROP TRIGGER kind_add")
+            conn.execute("DROP TRIGGER kind_delete")
+        conn.close()
+
+        self.open()
+        self.assertEqual(sorted(self.store.conn.execute("SELECT * FROM kinds")), kinds)
+        self.assertLegacyKinds()
+
+        # the triggers are in place
+        self.kb.retract(["johnny hasAge 42"])
+        self.kb.add(["batman rdf:type Human"])
+        self.kb.reason()
+        self.assertLegacyKinds()
+        self.assertEqual(self.store.typeof("hasAge", ["default"]), "datatype_property")
+        self.assertEqual(self.store.typeof("batman", ["default"]), "instance")
+
+
+class TestAxioms(StoreTestCase):
+
+    def assertCacheUpToDate(self):
+        """ The cache matches the axioms loaded from the triples.
+        """
+        cache = dict(self.store._axioms)
+        self.store.load_axioms()
+        self.assertEqual(cache, self.store._axioms)
+
+    def test_models(self):
+
+        self.kb.add(["hasAge rdf:type owl:FunctionalProperty", "hasParent owl:inverseOf hasChild"])
+        self.kb.add(["hasAge rdf:type owl:FunctionalProperty"], models = ["other"])
+        self.assertEqual(self.store.propertiesof("owl:FunctionalProperty"), {"hasAge"})
+        self.assertEqual(self.store.inversesof("hasChild"), {"hasParent"})
+        self.assertCacheUpToDate()
+
+        # still stated in the other model
+        self.kb.retract(["hasAge rdf:type owl:FunctionalProperty", "hasParent owl:inverseOf hasChild"], models = ["default"])
+        self.assertEqual(self.store.propertiesof("owl:FunctionalProperty"), {"hasAge"})
+        self.assertEqual(self.store.inversesof("hasChild"), set())
+        self.kb.update(["johnny hasAge 42"])
+        self.kb.update(["johnny hasAge 43"])
+        self.assertEqual(self.kb.find(["?age"], ["johnny hasAge ?age"]), ["43"])
+        self.assertCacheUpToDate()
+
+        self.kb.retract(["hasAge rdf:type owl:FunctionalProperty"], models = ["other"])
+        self.assertFalse(self.store.propertiesof("owl:FunctionalProperty"))
+        self.kb.update(["johnny hasAge 44"])
+        self.assertItemsEqual(self.kb.find(["?age"], ["johnny hasAge ?age"]), ["43", "44"])
+        self.assertCacheUpToDate()
+
+    def test_other_connection(self):
+
+        # axioms written by another process (eg, the reasoner)
+        other = MinimalKB(database = self.database, services = MinimalKB.SERVICES_INPROCESS)
+        other.add(["hasAge rdf:type owl:FunctionalProperty"])
+        self.store.onupdate()
+        self.assertEqual(self.store.propertiesof("owl:FunctionalProperty"), {"hasAge"})
+
+        # ...while the changes have been trimmed from the change log
+        other.add(["hasParent owl:inverseOf hasChild"])
+        other.retract(["hasAge rdf:type owl:FunctionalProperty"])
+        with other.store.conn:
+            other.store.conn.execute("DELETE FROM changelog")
+        other.add(["johnny rdf:type Human"])
+        self.store.onupdate()
+        self.assertFalse(self.store.propertiesof("owl:FunctionalProperty"))
+        self.assertEqual(self.store.inversesof("hasChild"), {"hasParent"})
+        self.assertCacheUpToDate()
+
+        other.store.conn.close()
+
+    def test_rollback(self):
+
+        self.kb.add(["hasParent owl:inverseOf hasChild"])
+
+        self.store.begin_group()
+        self.kb.add(["hasAge rdf:type owl:FunctionalProperty"])
+        self.kb.retract(["hasParent owl:inverseOf hasChild"])
+        self.assertEqual(self.store.propertiesof("owl:FunctionalProperty"), {"hasAge"})
+        self.assertEqual(self.store.inversesof("hasChild"), set())
+        self.store.rollback_group()
+
+        self.assertFalse(self.store.propertiesof("owl:FunctionalProperty"))
+        self.assertEqual(self.store.inversesof("hasChild"), {"hasParent"})
+        self.assertCacheUpToDate()
+
+        # the cache still follows the changes after the rollback
+        self.kb.add(["hasAge rdf:type owl:FunctionalProperty"])
+        self.assertEqual(self.store.propertiesof("owl:FunctionalProperty"), {"hasAge"})
+        self.assertCacheUpToDate()
+
+
+class TestSameAs(StoreTestCase):
+
+    def sameas(self):
+        """ Returns the equivalences known to the store: {resource:
+        canonical}, {canonical: sorted equivalents}, and the 'sameas' table.
+        """
+        return (dict(self.store._canonical),
+                {c: sorted(r) for c, r in self.store._equivalents.items()},
+                set(self.store.conn.execute("SELECT resource, canonical FROM sameas")))
+
+    def assertSameAsUpToDate(self):
+        """ The incrementally maintained equivalences match the ones rebuilt
+        from scratch.
+        """
+        incremental = self.sameas()
+        self.store.sameas_changed(reload = True)
+        self.assertEqual(incremental, self.sameas())
+
+    def test_union_find(self):
+
+        pairs = [("d", "c"), ("b", "c"), ("a", "d"), ("x", "y")]
+        for order in [pairs, list(reversed(pairs))]:
+            sameas = SameAs(order)
+            self.assertEqual(sameas.canonical(), {"a": "a", "b": "a", "c": "a", "d": "a", "x": "x", "y": "x"})
+            self.assertEqual(sameas.find("z"), "z")
+
+        # without (a, d), {a, b, c, d} splits in {a} and {b, c, d}
+        sameas.split("abcd", [("d", "c"), ("b", "c")])
+        self.assertEqual(sameas.canonical(), {"b": "b", "c": "b", "d": "b", "x": "x", "y": "x"})
+        self.assertEqual(sameas.canonical(["a", "c", "y"]), {"c": "b", "y": "x"})
+
+    def test_rewriting(self):
+
+        self.kb.add(["batman owl:sameAs brucewayne", "brucewayne livesIn gotham",
+                     "robin likes batman", "dick owl:sameAs robin"])
+
+        # results are reported with the canonical resources
+        self.assertEqual(self.kb.find(["?x"], ["?x livesIn gotham"]), ["batman"])
+        self.assertEqual(self.kb.find(["?x"], ["?x likes brucewayne"]), ["dick"])
+        self.assertEqual(self.kb.find(["?x", "?y"], ["?x likes ?y", "?y livesIn gotham"]), [{"x": "dick", "y": "batman"}])
+        self.assertTrue(self.kb.exist(["robin likes brucewayne"]))
+
+        self.kb.retract(["batman owl:sameAs brucewayne"])
+        self.assertEqual(self.kb.find(["?x"], ["?x livesIn gotham"]), ["brucewayne"])
+        self.assertFalse(self.kb.exist(["robin likes brucewayne"]))
+        self.assertTrue(self.kb.exist(["robin likes batman"]))
+
+    def test_incremental(self):
+
+        self.kb.add(["a owl:sameAs b", "x owl:sameAs y"])
+        self.assertSameAsUpToDate()
+
+        # merging two sets
+        self.kb.add(["c owl:sameAs d", "d owl:sameAs b"])
+        self.assertEqual(sorted(self.store.equivalents("c")), ["a", "b", "c", "d"])
+        self.assertSameAsUpToDate()
+
+        # splitting a set, the other one being left untouched
+        self.kb.retract(["d owl:sameAs b"])
+        self.assertEqual(sorted(self.store.equivalents("c")), ["c", "d"])
+        self.assertEqual(sorted(self.store.equivalents("b")), ["a", "b"])
+        self.assertSameAsUpToDate()
+
+        # a resource left without equivalent
+        self.kb.retract(["x owl:sameAs y"])
+        self.assertEqual(self.store.canonical("y"), "y")
+        self.assertEqual(self.store.equivalents("y"), ["y"])
+        self.assertSameAsUpToDate()
+
+        # added and removed in the same group
+        self.store.begin_group()
+        self.kb.add(["y owl:sameAs c"])
+        self.kb.retract(["c owl:sameAs d"])
+        self.store.commit_group()
+        self.assertEqual(sorted(self.store.equivalents("y")), ["c", "y"])
+        self.assertSameAsUpToDate()
+
+
+TAXONOMY = ["alfred rdf:type Human", "Human rdfs:subClassOf Mammal", "Mammal rdfs:subClassOf Animal",
+            "nemo rdf:type Fish", "Fish rdfs:subClassOf Animal", "Animal rdfs:subClassOf Creature",
+            "Creature rdfs:subClassOf Thing", "likes rdfs:domain Agent", "Agent rdfs:subClassOf Thing",
+            "batman likes nemo", "bruce owl:sameAs batman"]
+
+# statements in another model: the taxonomy of a model does not apply to the
+# other ones
+OTHER = ["r2d2 rdf:type Robot", "Robot rdfs:subClassOf Machine", "Human rdfs:subClassOf Machine",
+         "Animal rdfs:subClassOf Machine"]
+
+# (variables, patterns) of the queries on the closure
+TAXONOMY_QUERIES = [(["?c"], ["alfred rdf:type ?c"]),
+                    (["?c"], ["bruce rdf:type ?c"]),
+                    (["?x"], ["?x rdf:type Animal"]),
+                    (["?x"], ["?x rdf:type Thing"]),
+                    (["?x"], ["?x rdf:type Machine"]),
+                    (["?x", "?c"], ["?x rdf:type ?c"]),
+                    (["?c"], ["Human rdfs:subClassOf ?c"]),
+                    (["?c"], ["Creature rdfs:subClassOf ?c"]),
+                    (["?c"], ["?c rdfs:subClassOf Thing"]),
+                    (["?c"], ["?c rdfs:subClassOf Machine"]),
+                    (["?a", "?b"], ["?a rdfs:subClassOf ?b"]),
+                    (["?x", "?c"], ["?x rdf:type ?c", "?c rdfs:subClassOf Animal"]),
+                    (["?x", "?c"], ["?x likes ?y", "?y rdf:type ?c"]),
+                    ([], ["alfred rdf:type Thing"]),
+                    ([], ["alfred rdf:type Fish"])]
+
+class TestBackward(StoreTestCase):
+    """ The closure of the taxonomy computed at query time matches the one
+    materialized by the reasoner.
+    """
+
+    reasoning = MinimalKB.REASONING_BACKWARD
+
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.forwarddb = tempfile.mktemp(suffix = ".db")
+        self.forward = MinimalKB(database = self.forwarddb,
+                                 reasoning = MinimalKB.REASONING_FORWARD,
+                                 services = MinimalKB.SERVICES_INPROCESS)
+        for kb in [self.kb, self.forward]:
+            kb.add(TAXONOMY)
+            kb.add(OTHER, models = ["other"])
+            kb.reason()
+
+    def tearDown(self):
+        self.forward.stop_services()
+        self.forward.store.conn.close()
+        os.remove(self.forwarddb)
+        StoreTestCase.tearDown(self)
+
+    def assertSameResults(self, vars, patterns, models):
+        backward = self.kb.find(vars, patterns, models = models)
+        forward = self.forward.find(vars, patterns, models = models)
+        if vars:
+            self.assertItemsEqual(backward, forward, "%s %s in %s" % (vars, patterns, models))
+        else:
+            self.assertEqual(bool(backward), bool(forward), "%s in %s" % (patterns, models))
+
+    def test_closure(self):
+
+        # not materialized...
+        self.assertFalse(self.store.conn.execute("SELECT * FROM triples WHERE subject='alfred' AND object='Thing'").fetchall())
+
+        for models in [None, ["default"], ["other"], ["default", "other"]]:
+            for vars, patterns in TAXONOMY_QUERIES:
+                self.assertSameResults(vars, patterns, models)
+
+        self.assertTrue(self.kb.exist(["alfred rdf:type Thing"]))
+        self.assertItemsEqual(self.kb.find(["?c"], ["Human rdfs:subClassOf ?c"], models = ["default"]),
+                              ["Mammal", "Animal", "Creature", "Thing"])
+
+    def test_equivalent_class(self):
+
+        # (equivalent classes are subclasses of each other, which the
+        # reasoner does not materialize)
+        self.kb.add(["Person owl:equivalentClass Human", "Person rdfs:subClassOf Agent"])
+        self.assertItemsEqual(self.kb.find(["?c"], ["Person rdfs:subClassOf ?c"], models = ["default"]),
+                              ["Human", "Mammal", "Animal", "Creature", "Agent", "Thing"])
+        self.assertItemsEqual(self.kb.find(["?c"], ["?c rdfs:subClassOf Person"], models = ["default"]), ["Human"])
+        self.assertItemsEqual(self.kb.find(["?c"], ["alfred rdf:type ?c"], models = ["default"]),
+                              ["Person", "Human", "Mammal", "Animal", "Creature", "Agent", "Thing"])
+        self.assertItemsEqual(self.kb.find(["?x"], ["?x rdf:type Agent"], models = ["default"]), ["alfred", "batman"])
+
+    def test_retract(self):
+
+        for kb in [self.kb, self.forward]:
+            kb.retract(["Mammal rdfs:subClassOf Animal", "Robot rdfs:subClassOf Machine"], models = ["default", "other"])
+            kb.reason()
+
+        for models in [None, ["default"], ["other"]]:
+            for vars, patterns in TAXONOMY_QUERIES:
+                self.assertSameResults(vars, patterns, models)
+
+
+class TestLabels(StoreTestCase):
+
+    def test_fuzzy_lookup(self):
+
+        self.kb.add(['cup1 rdfs:label "red cup"', 'cup2 rdfs:label "cup"',
+                     'cup3 rdfs:label "big red cup with handle"', 'box1 rdfs:label "red box"',
+                     'table1 rdfs:label "table"'])
+        self.kb.add(['thing%s rdfs:label "thing %s"' % (i, i) for i in range(200)])
+
+        # the longest label which is part of the text first...
+        self.assertEqual([r for r, t in self.kb.lookup("the red cup", fuzzy = True, limit = 3)],
+                         ["cup1", "cup2", "cup3"])
+        self.assertEqual([r for r, t in self.kb.lookup("RED CUP", fuzzy = True, limit = 1)], ["cup1"])
+
+        # ...then the labels containing the most words
+        matches = [r for r, t in self.kb.lookup("red handle", fuzzy = True, limit = 2)]
+        self.assertEqual(matches[0], "cup3")
+        self.assertIn(matches[1], ["cup1", "box1"])
+
+        # misspelled words fall back to the labels sharing trigrams
+        self.assertEqual([r for r, t in self.kb.lookup("tabel", fuzzy = True, limit = 1)], ["table1"])
+
+        # candidates are bounded, not the results of the unlimited lookup
+        self.assertEqual(len(self.kb.lookup("thing", fuzzy = True, limit = 5)), 5)
+        self.assertEqual(len(self.kb.lookup("thing", fuzzy = True)), 200)
+
+    def test_fuzzy_lookup_best_candidates(self):
+
+        # more matching labels than LABEL_CANDIDATES, the best one last
+        self.kb.add(['obj%s rdfs:label "red mug holder number %s"' % (i, i) for i in range(4 * LABEL_CANDIDATES)])
+        self.kb.add(['best rdfs:label "red mugs"'])
+
+        self.assertEqual(self.kb.lookup("red mug", fuzzy = True)[0][0], "best")
+        self.assertEqual(self.kb.lookup("red mug", fuzzy = True, limit = 3)[0][0], "best")
+
+
+class TestJoinQuery(StoreTestCase):
+
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.kb.add(["alfred looksAt cup", "johnny looksAt cup", "johnny looksAt spoon",
+                     "cup isOn table", "spoon isOn shelf"])
+        self.patterns = [("?agent", "looksAt", "?obj"), ("?obj", "isOn", "?place")]
+
+    def test_routing(self):
+
+        # several variables over several patterns: compiled into a join
+        res = query(self.store.conn, ["?agent", "?obj"], self.patterns, ["default"])
+        self.assertEqual(sorted(res), [{"agent": "alfred", "obj": "cup"},
+                                       {"agent": "johnny", "obj": "cup"},
+                                       {"agent": "johnny", "obj": "spoon"}])
+        self.assertEqual(sorted(res), sorted(joinquery(self.store.conn, ["?agent", "?obj"], self.patterns, ["default"])))
+
+        # one variable: the candidates are computed pattern by pattern
+        patterns = [("?agent", "looksAt", "cup"), ("?agent", "looksAt", "spoon")]
+        self.assertEqual(query(self.store.conn, ["?agent"], patterns, ["default"]), ["johnny"])
+        self.assertEqual(joinquery(self.store.conn, ["?agent"], patterns, ["default"]), ["johnny"])
+
+    def test_delta(self):
+
+        vars = ["?agent", "?obj", "?place"]
+        self.kb.add(["alfred looksAt spoon", "fork isOn table"])
+
+        # only the bindings depending on the staged statements, whatever the
+        # pattern they match
+        self.store.stage_delta([("alfred", "looksAt", "spoon", "default"), ("cup", "isOn", "table", "default")])
+        self.assertEqual(self.store.bindings(vars, self.patterns, ["default"], delta = 0),
+                         {("alfred", "spoon", "shelf")})
+        self.assertEqual(self.store.bindings(vars, self.patterns, ["default"], delta = 1),
+                         {("alfred", "cup", "table"), ("johnny", "cup", "table")})
+
+        # the staged statements that are not in the KB anymore are ignored
+        self.kb.retract(["alfred looksAt spoon"])
+        self.store.stage_delta([("alfred", "looksAt", "spoon", "default")])
+        self.assertEqual(self.store.bindings(vars, self.patterns, ["default"], delta = 0), set())
+
+
+class TestDetails(StoreTestCase):
+
+    def test_details_many(self):
+
+        # more resources (and related concepts) than fit in one batch of
+        # SQL parameters
+        n = 2 * MAX_PARAMS + 10
+        self.kb.add(["Thing%s rdfs:subClassOf Thing" % i for i in range(n)])
+        self.kb.add(["thing%s rdf:type Thing%s" % (i, i) for i in range(n)])
+        self.kb.add(['thing%s rdfs:label "thing number %s"' % (i, i) for i in range(n)])
+
+        resources = ["Thing%s" % i for i in range(n)] + ["thing%s" % i for i in range(n)] + ["Thing"]
+        details = self.kb.details_many(resources)
+        self.assertEqual(len(details), len(resources))
+
+        # the same as the details of each resource alone
+        for resource in ["Thing0", "Thing%s" % (n - 1), "thing%s" % MAX_PARAMS, "thing%s" % (n - 1)]:
+            self.assertEqual(details[resources.index(resource)], self.kb.details(resource))
+
+        for i in [0, MAX_PARAMS, n - 1]:
+            cls, instance = details[i], details[n + i]
+            self.assertEqual(cls["type"], "class")
+            self.assertEqual(cls["attributes"][0]["values"], [{"id": "Thing", "name": "Thing"}])
+            self.assertEqual(cls["attributes"][2]["values"],
+                             [{"id": "thing%s" % i, "name": '"thing number %s"' % i}])
+            self.assertEqual(instance["type"], "instance")
+            self.assertEqual(instance["name"], '"thing number %s"' % i)
+            self.assertEqual(instance["attributes"][0]["values"], [{"id": "Thing%s" % i, "name": "Thing%s" % i}])
+
+        self.assertEqual(len(details[-1]["attributes"][1]["values"]), n)
+
+
+def version():
+    print("minimalKB tests %s" % __version__)
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Store tests for minimalKB.')
+    parser.add_argument('-v', '--version', action='version',
+                       version=version(), help='returns minimalKB version')
+    parser.add_argument('-f', '--failfast', action='store_true',
+                                help='stops at first failed test')
+
+    args = parser.parse_args()
+
+    unittest.main(failfast=args.failfast)